@@ -0,0 +1,196 @@
+"""One NumPy table of all actors per world tick.
+
+The controllers used to sweep world.get_actors().filter(...) several times per tick
+and then ask every actor for its transform and velocity. The WorldSnapshot that
+wait_for_tick() returns already holds the transform and velocity of every actor,
+so ActorSnapshotService turns it into one table and only asks the server for the
+actor descriptions (type id, handle) when actors spawn or despawn.
+
+Example:
+    service = ActorSnapshotService(world)
+    table = service.update(world.wait_for_tick())
+    rows = table.rows(VEHICLE)
+    speeds = table.speeds()[rows]
+"""
+
+import numpy as np
+
+from Proximity import ProximityGrid
+
+
+# Actor kinds of the table
+VEHICLE = 0
+WALKER = 1
+TRAFFIC_LIGHT = 2
+OTHER = 3
+
+_KIND_PREFIXES = (('vehicle.', VEHICLE), ('walker.', WALKER), ('traffic.traffic_light', TRAFFIC_LIGHT))
+
+# Column layout of ActorTable.data
+X, Y, Z, YAW, PITCH, VX, VY, VZ = range(8)
+
+
+def actor_kind(type_id):
+    """Kind of an actor from its blueprint id, e.g. 'vehicle.bmw.grandtourer' -> VEHICLE"""
+    for prefix, kind in _KIND_PREFIXES:
+        if type_id.startswith(prefix):
+            return kind
+    return OTHER
+
+
+class ActorTable(object):
+    """
+    All actors of one tick, one row per actor.
+
+    data: (N, 8) float64 with the columns X, Y, Z, YAW, PITCH (degrees), VX, VY, VZ
+    ids, kinds: (N,) actor ids and kinds
+    light_states: (N,) int(carla.TrafficLightState) for traffic lights, -1 otherwise
+    type_ids, actors: blueprint ids and carla.Actor handles, for the rare calls that
+                      need the actor itself (commands, map queries)
+    """
+
+    def __init__(self, frame, timestamp, ids, data, layout, light_states):
+        self.frame = frame
+        self.timestamp = timestamp
+        self.ids = ids
+        self.data = data
+        self.light_states = light_states
+        self._layout = layout
+        self._grid = None
+
+    @property
+    def kinds(self):
+        return self._layout.kinds
+
+    @property
+    def type_ids(self):
+        return self._layout.type_ids
+
+    @property
+    def actors(self):
+        return self._layout.actors
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, actor_id):
+        """Row of an actor, or None when it is not in the table"""
+        return self._layout.rows.get(actor_id)
+
+    def rows(self, kind):
+        """Rows of all actors of a kind"""
+        return self._layout.kind_rows[kind]
+
+    @property
+    def locations(self):
+        return self.data[:, X:Z + 1]
+
+    @property
+    def velocities(self):
+        return self.data[:, VX:VZ + 1]
+
+    @property
+    def grid(self):
+        """Proximity.ProximityGrid of the actor locations, built on first use"""
+        if self._grid is None:
+            self._grid = ProximityGrid(self.locations)
+        return self._grid
+
+    def mask(self, kind):
+        """(N,) boolean mask of the actors of a kind"""
+        return self._layout.kind_masks[kind]
+
+    def speeds(self):
+        """(N,) speeds in m/s"""
+        return np.sqrt(np.einsum('ij,ij->i', self.velocities, self.velocities))
+
+    def forward(self, row):
+        """Unit forward vector of an actor, like Transform.get_forward_vector()"""
+        yaw, pitch = np.radians(self.data[row, [YAW, PITCH]])
+        return np.array([np.cos(pitch) * np.cos(yaw), np.cos(pitch) * np.sin(yaw), np.sin(pitch)])
+
+    def speed(self, actor_id):
+        """Speed of an actor in m/s, None when it is not in the table"""
+        row = self.row(actor_id)
+        if row is None:
+            return None
+        return float(np.sqrt(np.dot(self.data[row, VX:VZ + 1], self.data[row, VX:VZ + 1])))
+
+
+class _Layout(object):
+    """Per-row metadata, rebuilt only when the set of actors changes"""
+
+    def __init__(self, ids, descriptions):
+        self.ids = ids
+        self.type_ids = [descriptions[actor_id][0] for actor_id in ids.tolist()]
+        self.actors = [descriptions[actor_id][1] for actor_id in ids.tolist()]
+        self.kinds = np.array([actor_kind(type_id) for type_id in self.type_ids], dtype=np.int8)
+        self.rows = {actor_id: row for row, actor_id in enumerate(ids.tolist())}
+        self.kind_masks = {kind: self.kinds == kind for kind in (VEHICLE, WALKER, TRAFFIC_LIGHT, OTHER)}
+        self.kind_rows = {kind: np.flatnonzero(mask) for kind, mask in self.kind_masks.items()}
+        self.light_actors = [self.actors[row] for row in self.kind_rows[TRAFFIC_LIGHT]]
+
+
+class ActorSnapshotService(object):
+    """
+    Class building an ActorTable per tick from the WorldSnapshot.
+
+    refreshes counts the get_actors() calls, i.e. the ticks where actors spawned or
+    despawned.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self.table = None
+        self.refreshes = 0
+        self._layout = None
+        self._descriptions = {}
+
+    def update(self, world_snapshot=None):
+        """
+        :param world_snapshot: carla.WorldSnapshot of the tick, defaults to world.get_snapshot()
+        :return: ActorTable of the tick
+        """
+        if world_snapshot is None:
+            world_snapshot = self.world.get_snapshot()
+        ids = []
+        values = []
+        for actor in world_snapshot:
+            transform = actor.get_transform()
+            velocity = actor.get_velocity()
+            location = transform.location
+            ids.append(actor.id)
+            values.append((location.x, location.y, location.z, transform.rotation.yaw,
+                           transform.rotation.pitch, velocity.x, velocity.y, velocity.z))
+        ids = np.array(ids, dtype=np.int64)
+        data = np.array(values, dtype=np.float64).reshape(-1, 8)
+
+        if self._layout is None or not np.array_equal(ids, self._layout.ids):
+            self._refresh(ids)
+        # The light state is not in the WorldSnapshot, TrafficLight.state reads the
+        # client side copy of the episode state and costs no round trip
+        light_states = np.full(len(ids), -1, dtype=np.int8)
+        light_states[self._layout.kind_rows[TRAFFIC_LIGHT]] = [
+            int(light.state) for light in self._layout.light_actors]
+
+        timestamp = world_snapshot.timestamp
+        self.table = ActorTable(world_snapshot.frame, timestamp.elapsed_seconds, ids, data,
+                                self._layout, light_states)
+        return self.table
+
+    def _refresh(self, ids):
+        """Describe the actors that appeared, forget the ones that are gone"""
+        current = set(ids.tolist())
+        new_ids = [actor_id for actor_id in current if actor_id not in self._descriptions]
+        if new_ids:
+            self.refreshes += 1
+            for actor in self.world.get_actors(new_ids):
+                self._descriptions[actor.id] = (actor.type_id, actor)
+            # Actors destroyed between the snapshot and get_actors() stay kind OTHER until
+            # they leave the snapshot
+            for actor_id in new_ids:
+                self._descriptions.setdefault(actor_id, ('', None))
+        for actor_id in list(self._descriptions):
+            if actor_id not in current:
+                del self._descriptions[actor_id]
+        self._layout = _Layout(ids, self._descriptions)
@@ -59,6 +59,11 @@ import carla
 from Self_Driving_Agent import SelfDrivingAgent
 import DetectingObject
 from Controlling_Automatically import change_speed
+from Actor_Snapshot import ActorSnapshotService
+from Ego_State import EgoStateProvider
+from Traffic_Light_Index import TrafficLightIndex
+from Drivable_Area import DrivableArea
+from Lead_Vehicle import LeadVehicleIndex
 
 from agents.navigation.behavior_agent import BehaviorAgent
 # ==============================================================================
@@ -102,6 +107,15 @@ class World(object):
         self._actor_filter = args.filter
         self._gamma = args.gamma
         self.hud = hud
+        self.actor_snapshots = ActorSnapshotService(self.world)
+        self.snapshot = None
+        self.light_index = TrafficLightIndex(self.world, self.map)
+        self.drivable_area = DrivableArea.from_map(self.map)
+        self.lead_vehicles = LeadVehicleIndex(self.map)
+        # simulate_physics set by change_speed, per vehicle id
+        self.physics = {}
+        self.ego = None
+        self.ego_state = None
         self.restart(args)
         
 
@@ -149,6 +163,8 @@ class World(object):
             self.camera_manager.set_sensor(1, notify=False)
             actor_type = get_actor_display_name(self.player)
             print('spawned %r at %s' % (actor_type, spawn_point.location))
+        if self.ego is None:
+            self.ego = EgoStateProvider(self.player, self.world)
 
     def next_weather(self, reverse=False):
         """Method to change the weather"""
@@ -157,6 +173,11 @@ class World(object):
         preset = self._weather_presets[self._weather_presets]
         self.player.get_world().set_weather(preset[0])
 
+    def tick(self, world_snapshot):
+        """Build the actor table and the ego state of the tick, read by the controller, the agent and the HUD"""
+        self.snapshot = self.actor_snapshots.update(world_snapshot)
+        self.ego_state = self.ego.update(world_snapshot, self.snapshot)
+
     def render(self, display):
         """ Method to render the world """
         state, labels = self.camera_manager.render(display)
@@ -171,6 +192,9 @@ class World(object):
                     
     def destroy(self):
         """Destroy the player"""
+        if self.ego is not None:
+            self.ego.destroy()
+            self.ego = None
         actors = [
             self.camera_manager.sensor,
             self.player]
@@ -197,10 +221,14 @@ class HUD(object):
 
     def render(self, world, display):
         """Method to render the HUD"""
-        velocity = world.player.get_velocity()
-        if velocity is not None:
-            speed = 3.6 * math.sqrt(velocity.x**2 + velocity.y**2 + velocity.z**2)
-            display.blit(self._font.render('Speed: % 5d km/h' % speed, True, (255, 255, 255)), (10, 10))
+        if world.ego_state is not None:
+            speed = world.ego_state.speed
+        else:
+            speed = world.snapshot.speed(world.player.id) if world.snapshot is not None else None
+        if speed is None:
+            velocity = world.player.get_velocity()
+            speed = math.sqrt(velocity.x**2 + velocity.y**2 + velocity.z**2)
+        display.blit(self._font.render('Speed: % 5d km/h' % (3.6 * speed), True, (255, 255, 255)), (10, 10))
 
 # ==============================================================================
 # -- KeyboardControl -----------------------------------------------------------
@@ -335,7 +363,7 @@ def game_loop(args):
             if not world.world.wait_for_tick(10.0):
                 continue
 
-            world.world.wait_for_tick(10.0)
+            world.tick(world.world.wait_for_tick(10.0))
 
             state, labels = world.render(display)
             pygame.display.flip()
@@ -381,7 +409,10 @@ def game_loop(args):
 # Using autopilot code
             if (data):
                 world.player.set_autopilot(True, tm_port)
-                last_stop_time = change_speed(client.get_world(),some_state, world.map, world.player, desired_speed, last_stop_time)
+                last_stop_time = change_speed(world.world, some_state, world.map, world.player, desired_speed, last_stop_time,
+                                              snapshot=world.snapshot, light_index=world.light_index,
+                                              drivable=world.drivable_area, leads=world.lead_vehicles,
+                                              ego=world.ego_state, physics=world.physics)
 
 # Using Behaviour agent
             else:
@@ -396,7 +427,7 @@ def game_loop(args):
                     print("Target reached, stopping simulation")
                     break
 
-                speed_limit = world.player.get_speed_limit()
+                speed_limit = world.ego_state.speed_limit
                 agent.get_local_planner().set_speed(speed_limit)
                 control = agent.run_step()
                 world.player.apply_control(control)
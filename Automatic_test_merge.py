@@ -60,6 +60,14 @@ import carla
 from Self_Driving_Agent import SelfDrivingAgent
 import DetectingObject
 from Controlling_Automatically import change_speed
+from Actor_Snapshot import ActorSnapshotService
+from Ego_State import EgoStateProvider
+from Traffic_Light_Index import TrafficLightIndex
+from Drivable_Area import DrivableArea
+from Lead_Vehicle import LeadVehicleIndex
+from Detection_Evaluation import DetectionEvaluator, GroundTruthProjector, GROUND_TRUTH_CLASSES
+from Detection_Cache import DetectionCacheWriter
+from Detection_Postprocess import SignResponse
 
 from agents.navigation.behavior_agent import BehaviorAgent
 # ==============================================================================
@@ -102,7 +110,26 @@ class World(object):
         self._weather_presets = 0
         self._actor_filter = args.filter
         self._gamma = args.gamma
+        self._conf_threshold = args.conf
+        self.evaluator = None
+        if args.evaluate:
+            thresholds = [float(x) for x in args.conf_thresholds.split(',')]
+            self.evaluator = DetectionEvaluator(
+                conf_thresholds=thresholds,
+                classes=[label for _, label in GROUND_TRUTH_CLASSES])
+        self.detection_cache = None
+        if args.cache_run:
+            self.detection_cache = DetectionCacheWriter(args.cache_run, args.cache_dir)
         self.hud = hud
+        self.actor_snapshots = ActorSnapshotService(self.world)
+        self.snapshot = None
+        self.light_index = TrafficLightIndex(self.world, self.map)
+        self.drivable_area = DrivableArea.from_map(self.map)
+        self.lead_vehicles = LeadVehicleIndex(self.map)
+        # simulate_physics set by change_speed, per vehicle id
+        self.physics = {}
+        self.ego = None
+        self.ego_state = None
         self.restart(args)
         
 
@@ -145,11 +172,15 @@ class World(object):
             self.player = self.world.spawn_actor(blueprint, spawn_point)
 
                 # Set up the camera sensor
-            self.camera_manager = CameraManager(self.player, self._gamma, args.width, args.height)
+            self.camera_manager = CameraManager(self.player, self._gamma, args.width, args.height,
+                                                self._conf_threshold, self.evaluator,
+                                                self.detection_cache)
             self.camera_manager.transform_index = cam_pos_id
             self.camera_manager.set_sensor(1, notify=False)
             actor_type = get_actor_display_name(self.player)
             print('spawned %r at %s' % (actor_type, spawn_point.location))
+        if self.ego is None:
+            self.ego = EgoStateProvider(self.player, self.world)
 
     def next_weather(self, reverse=False):
         """Method to change the weather"""
@@ -158,6 +189,11 @@ class World(object):
         preset = self._weather_presets[self._weather_presets]
         self.player.get_world().set_weather(preset[0])
 
+    def tick(self, world_snapshot):
+        """Build the actor table and the ego state of the tick, read by the controller, the agent and the HUD"""
+        self.snapshot = self.actor_snapshots.update(world_snapshot)
+        self.ego_state = self.ego.update(world_snapshot, self.snapshot)
+
     def render(self, display):
         """ Method to render the world """
         state, labelConf = self.camera_manager.render(display)
@@ -172,6 +208,9 @@ class World(object):
                     
     def destroy(self):
         """Destroy the player"""
+        if self.ego is not None:
+            self.ego.destroy()
+            self.ego = None
         actors = [
             self.camera_manager.sensor,
             self.player]
@@ -198,10 +237,14 @@ class HUD(object):
 
     def render(self, world, display):
         """Method to render the HUD"""
-        velocity = world.player.get_velocity()
-        if velocity is not None:
-            speed = 3.6 * math.sqrt(velocity.x**2 + velocity.y**2 + velocity.z**2)
-            display.blit(self._font.render('Speed: % 5d km/h' % speed, True, (255, 255, 255)), (10, 10))
+        if world.ego_state is not None:
+            speed = world.ego_state.speed
+        else:
+            speed = world.snapshot.speed(world.player.id) if world.snapshot is not None else None
+        if speed is None:
+            velocity = world.player.get_velocity()
+            speed = math.sqrt(velocity.x**2 + velocity.y**2 + velocity.z**2)
+        display.blit(self._font.render('Speed: % 5d km/h' % (3.6 * speed), True, (255, 255, 255)), (10, 10))
 
 # ==============================================================================
 # -- KeyboardControl -----------------------------------------------------------
@@ -227,9 +270,14 @@ class KeyboardControl(object):
 class CameraManager(object):
     """ Class to manage the camera sensor """
 
-    def __init__(self, parent_actor, gamma_correction, width, height):
+    def __init__(self, parent_actor, gamma_correction, width, height,
+                 conf_threshold=DetectingObject.CONF_THRESHOLD, evaluator=None, detection_cache=None):
         self.sensor = None
         self.labelconf = []
+        self.conf_threshold = conf_threshold
+        self.evaluator = evaluator
+        self.detection_cache = detection_cache
+        self.ground_truth = None
         self.state = False
         self.surface = None
         self._parent = parent_actor
@@ -244,6 +292,8 @@ class CameraManager(object):
         if blp.has_attribute('gamma'):
             blp.set_attribute('gamma', str(gamma_correction))
         self.sensor = self._parent.get_world().spawn_actor(blp, self._camera_transforms[0], attach_to=self._parent, attachment_type=self._camera_transforms[1]) 
+        if self.evaluator is not None:
+            self.ground_truth = GroundTruthProjector(self._parent.get_world(), width, height, 50)
 
     def set_sensor(self, index, notify=True):
         """Set the sensor"""
@@ -266,7 +316,20 @@ class CameraManager(object):
         self = weak_self()
         if self is None:
             return
-        self.surface,self.state, self.labelconf = DetectingObject.parse_image(image)
+        sink = None
+        if self.evaluator is not None or self.detection_cache is not None:
+            sink = self._record_detections
+        self.surface,self.state, self.labelconf = DetectingObject.parse_image(
+            image, conf_threshold=self.conf_threshold, sink=sink)
+
+    def _record_detections(self, image, boxes, confs, labels):
+        """Feed the raw detections of a frame to the evaluator and the detection cache"""
+        gt = None
+        if self.evaluator is not None:
+            gt = self.ground_truth.project(image.transform)
+            self.evaluator.update(image.timestamp, boxes, labels, confs, *gt)
+        if self.detection_cache is not None:
+            self.detection_cache.add(image.frame, image.timestamp, boxes, confs, labels, gt)
 
 
 def game_loop(args):
@@ -279,6 +342,7 @@ def game_loop(args):
     num_min_waypoints = 21
     tm_port = 9000
     desired_speed = 8.16
+    response = SignResponse(time.time(), desired_speed)
 
     log_data = {
         "experiment_id": "blue_red_sign_behavior_test_01",
@@ -343,9 +407,6 @@ def game_loop(args):
         clock = pygame.time.Clock()
         print("Starting simulation")
         last_stop_time = time.time() - 86400
-        state_time = time.time() - 86400
-
-        vechicle_speed_state = time.time() - 86400
 
         while True:
             if controller.parse_events():
@@ -354,7 +415,7 @@ def game_loop(args):
             if not world.world.wait_for_tick(10.0):
                 continue
 
-            world.world.wait_for_tick(10.0)
+            world.tick(world.world.wait_for_tick(10.0))
 
             state, labelConf= world.render(display)
             pygame.display.flip()
@@ -362,11 +423,6 @@ def game_loop(args):
             current_time = time.time()
 
 
-            if state:
-               state_time = time.time()
-            
-
-            some_state = False
             labels = labelConf[0] if labelConf else []
             confs = labelConf[1] if labelConf else []
 
@@ -377,36 +433,9 @@ def game_loop(args):
 
 
 #        Changing the desired speed based on Sign Detected
-            if labels is None:
-                pass
-            elif current_time - state_time < 10.0 and "crosswalk-blue" in labels:
-                some_state = True
-                desired_speed = 0
-              
-               
-            
-            elif current_time - state_time < 2.0:
-                some_state = True
-                desired_speed = 0
+            some_state, desired_speed = response.update(current_time, state, labels)
+            if some_state:
                 print ("Pedestrian detected, stopping vehicle");
-                           
-            elif "crosswalk-red" in labels:
-                desired_speed = 15/3.6
-                vechicle_speed_state = time.time() - 25
-
-            elif "crosswalk-blue"  in labels: 
-                desired_speed = 10/3.6
-                vechicle_speed_state = time.time() - 30
-            elif "speed-30" in labels:
-                desired_speed = 20/3.6
-                vechicle_speed_state = time.time()
-                print(labels)
-            elif "speed-60" in labels:
-                desired_speed = 30/3.6
-                vechicle_speed_state = time.time()
-                print(labels)
-            elif current_time - vechicle_speed_state >= 40:
-                desired_speed = 8.16
             for index in range(len(labels)):
                 log_event("Testing", {
                     "sign": labels[index],
@@ -419,7 +448,10 @@ def game_loop(args):
 # Using autopilot code
             if (data):
                 world.player.set_autopilot(True, tm_port)
-                last_stop_time = change_speed(client.get_world(),some_state, world.map, world.player, desired_speed, last_stop_time)
+                last_stop_time = change_speed(world.world, some_state, world.map, world.player, desired_speed, last_stop_time,
+                                              snapshot=world.snapshot, light_index=world.light_index,
+                                              drivable=world.drivable_area, leads=world.lead_vehicles,
+                                              ego=world.ego_state, physics=world.physics)
 
 # Using Behaviour agent
             else:
@@ -434,7 +466,7 @@ def game_loop(args):
                     print("Target reached, stopping simulation")
                     break
 
-                speed_limit = world.player.get_speed_limit()
+                speed_limit = world.ego_state.speed_limit
                 agent.get_local_planner().set_speed(speed_limit)
                 control = agent.run_step()
                 world.player.apply_control(control)
@@ -445,6 +477,13 @@ def game_loop(args):
         with open("ped_sign_behavior_log.json", "w") as f:
             json.dump(log_data, f, indent=2)
         print(f"[LOG SAVED] Total Events: {len(log_data['events'])}")
+        if world is not None and world.evaluator is not None:
+            world.evaluator.save(args.evaluate)
+            world.evaluator.print_summary()
+            print(f"[EVALUATION SAVED] {args.evaluate}")
+        if world is not None and world.detection_cache is not None:
+            world.detection_cache.close()
+            print(f"[DETECTIONS CACHED] {world.detection_cache.path}")
         if world is not None:
             world.destroy()
 
@@ -507,6 +546,29 @@ def main():
         type=bool,
         default=False,
         help='Use custom code')
+    argparser.add_argument(
+        '--conf',
+        default=DetectingObject.CONF_THRESHOLD,
+        type=float,
+        help='Detection confidence threshold (default: %(default)s)')
+    argparser.add_argument(
+        '--evaluate',
+        metavar='PATH',
+        default=None,
+        help='Evaluate the detector against ground truth and write the metrics to PATH')
+    argparser.add_argument(
+        '--conf-thresholds',
+        default='0.5,0.6,0.75,0.85',
+        help='Comma separated confidence thresholds evaluated with --evaluate')
+    argparser.add_argument(
+        '--cache-run',
+        metavar='RUN_ID',
+        default=None,
+        help='Cache the raw detections of this run for offline replay (see Detection_Cache.py)')
+    argparser.add_argument(
+        '--cache-dir',
+        default='detection_cache',
+        help='Directory of the detection cache (default: %(default)s)')
 
     args = argparser.parse_args()
 
@@ -0,0 +1,89 @@
+# Helpers to project world points (actor boxes, waypoints) into the camera image
+import numpy as np
+
+
+# ---------- 1. Camera Intrinsics ----------
+def build_projection_matrix(width, height, fov):
+    """
+    Build the pinhole intrinsics of a CARLA RGB camera.
+
+    :param width: image width in pixels
+    :param height: image height in pixels
+    :param fov: horizontal field of view in degrees
+    """
+    focal = width / (2.0 * np.tan(fov * np.pi / 360.0))
+    K = np.identity(3)
+    K[0, 0] = K[1, 1] = focal
+    K[0, 2] = width / 2.0
+    K[1, 2] = height / 2.0
+    return K
+
+# ---------- 2. Camera Extrinsics ----------
+def world_to_camera_matrix(camera_transform):
+    """Return the 4x4 world -> camera matrix of a carla.Transform"""
+    return np.array(camera_transform.get_inverse_matrix())
+
+# ---------- 3. Point Projection ----------
+def project_points(points, world_to_camera, K):
+    """
+    Project world points into the image.
+
+    :param points: (N, 3) array of world coordinates
+    :param world_to_camera: 4x4 matrix from world_to_camera_matrix
+    :param K: 3x3 intrinsics from build_projection_matrix
+    :return: (N, 2) pixel coordinates and (N,) depth in meters (<= 0 is behind the camera)
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    homogeneous = np.hstack((points, np.ones((points.shape[0], 1))))
+    cam = homogeneous.dot(world_to_camera.T)
+    # UE4 (x forward, y right, z up) -> camera (x right, y down, z forward)
+    cam = np.stack((cam[:, 1], -cam[:, 2], cam[:, 0]), axis=1)
+    depth = cam[:, 2]
+    safe = np.where(np.abs(depth) < 1e-6, 1e-6, depth)
+    pixels = cam.dot(K.T)[:, :2] / safe[:, None]
+    return pixels, depth
+
+# ---------- 4. Actor Bounding Boxes ----------
+# Corners of a unit box, scaled by the actor's bounding box extent
+_BOX_CORNERS = np.array([
+    [1, 1, 1], [1, 1, -1], [1, -1, 1], [1, -1, -1],
+    [-1, 1, 1], [-1, 1, -1], [-1, -1, 1], [-1, -1, -1]], dtype=np.float64)
+
+# Props spawned by SpawnSpeedSign/SpawnCrosswalkSign report an empty bounding box
+DEFAULT_PROP_EXTENT = (0.1, 0.5, 0.5)
+
+def bounding_box_vertices(actor):
+    """Return the (8, 3) world coordinates of an actor's bounding box corners"""
+    bbox = actor.bounding_box
+    extent = np.array([bbox.extent.x, bbox.extent.y, bbox.extent.z])
+    if not extent.any():
+        extent = np.array(DEFAULT_PROP_EXTENT)
+    local = _BOX_CORNERS * extent + np.array([bbox.location.x, bbox.location.y, bbox.location.z])
+    actor_to_world = np.array(actor.get_transform().get_matrix())
+    homogeneous = np.hstack((local, np.ones((8, 1))))
+    return homogeneous.dot(actor_to_world.T)[:, :3]
+
+def project_bounding_boxes(actors, camera_transform, K, width, height, max_distance=100.0):
+    """
+    Project the 3D bounding boxes of several actors to 2D image boxes in one pass.
+
+    :param actors: sequence of carla actors
+    :param camera_transform: carla.Transform of the camera when the frame was taken
+    :return: (M, 4) array of [x1, y1, x2, y2] and (M,) boolean array of visible boxes
+    """
+    boxes = np.zeros((len(actors), 4))
+    if not actors:
+        return boxes, np.zeros(0, dtype=bool)
+    vertices = np.vstack([bounding_box_vertices(actor) for actor in actors])
+    pixels, depth = project_points(vertices, world_to_camera_matrix(camera_transform), K)
+    pixels = pixels.reshape(-1, 8, 2)
+    depth = depth.reshape(-1, 8)
+
+    # Only boxes fully in front of the camera are trusted; clip the rest to the image
+    in_front = (depth > 0.1).all(axis=1) & (depth.min(axis=1) < max_distance)
+    boxes[:, 0] = np.clip(pixels[:, :, 0].min(axis=1), 0, width)
+    boxes[:, 1] = np.clip(pixels[:, :, 1].min(axis=1), 0, height)
+    boxes[:, 2] = np.clip(pixels[:, :, 0].max(axis=1), 0, width)
+    boxes[:, 3] = np.clip(pixels[:, :, 1].max(axis=1), 0, height)
+    visible = in_front & (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+    return boxes, visible
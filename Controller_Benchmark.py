@@ -0,0 +1,287 @@
+"""Benchmarks of the speed controller against synthetic actor populations, without a server.
+
+Runs change_speed, is_red_light_ahead and the vehicles-ahead test of
+Controlling_Automatically on a Synthetic_World.SyntheticWorld, with the legacy
+implementation (every actor asked for its state) and the optimized ones (actor
+table, traffic light index, drivable raster, lane leader index, ego state). For
+each population it reports the time per tick, the calls per tick that would be
+server round trips on a live world, and how often the decisions match the legacy
+ones. change_speed runs twice: with a green light ahead of the ego, so every
+vehicle and walker is looked at, and stopped at a red light (change_speed_red),
+which returns before that. The optimized change_speed times include building the actor table and the
+ego state of the tick, also reported on their own as the table time; the one-off
+map indexes are reported as setup, and warmup ticks before the timed ones fill the
+waypoint caches.
+
+Example:
+    python Controller_Benchmark.py --sizes 10,100,1000,10000 --ticks 10
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from Actor_Snapshot import VEHICLE, ActorSnapshotService
+from Controlling_Automatically import actors_ahead, change_speed, is_red_light_ahead, is_something_ahead
+from Drivable_Area import DrivableArea
+from Ego_State import EgoStateProvider
+from Lead_Vehicle import LeadVehicleIndex
+from Synthetic_World import SyntheticWorld
+from Traffic_Light_Index import TrafficLightIndex
+
+
+DESIRED_SPEED = 8.0
+
+
+# ==============================================================================
+# -- Context -------------------------------------------------------------------
+# ==============================================================================
+
+class ControllerContext(object):
+    """The per-map services of the optimized controller, built once per population"""
+
+    def __init__(self, world):
+        self.world = world
+        self.map = world.get_map()
+        self.setup_ms = {}
+        self.snapshots = ActorSnapshotService(world)
+        self.light_index = self._timed('light_index', lambda: TrafficLightIndex(world, self.map))
+        self.drivable = self._timed('drivable_area', lambda: DrivableArea.from_map(self.map, resolution=0.5))
+        self.leads = LeadVehicleIndex(self.map)
+        self.ego = EgoStateProvider(world.ego, world, imu=False, gnss=False)
+        self.physics = {}
+        self.table = None
+        self.ego_state = None
+        self.update_seconds = 0.0
+
+    def _timed(self, name, build):
+        start = time.perf_counter()
+        value = build()
+        self.setup_ms[name] = 1000.0 * (time.perf_counter() - start)
+        return value
+
+    def update(self, world_snapshot):
+        """Actor table and ego state of the tick, as World.tick builds them"""
+        start = time.perf_counter()
+        self.table = self.snapshots.update(world_snapshot)
+        self.ego_state = self.ego.update(world_snapshot, self.table)
+        self.update_seconds += time.perf_counter() - start
+
+
+# ==============================================================================
+# -- Cases ---------------------------------------------------------------------
+# ==============================================================================
+
+def _legacy_change_speed(world, context, snapshot):
+    change_speed(world, False, context.map, world.ego, DESIRED_SPEED, 0.0)
+    return world.ego.command
+
+def _snapshot_change_speed(world, context, snapshot):
+    context.update(snapshot)
+    change_speed(world, False, context.map, world.ego, DESIRED_SPEED, 0.0, snapshot=context.table)
+    return world.ego.command
+
+def _indexed_change_speed(world, context, snapshot):
+    context.update(snapshot)
+    change_speed(world, False, context.map, world.ego, DESIRED_SPEED, 0.0, snapshot=context.table,
+                 light_index=context.light_index, drivable=context.drivable, leads=context.leads,
+                 ego=context.ego_state, physics=context.physics)
+    return world.ego.command
+
+def _legacy_red_light(world, context, snapshot):
+    return is_red_light_ahead(world.ego, world, context.map)
+
+def _snapshot_red_light(world, context, snapshot):
+    return is_red_light_ahead(world.ego, world, context.map, snapshot=context.table)
+
+def _indexed_red_light(world, context, snapshot):
+    return is_red_light_ahead(world.ego, world, context.map, snapshot=context.table,
+                              light_index=context.light_index, ego=context.ego_state)
+
+def _legacy_vehicles_ahead(world, context, snapshot):
+    ego = world.ego
+    ahead = []
+    for vehicle in world.get_actors().filter('*vehicle*'):
+        if vehicle.id != ego.id:
+            infront, distance = is_something_ahead(ego, vehicle)
+            if infront and distance < 10.0:
+                ahead.append(vehicle.id)
+    return sorted(ahead)
+
+def _grid_vehicles_ahead(world, context, snapshot):
+    table = context.table
+    rows, _ = actors_ahead(table, table.row(world.ego.id), VEHICLE, max_distance=10.0)
+    return sorted(table.ids[rows].tolist())
+
+def _lane_leader(world, context, snapshot):
+    table = context.table
+    lead = context.leads.leader(table, table.row(world.ego.id))
+    return int(table.ids[lead[0]]) if lead is not None and lead[0] is not None else None
+
+_CHANGE_SPEED = [
+    ('legacy', False, True, _legacy_change_speed),
+    ('snapshot', False, True, _snapshot_change_speed),
+    ('indexed', False, True, _indexed_change_speed),
+]
+
+# function -> [(implementation, prepare the actor table before timing, comparable with
+# the legacy decisions, run)], legacy first
+CASES = {
+    'change_speed': _CHANGE_SPEED,
+    'change_speed_red': _CHANGE_SPEED,
+    'is_red_light_ahead': [
+        ('legacy', False, True, _legacy_red_light),
+        ('snapshot', True, True, _snapshot_red_light),
+        ('light_index', True, True, _indexed_red_light),
+    ],
+    'vehicles_ahead': [
+        ('legacy', False, True, _legacy_vehicles_ahead),
+        ('grid', True, True, _grid_vehicles_ahead),
+        # The lane leader only, not every vehicle of the cone
+        ('lane_leader', True, False, _lane_leader),
+    ],
+}
+
+# Functions run with a red light ahead of the ego, the others with a green one
+RED_LIGHT = {'change_speed_red', 'is_red_light_ahead'}
+
+
+# ==============================================================================
+# -- Measurements --------------------------------------------------------------
+# ==============================================================================
+
+def run_case(world, context, prepare, function, ticks, warmup=0):
+    """
+    Run one implementation for warmup + ticks ticks from the initial state of the
+    world, timing the last ticks.
+
+    :return: (ms per tick, ms per tick spent building the actor table and ego state
+             inside the timed calls, calls per tick, Counter of the calls, decisions per tick)
+    """
+    world.reset()
+    context.physics.clear()
+    for _ in range(warmup):
+        snapshot = world.wait_for_tick()
+        if prepare:
+            context.update(snapshot)
+        function(world, context, snapshot)
+    elapsed = 0.0
+    updating = 0.0
+    calls = 0
+    counted = None
+    decisions = []
+    for _ in range(ticks):
+        snapshot = world.wait_for_tick()
+        if prepare:
+            context.update(snapshot)
+        world.reset_calls()
+        context.update_seconds = 0.0
+        start = time.perf_counter()
+        decisions.append(function(world, context, snapshot))
+        elapsed += time.perf_counter() - start
+        updating += context.update_seconds
+        calls += sum(world.calls.values())
+        counted = counted + world.calls if counted is not None else world.calls.copy()
+    return 1000.0 * elapsed / ticks, 1000.0 * updating / ticks, calls / float(ticks), counted, decisions
+
+def benchmark_population(vehicles, walkers, lights, ticks, warmup=5, seed=0):
+    """
+    :return: dict with the population, the setup times and, per function and
+             implementation, ms_per_tick, table_ms_per_tick, calls_per_tick, top calls and the
+             agreement with the legacy decisions (None when not comparable)
+    """
+    world = SyntheticWorld(vehicles, walkers, lights, seed=seed)
+    context = ControllerContext(world)
+    results = {'vehicles': vehicles, 'walkers': walkers, 'lights': lights,
+               'setup_ms': context.setup_ms, 'functions': {}}
+    for function_name, implementations in CASES.items():
+        rows = {}
+        reference = None
+        world.set_red_light(function_name in RED_LIGHT)
+        for name, prepare, comparable, function in implementations:
+            ms, update_ms, calls, counted, decisions = run_case(world, context, prepare, function, ticks, warmup)
+            if reference is None:
+                reference = decisions
+            rows[name] = {
+                'ms_per_tick': ms,
+                'table_ms_per_tick': update_ms,
+                'calls_per_tick': calls,
+                'top_calls': {key: value / float(ticks) for key, value in counted.most_common(3)},
+                'agreement': float(np.mean([a == b for a, b in zip(decisions, reference)])) if comparable else None,
+            }
+        results['functions'][function_name] = rows
+    return results
+
+
+# ==============================================================================
+# -- main() --------------------------------------------------------------------
+# ==============================================================================
+
+def print_population(results):
+    print('%d vehicles, %d walkers, %d lights (setup: %s)' % (
+        results['vehicles'], results['walkers'], results['lights'],
+        ', '.join('%s %.0f ms' % item for item in sorted(results['setup_ms'].items()))))
+    for function_name, rows in results['functions'].items():
+        for name, metrics in rows.items():
+            agreement = metrics['agreement']
+            print('  %-18s %-12s %9.3f ms/tick (table %7.3f) %9.1f calls/tick  agree %4s  %s' % (
+                function_name, name, metrics['ms_per_tick'], metrics['table_ms_per_tick'], metrics['calls_per_tick'],
+                '%.2f' % agreement if agreement is not None else '-',
+                ' '.join('%s=%.0f' % item for item in metrics['top_calls'].items())))
+
+def main():
+    """Main method"""
+
+    argparser = argparse.ArgumentParser(description='Speed controller benchmarks on synthetic worlds')
+    argparser.add_argument(
+        '--sizes',
+        default='10,100,1000,10000',
+        help='Comma separated vehicle counts (default: %(default)s)')
+    argparser.add_argument(
+        '--walkers',
+        default=0.5,
+        type=float,
+        help='Walkers per vehicle (default: 0.5)')
+    argparser.add_argument(
+        '--lights',
+        default=0.05,
+        type=float,
+        help='Traffic lights per vehicle, at least one (default: 0.05)')
+    argparser.add_argument(
+        '--ticks',
+        default=10,
+        type=int,
+        help='Timed ticks per implementation (default: 10)')
+    argparser.add_argument(
+        '--warmup',
+        default=5,
+        type=int,
+        help='Untimed ticks before the timed ones (default: 5)')
+    argparser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        help='Population seed (default: 0)')
+    argparser.add_argument(
+        '--json',
+        metavar='PATH',
+        help='Also write the results to a json file')
+    args = argparser.parse_args()
+
+    all_results = []
+    for vehicles in [int(x) for x in args.sizes.split(',')]:
+        results = benchmark_population(vehicles, int(vehicles * args.walkers), max(1, int(vehicles * args.lights)),
+                                       args.ticks, args.warmup, args.seed)
+        print_population(results)
+        all_results.append(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(all_results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -34,6 +34,17 @@ import carla
 from math import radians, cos, sin, degrees, acos, sqrt
 import time
 
+import numpy as np
+
+from Actor_Snapshot import PITCH, TRAFFIC_LIGHT, VEHICLE, VX, VZ, WALKER, YAW
+
+# set_target_velocity as a batch command, ApplyVelocity before CARLA 0.9.11
+_APPLY_VELOCITY = getattr(carla.command, 'ApplyTargetVelocity', None) or carla.command.ApplyVelocity
+
+# Bumper to bumper gap under which the lane leader sets the speed: the 10 m center
+# distance of the cone test between two mid-size cars
+FOLLOW_GAP = 5.5
+
 # Changing the speed of the vehicle automatically based on the distance to the target
 # This is a simple example of how to control the speed of a vehicle automatically based on the distance to the target
 def target_velocity(yaw, pitch, speed, desired_speed):
@@ -61,23 +72,251 @@ def target_velocity(yaw, pitch, speed, desired_speed):
 
 
 
+class SpeedGovernor(object):
+    """
+    Throttle / brake speed control with hysteresis, one per controlled vehicle.
+
+    The target speed ramps towards the desired speed (accel / decel in m/s^2) and a PI
+    loop follows it. The mode only changes when the speed leaves a deadband around
+    the target, and a control is only sent on a mode change or when the throttle or
+    brake moved by more than min_change, so a cruising vehicle gets no command at
+    all. Physics stays on: holding is a full brake, not a frozen actor.
+    """
+
+    CRUISE = 'cruise'
+    SLOWING = 'slowing'
+    HOLDING = 'holding'
+    RESUMING = 'resuming'
+
+    def __init__(self, accel=1.5, decel=3.0, kp=0.25, ki=0.1, kb=0.3, deadband=0.5, hold_speed=0.3,
+                 resume_speed=1.0, min_change=0.05, hold_brake=1.0, max_integral=0.6):
+        """
+        :param deadband: speed error (m/s) tolerated before slowing or counting as resumed
+        :param hold_speed: below this speed a stop request becomes holding
+        :param resume_speed: holding ends when the desired speed gets above this
+        """
+        self.accel = accel
+        self.decel = decel
+        self.kp = kp
+        self.ki = ki
+        self.kb = kb
+        self.deadband = deadband
+        self.hold_speed = hold_speed
+        self.resume_speed = resume_speed
+        self.min_change = min_change
+        self.hold_brake = hold_brake
+        self.max_integral = max_integral
+        self.reset()
+
+    def reset(self):
+        self.mode = SpeedGovernor.CRUISE
+        self.target = None
+        self.control = None
+        self.updates = 0
+        self.sent = 0
+        self.transitions = 0
+        self._integral = 0.0
+        self._timestamp = None
+
+    def _next_mode(self, desired_speed, speed):
+        if self.mode == SpeedGovernor.HOLDING:
+            return SpeedGovernor.RESUMING if desired_speed >= self.resume_speed else SpeedGovernor.HOLDING
+        if desired_speed < self.hold_speed and speed < self.hold_speed:
+            return SpeedGovernor.HOLDING
+        if speed > desired_speed + self.deadband:
+            return SpeedGovernor.SLOWING
+        if self.mode == SpeedGovernor.SLOWING and speed > desired_speed + 0.5 * self.deadband:
+            return SpeedGovernor.SLOWING
+        if self.mode == SpeedGovernor.RESUMING and speed < desired_speed - self.deadband:
+            return SpeedGovernor.RESUMING
+        return SpeedGovernor.CRUISE
+
+    def update(self, desired_speed, speed, timestamp):
+        """
+        :param desired_speed, speed: m/s
+        :param timestamp: simulation time in seconds
+        :return: (throttle, brake) to send, or None when the last control still holds
+        """
+        dt = timestamp - self._timestamp if self._timestamp is not None else 0.0
+        self._timestamp = timestamp
+        self.updates += 1
+        if self.target is None:
+            self.target = speed
+        if desired_speed > self.target:
+            self.target = min(desired_speed, self.target + self.accel * dt)
+        else:
+            self.target = max(desired_speed, self.target - self.decel * dt)
+
+        mode = self._next_mode(desired_speed, speed)
+        if mode == SpeedGovernor.HOLDING:
+            self._integral = 0.0
+            control = (0.0, self.hold_brake)
+        else:
+            error = self.target - speed
+            self._integral = min(max(self._integral + self.ki * error * dt, 0.0), self.max_integral)
+            throttle = min(max(self.kp * error + self._integral, 0.0), 1.0)
+            brake = min(self.kb * -error, 1.0) if error < -self.deadband else 0.0
+            control = (0.0, brake) if brake > 0.0 else (throttle, 0.0)
+
+        changed = mode != self.mode
+        if changed:
+            self.transitions += 1
+            self.mode = mode
+        if (not changed and self.control is not None
+                and abs(control[0] - self.control[0]) <= self.min_change
+                and abs(control[1] - self.control[1]) <= self.min_change):
+            return None
+        self.control = control
+        self.sent += 1
+        return control
+
+
 # Change speed of the Vehicle
-def change_speed(world, some_state, map, vechicle, desired_speed, last_stop_time):
+def change_speed(world, some_state, map, vechicle, desired_speed, last_stop_time, snapshot=None,
+                 light_index=None, drivable=None, governor=None, leads=None, ego=None, physics=None):
     """
     Change the speed of the vehicle based on the distance to the target
     :param vechicle: The vehicle to control
     :param desired_speed: The desired speed of the vehicle
+    :param snapshot: Actor_Snapshot.ActorTable of the tick; without it every actor is queried
+    :param light_index: Traffic_Light_Index.TrafficLightIndex of the map
+    :param drivable: Drivable_Area.DrivableArea (or DrivingLaneCache) of the map, used
+                     with the snapshot to tell walkers on the road
+    :param governor: SpeedGovernor of the vehicle; drives with throttle and brake instead
+                     of target velocities and frozen physics
+    :param leads: Lead_Vehicle.LeadVehicleIndex of the map, used with the snapshot to
+                  follow only the vehicle ahead in the ego lane
+    :param ego: Ego_State.EgoState of the tick, instead of asking the vehicle
+    :param physics: dict of the simulate_physics state set by the earlier calls, per
+                    vehicle id, kept up to date; set_simulate_physics is then only
+                    called when the vehicle switches between braking and driving
+    """
+    desired_speed, new_velocity = speed_command(world, some_state, map, vechicle, desired_speed, snapshot,
+                                                light_index, drivable, leads, ego)
+    if governor is None:
+        if physics is None:
+            apply_speed_command(vechicle, desired_speed, new_velocity)
+        else:
+            physics[vechicle.id] = apply_speed_command(vechicle, desired_speed, new_velocity,
+                                                       physics.get(vechicle.id))
+        return last_stop_time
+
+    speed = snapshot.speed(vechicle.id) if snapshot is not None else None
+    if speed is None and ego is not None:
+        speed = ego.speed
+    if speed is None:
+        velocity = vechicle.get_velocity()
+        speed = (velocity.x**2 + velocity.y**2 + velocity.z**2)**0.5
+    if snapshot is not None:
+        timestamp = snapshot.timestamp
+    else:
+        timestamp = ego.timestamp if ego is not None else time.time()
+    control = governor.update(desired_speed, speed, timestamp)
+    if control is not None:
+        if governor.sent == 1 and (physics is None or physics.get(vechicle.id) is not True):
+            # The target velocity mode may have left the physics off
+            vechicle.set_simulate_physics(True)
+            if physics is not None:
+                physics[vechicle.id] = True
+        vechicle.apply_control(carla.VehicleControl(throttle=control[0], brake=control[1],
+                                                    steer=vechicle.get_control().steer))
+    return last_stop_time
+
+def speed_command(world, some_state, map, vechicle, desired_speed, snapshot=None, light_index=None,
+                  drivable=None, leads=None, ego=None):
+    """
+    The speed decision of change_speed, without sending anything to the vehicle
+    :return: (desired_speed, new_velocity); a desired speed of 0 means brake, a new
+             velocity of None keeps the current one
     """
-    # Get the current velocity of the vehicle
-    velocity = vechicle.get_velocity()
-    transform = vechicle.get_transform()
-    yaw = radians(transform.rotation.yaw)
-    pitch = radians(transform.rotation.pitch)
-    traffic_light_state = str(vechicle.get_traffic_light_state())
+    ego_row = snapshot.row(vechicle.id) if snapshot is not None else None
+    if ego_row is not None:
+        speed = snapshot.speed(vechicle.id)
+        yaw = radians(snapshot.data[ego_row, YAW])
+        pitch = radians(snapshot.data[ego_row, PITCH])
+    elif ego is not None:
+        yaw = radians(ego.rotation.yaw)
+        pitch = radians(ego.rotation.pitch)
+        speed = ego.speed
+    else:
+        # Get the current velocity of the vehicle
+        velocity = vechicle.get_velocity()
+        transform = vechicle.get_transform()
+        yaw = radians(transform.rotation.yaw)
+        pitch = radians(transform.rotation.pitch)
+        speed = (velocity.x**2 + velocity.y**2 + velocity.z**2)**0.5
+    traffic_light_state = str(ego.light_state if ego is not None else vechicle.get_traffic_light_state())
     current_time = time.time()
-    if some_state or ((traffic_light_state == "Red" or traffic_light_state == "Yellow") and (is_red_light_ahead(vechicle, world, map))):
+    if some_state or ((traffic_light_state == "Red" or traffic_light_state == "Yellow") and (is_red_light_ahead(vechicle, world, map, snapshot=snapshot, light_index=light_index, ego=ego))):
         desired_speed = 0
 
+    if ego_row is not None:
+        if desired_speed != 0:
+            desired_speed = obstacle_speed(snapshot, ego_row, map, desired_speed, drivable, leads)
+    else:
+        desired_speed = _obstacle_speed_by_actor(world, map, vechicle, desired_speed,
+                                                 ego.transform if ego is not None else None)
+
+    # Calculate the new velocity based on the desired speed
+    return desired_speed, target_velocity(yaw, pitch, speed, desired_speed)
+
+def apply_speed_command(vechicle, desired_speed, new_velocity, physics=None):
+    """
+    Send a speed_command decision to the vehicle, one call at a time
+    :param physics: simulate_physics the vehicle currently has, if known;
+                    set_simulate_physics is then only called when it changes
+    :return: simulate_physics of the vehicle after the call, None if unknown
+    """
+    # Set the new velocity of the vehicle
+    if desired_speed == 0:
+        if physics is not False:
+            vechicle.set_simulate_physics(False)
+        vechicle.apply_control(carla.VehicleControl(throttle=0.0, brake=1.0, steer = 0))
+        return False
+    elif new_velocity is not None:
+        if physics is not True:
+            vechicle.set_simulate_physics(True)
+        vechicle.set_target_velocity(new_velocity)
+        return True
+    return physics
+
+def speed_batch_commands(vechicle_id, desired_speed, new_velocity, physics=None):
+    """
+    The calls of apply_speed_command as carla.command objects, for client.apply_batch
+    :param physics: simulate_physics the vehicle currently has, if known;
+                    SetSimulatePhysics is then only sent when it changes
+    :return: list of commands, possibly empty
+    """
+    commands = []
+    if desired_speed == 0:
+        if physics is not False:
+            commands.append(carla.command.SetSimulatePhysics(vechicle_id, False))
+        commands.append(carla.command.ApplyVehicleControl(
+            vechicle_id, carla.VehicleControl(throttle=0.0, brake=1.0, steer=0)))
+    elif new_velocity is not None:
+        if physics is not True:
+            commands.append(carla.command.SetSimulatePhysics(vechicle_id, True))
+        commands.append(_APPLY_VELOCITY(vechicle_id, new_velocity))
+    return commands
+
+def governor_batch_commands(vechicle_id, control, physics=None):
+    """
+    Commands of a SpeedGovernor.update output, for client.apply_batch
+    :param physics: simulate_physics the vehicle currently has, if known
+    """
+    if control is None:
+        return []
+    commands = []
+    if physics is not True:
+        commands.append(carla.command.SetSimulatePhysics(vechicle_id, True))
+    commands.append(carla.command.ApplyVehicleControl(
+        vechicle_id, carla.VehicleControl(throttle=control[0], brake=control[1], steer=0)))
+    return commands
+
+def _obstacle_speed_by_actor(world, map, vechicle, desired_speed, ego_transform=None):
+    """Desired speed after the vehicles and walkers ahead, asking every actor"""
+    if ego_transform is None:
+        ego_transform = vechicle.get_transform()
     vehicle_list = world.get_actors().filter("*vehicle*")
     person_list = world.get_actors().filter("*walker*")
     distance = 100
@@ -85,7 +324,7 @@ def change_speed(world, some_state, map, vechicle, desired_speed, last_stop_time
         if desired_speed == 0:
             break
         if v.id != vechicle.id:
-            infront, dist = is_something_ahead(vechicle, v)
+            infront, dist = is_something_ahead(vechicle, v, ego_transform=ego_transform)
             if infront and dist < 10.0 and dist < distance:
                 velo = v.get_velocity()
                 desired_speed = (velo.x**2 + velo.y**2 + velo.z**2)**0.5
@@ -93,35 +332,66 @@ def change_speed(world, some_state, map, vechicle, desired_speed, last_stop_time
     for p in person_list:
         if desired_speed == 0:
             break
-        infront, dist = is_something_ahead(vechicle, p, max_angle=20)
+        infront, dist = is_something_ahead(vechicle, p, max_angle=20, ego_transform=ego_transform)
 
         if infront and dist < 10.0:
             waypoint = p.get_transform().location
             waypoint = map.get_waypoint(waypoint, project_to_road=False)
             if waypoint.lane_type == carla.LaneType.Driving:
                 desired_speed = 0
-                
+    return desired_speed
 
-    # Get the current speed of the vehicle
-    speed = (velocity.x**2 + velocity.y**2 + velocity.z**2)**0.5
+def obstacle_speed(snapshot, ego_row, map, desired_speed, drivable=None, leads=None):
+    """
+    Desired speed after the vehicles and walkers ahead, from the actor table.
+    Same rules as _obstacle_speed_by_actor: follow the closest vehicle ahead within
+    10 m, stop for a walker on a driving lane within 10 m and 20 degrees.
+    With drivable, all the walkers ahead are tested in one query instead of one
+    map.get_waypoint each. With leads, the vehicle followed is the leader in the ego
+    lane within FOLLOW_GAP, not any vehicle in the cone; off a lane the cone is used.
+    """
+    lead = leads.leader(snapshot, ego_row) if leads is not None else None
+    if lead is not None:
+        row, gap, _ = lead
+        if row is not None and gap < FOLLOW_GAP:
+            desired_speed = float(np.sqrt(np.dot(snapshot.data[row, VX:VZ + 1], snapshot.data[row, VX:VZ + 1])))
+    else:
+        rows, distances = actors_ahead(snapshot, ego_row, VEHICLE, max_distance=10.0)
+        close = distances < 10.0
+        if close.any():
+            # Results are sorted by distance
+            closest = rows[close][0]
+            desired_speed = float(np.sqrt(np.dot(snapshot.data[closest, VX:VZ + 1],
+                                                 snapshot.data[closest, VX:VZ + 1])))
+
+    rows, distances = actors_ahead(snapshot, ego_row, WALKER, max_distance=10.0, max_angle=20)
+    rows = rows[distances < 10.0]
+    if drivable is not None:
+        return 0 if drivable.contains(snapshot.locations[rows]).any() else desired_speed
+    for row in rows:
+        x, y, z = snapshot.locations[row].tolist()
+        waypoint = map.get_waypoint(carla.Location(x=x, y=y, z=z), project_to_road=False)
+        if waypoint is not None and waypoint.lane_type == carla.LaneType.Driving:
+            return 0
+    return desired_speed
+
+def actors_ahead(snapshot, ego_row, kind, max_distance=20, max_angle=90):
+    """
+    is_something_ahead for the actors of a kind near the ego, with the proximity grid
+    of the tick.
 
-    # Calculate the new velocity based on the desired speed
-    new_velocity = target_velocity(yaw, pitch, speed, desired_speed)
-    
-    # Set the new velocity of the vehicle
-    if desired_speed == 0:
-        vechicle.set_simulate_physics(False)
-        vechicle.apply_control(carla.VehicleControl(throttle=0.0, brake=1.0, steer = 0))
-    elif new_velocity is not None:
-        vechicle.set_simulate_physics(True)
-        vechicle.set_target_velocity(new_velocity)
-    return last_stop_time
+    :return: rows of the actors ahead and their distances, closest first
+    """
+    return snapshot.grid.query(snapshot.locations[ego_row], max_distance, snapshot.forward(ego_row),
+                               max_angle, rows=snapshot.mask(kind), exclude=ego_row)
 
 # Check if the vehicle is a head
-def is_something_ahead(ego_vehicle, target, max_distance=20,  max_angle=90):
+def is_something_ahead(ego_vehicle, target, max_distance=20,  max_angle=90, ego_transform=None):
 
     target_location = target.get_transform().location
-    ego_transform = ego_vehicle.get_transform()
+    # The ego transform is the same for every target of a tick, callers can read it once
+    if ego_transform is None:
+        ego_transform = ego_vehicle.get_transform()
     ego_location = ego_transform.location
     ego_forward = ego_transform.get_forward_vector()
 
@@ -160,13 +430,35 @@ def is_pedestrian_ahead(egro_vechile, pedestrainLocation, max_distance, angle ):
 
 
 # Check the red light ahead infornt
-def is_red_light_ahead(hero, world, map, max_distance=45.0, min_distance = 20, angle_threshold=25.0):
+def is_red_light_ahead(hero, world, map, max_distance=45.0, min_distance = 20, angle_threshold=25.0, snapshot=None,
+                       light_index=None, ego=None):
     """
     Checks if there's a red traffic light in front of the vehicle.
     - max_distance: how far ahead to check (in meters)
     - angle_threshold: how narrow the forward cone is (degrees)
+    - snapshot: Actor_Snapshot.ActorTable of the tick, saves the traffic light sweep
+    - light_index: Traffic_Light_Index.TrafficLightIndex; only the light governing the
+      lane ahead is checked, along the lane instead of in a cone
+    - ego: Ego_State.EgoState of the tick, instead of asking the hero for its pose
     """
-    ego_transform = hero.get_transform()
+    ego_row = snapshot.row(hero.id) if snapshot is not None else None
+    if light_index is not None:
+        if ego_row is not None:
+            x, y, z = snapshot.locations[ego_row].tolist()
+            location = carla.Location(x=x, y=y, z=z)
+        else:
+            location = ego.location if ego is not None else hero.get_location()
+        light, _ = light_index.next_light(map.get_waypoint(location), max_distance)
+        return light is not None and light.state in (carla.TrafficLightState.Red, carla.TrafficLightState.Yellow)
+    if ego_row is not None:
+        yaw = radians(snapshot.data[ego_row, YAW])
+        lights, _ = snapshot.grid.query(snapshot.locations[ego_row], max_distance, (cos(yaw), sin(yaw)),
+                                        angle_threshold, rows=snapshot.mask(TRAFFIC_LIGHT), planar=True)
+        states = snapshot.light_states[lights]
+        return bool(np.any((states == int(carla.TrafficLightState.Red)) |
+                           (states == int(carla.TrafficLightState.Yellow))))
+
+    ego_transform = ego.transform if ego is not None else hero.get_transform()
     ego_location = ego_transform.location
     ego_forward = ego_transform.get_forward_vector()
 
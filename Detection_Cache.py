@@ -0,0 +1,267 @@
+"""On-disk cache of raw detections and an offline replay of the post-processing.
+
+Detections are stored before any confidence threshold, one directory per run, in
+columnar .npz chunks: a frame table (frame id, timestamp, offsets) and a detection
+table (boxes, confidences, class ids). Replaying a run re-applies the threshold, the
+AOI heuristic and the game loop speed decisions with array math only.
+
+Example:
+    python Detection_Cache.py --run-id town02_01 --conf 0.6,0.75,0.85
+"""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+
+from Detection_Postprocess import (AOI, AOI_MIN_OVERLAP, CLOSE_MIN_HEIGHT, CLOSE_MIN_WIDTH,
+                                   CONF_THRESHOLD, SignResponse, pedestrian_stop_mask)
+
+
+DEFAULT_CACHE_DIR = 'detection_cache'
+
+
+# ==============================================================================
+# -- Writer --------------------------------------------------------------------
+# ==============================================================================
+
+class DetectionCacheWriter(object):
+    """Class to append raw detections of a run to the cache"""
+
+    def __init__(self, run_id, directory=DEFAULT_CACHE_DIR, flush_every=2000):
+        """
+        :param run_id: name of the run, one sub directory per run
+        :param flush_every: frames kept in memory before a chunk is written
+        """
+        self.run_id = run_id
+        self.path = os.path.join(directory, run_id)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.flush_every = flush_every
+        self._classes = {}
+        parts = sorted(glob.glob(os.path.join(self.path, 'part-*.npz')))
+        self._part = len(parts)
+        if parts:
+            # Appending to an existing run: the readers take the class table of the
+            # last chunk, so keep extending the one already written
+            with np.load(parts[-1]) as chunk:
+                self._classes = {label: index for index, label in enumerate(chunk['classes'].tolist())}
+        self._reset()
+
+    def _reset(self):
+        self._frame_ids = []
+        self._timestamps = []
+        self._boxes = []
+        self._confs = []
+        self._class_ids = []
+        self._gt_boxes = []
+        self._gt_class_ids = []
+        self._gt_ids = []
+
+    def _class_id(self, label):
+        if label not in self._classes:
+            self._classes[label] = len(self._classes)
+        return self._classes[label]
+
+    def add(self, frame_id, timestamp, boxes, confs, labels, gt=None):
+        """
+        Add the raw detections of one frame.
+
+        :param gt: optional (boxes, labels, ids) ground truth of the frame
+        """
+        self._frame_ids.append(frame_id)
+        self._timestamps.append(timestamp)
+        self._boxes.append(np.asarray(boxes, dtype=np.float32).reshape(-1, 4))
+        self._confs.append(np.asarray(confs, dtype=np.float32).reshape(-1))
+        self._class_ids.append(np.array([self._class_id(l) for l in labels], dtype=np.int16))
+        if gt is None:
+            gt = (np.zeros((0, 4)), [], [])
+        self._gt_boxes.append(np.asarray(gt[0], dtype=np.float32).reshape(-1, 4))
+        self._gt_class_ids.append(np.array([self._class_id(l) for l in gt[1]], dtype=np.int16))
+        self._gt_ids.append(np.asarray(gt[2], dtype=np.int64).reshape(-1))
+        if len(self._frame_ids) >= self.flush_every:
+            self.flush()
+
+    def sink(self, image, boxes, confs, labels):
+        """Adapter for the sink argument of DetectingObject.parse_image"""
+        self.add(image.frame, image.timestamp, boxes, confs, labels)
+
+    def flush(self):
+        """Write the frames kept in memory as a new chunk"""
+        if not self._frame_ids:
+            return
+        counts = np.array([len(c) for c in self._confs], dtype=np.int64)
+        gt_counts = np.array([len(i) for i in self._gt_ids], dtype=np.int64)
+        classes = sorted(self._classes, key=self._classes.get)
+        np.savez_compressed(
+            os.path.join(self.path, 'part-%05d.npz' % self._part),
+            frame_id=np.array(self._frame_ids, dtype=np.int64),
+            timestamp=np.array(self._timestamps, dtype=np.float64),
+            det_offset=np.concatenate(([0], np.cumsum(counts))),
+            box=np.concatenate(self._boxes),
+            conf=np.concatenate(self._confs),
+            class_id=np.concatenate(self._class_ids),
+            gt_offset=np.concatenate(([0], np.cumsum(gt_counts))),
+            gt_box=np.concatenate(self._gt_boxes),
+            gt_class_id=np.concatenate(self._gt_class_ids),
+            gt_id=np.concatenate(self._gt_ids),
+            classes=np.array(classes, dtype=str))
+        self._part += 1
+        self._reset()
+
+    def close(self):
+        self.flush()
+
+
+# ==============================================================================
+# -- Reader --------------------------------------------------------------------
+# ==============================================================================
+
+class DetectionCache(object):
+    """Class to load a cached run as flat columns"""
+
+    def __init__(self, run_id, directory=DEFAULT_CACHE_DIR):
+        parts = sorted(glob.glob(os.path.join(directory, run_id, 'part-*.npz')))
+        if not parts:
+            raise IOError('no cached detections for run %r in %s' % (run_id, directory))
+        columns = {}
+        det_base = 0
+        gt_base = 0
+        for path in parts:
+            with np.load(path) as chunk:
+                for name in chunk.files:
+                    if name == 'classes':
+                        self.classes = chunk['classes'].tolist()
+                        continue
+                    values = chunk[name]
+                    if name == 'det_offset':
+                        values = values[:-1] + det_base
+                        det_base += len(chunk['conf'])
+                    elif name == 'gt_offset':
+                        values = values[:-1] + gt_base
+                        gt_base += len(chunk['gt_id'])
+                    columns.setdefault(name, []).append(values)
+        for name, values in columns.items():
+            setattr(self, name, np.concatenate(values))
+        self.det_offset = np.append(self.det_offset, det_base)
+        self.gt_offset = np.append(self.gt_offset, gt_base)
+        # Frame index of every detection, for per-frame reductions
+        self.det_frame = np.repeat(np.arange(len(self.frame_id)), np.diff(self.det_offset))
+
+    def __len__(self):
+        return len(self.frame_id)
+
+    def labels(self, class_ids):
+        return [self.classes[i] for i in class_ids]
+
+    def frame(self, index):
+        """Return (boxes, confs, labels) of one frame"""
+        start, end = self.det_offset[index], self.det_offset[index + 1]
+        return self.box[start:end], self.conf[start:end], self.labels(self.class_id[start:end])
+
+    def ground_truth(self, index):
+        """Return (boxes, labels, ids) of one frame"""
+        start, end = self.gt_offset[index], self.gt_offset[index + 1]
+        return self.gt_box[start:end], self.labels(self.gt_class_id[start:end]), self.gt_id[start:end]
+
+
+# ==============================================================================
+# -- Replay --------------------------------------------------------------------
+# ==============================================================================
+
+def replay(cache, conf_threshold=CONF_THRESHOLD, aoi=AOI, min_overlap=AOI_MIN_OVERLAP,
+           min_height=CLOSE_MIN_HEIGHT, min_width=CLOSE_MIN_WIDTH):
+    """
+    Re-run the post-processing and the speed decisions of a cached run.
+
+    :return: dict with per-frame arrays 'state', 'stop' and 'desired_speed'
+    """
+    num_frames = len(cache)
+    keep = cache.conf >= conf_threshold
+
+    # Pedestrian stop state per frame, from one vectorized AOI test over the whole run
+    pedestrian = cache.classes.index('pedestrian') if 'pedestrian' in cache.classes else -1
+    stop = keep & (cache.class_id == pedestrian)
+    stop[stop] = pedestrian_stop_mask(cache.box[stop], aoi, min_overlap, min_height, min_width)
+    state = np.bincount(cache.det_frame[stop], minlength=num_frames) > 0
+
+    # Labels present per frame, as a (frames, classes) table
+    present = np.zeros((num_frames, len(cache.classes)), dtype=bool)
+    present[cache.det_frame[keep], cache.class_id[keep]] = True
+
+    response = SignResponse(cache.timestamp[0] if num_frames else 0.0)
+    desired_speed = np.zeros(num_frames)
+    some_state = np.zeros(num_frames, dtype=bool)
+    classes = np.array(cache.classes, dtype=object)
+    for index in range(num_frames):
+        labels = set(classes[present[index]])
+        some_state[index], desired_speed[index] = response.update(
+            cache.timestamp[index], state[index], labels)
+    return {'state': state, 'stop': some_state, 'desired_speed': desired_speed}
+
+def replay_summary(cache, decisions):
+    """Summarize the decisions of a replay: stop time and time spent per target speed"""
+    dt = np.diff(cache.timestamp, append=cache.timestamp[-1])
+    speeds = np.round(decisions['desired_speed'] * 3.6).astype(int)
+    changes = int(np.count_nonzero(np.diff(speeds)))
+    return {
+        'frames': len(cache),
+        'pedestrian_frames': int(decisions['state'].sum()),
+        'stop_seconds': float(dt[decisions['stop']].sum()),
+        'speed_changes': changes,
+        'seconds_per_speed': {int(s): float(dt[speeds == s].sum()) for s in np.unique(speeds)},
+    }
+
+
+# ==============================================================================
+# -- main() --------------------------------------------------------------------
+# ==============================================================================
+
+def main():
+    """Main method"""
+
+    argparser = argparse.ArgumentParser(
+        description='Replay cached detections with different post-processing parameters')
+    argparser.add_argument(
+        '--run-id',
+        required=True,
+        help='Name of the cached run')
+    argparser.add_argument(
+        '--cache-dir',
+        default=DEFAULT_CACHE_DIR,
+        help='Cache directory (default: %(default)s)')
+    argparser.add_argument(
+        '--conf',
+        default=str(CONF_THRESHOLD),
+        help='Comma separated confidence thresholds to sweep (default: %(default)s)')
+    argparser.add_argument(
+        '--aoi',
+        metavar='LEFT,TOP,RIGHT,BOTTOM',
+        default=','.join(str(v) for v in AOI),
+        help='Area of interest for pedestrians (default: %(default)s)')
+    argparser.add_argument(
+        '--close',
+        metavar='HEIGHT,WIDTH',
+        default='%d,%d' % (CLOSE_MIN_HEIGHT, CLOSE_MIN_WIDTH),
+        help='Minimum box height or width of a close pedestrian (default: %(default)s)')
+    args = argparser.parse_args()
+
+    start = time.time()
+    cache = DetectionCache(args.run_id, args.cache_dir)
+    aoi = tuple(int(v) for v in args.aoi.split(','))
+    min_height, min_width = [int(v) for v in args.close.split(',')]
+    print('loaded %d frames in %.2f s' % (len(cache), time.time() - start))
+
+    for conf in [float(v) for v in args.conf.split(',')]:
+        start = time.time()
+        decisions = replay(cache, conf, aoi, min_height=min_height, min_width=min_width)
+        summary = replay_summary(cache, decisions)
+        print('conf >= %.2f (%.3f s): %s' % (conf, time.time() - start, summary))
+
+
+if __name__ == '__main__':
+    main()
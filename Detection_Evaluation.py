@@ -0,0 +1,281 @@
+"""Streaming evaluation of the object detector against projected ground truth boxes."""
+
+import json
+import fnmatch
+
+import numpy as np
+
+from Camera_Projection import build_projection_matrix, project_bounding_boxes
+
+
+# Blueprint patterns of the actors we spawn, and the detector class they should produce
+GROUND_TRUTH_CLASSES = [
+    ('walker.pedestrian.*', 'pedestrian'),
+    ('static.prop.crosswalk', 'crosswalk-blue'),
+    ('static.prop.speed30', 'speed-30'),
+    ('static.prop.speed60', 'speed-60'),
+]
+
+# Upper edges (seconds) of the latency-to-first-detection histogram bins
+LATENCY_BINS = np.array([0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, np.inf])
+
+
+# ==============================================================================
+# -- Matching ------------------------------------------------------------------
+# ==============================================================================
+
+def box_iou(boxes_a, boxes_b):
+    """
+    Pairwise IoU between two sets of boxes.
+
+    :param boxes_a: (N, 4) array of [x1, y1, x2, y2]
+    :param boxes_b: (M, 4) array of [x1, y1, x2, y2]
+    :return: (N, M) IoU matrix
+    """
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    left = np.maximum(a[:, None, 0], b[None, :, 0])
+    top = np.maximum(a[:, None, 1], b[None, :, 1])
+    right = np.minimum(a[:, None, 2], b[None, :, 2])
+    bottom = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+def match_detections(det_boxes, det_confs, gt_boxes, iou_threshold=0.5):
+    """
+    Greedy one-to-one matching of detections to ground truth, highest confidence first.
+
+    Because detections are visited in descending confidence, the matches of every
+    prefix are exactly the matches obtained with a higher confidence threshold, so a
+    single pass answers all thresholds at once.
+
+    :return: indices sorting the detections by descending confidence, and for each of
+             them the index of the matched ground truth box (-1 if unmatched)
+    """
+    order = np.argsort(-np.asarray(det_confs), kind='stable')
+    matched_gt = np.full(len(order), -1, dtype=np.int64)
+    if len(order) == 0 or len(gt_boxes) == 0:
+        return order, matched_gt
+
+    iou = box_iou(np.asarray(det_boxes)[order], gt_boxes)
+    iou[iou < iou_threshold] = 0.0
+    for rank in np.flatnonzero(iou.any(axis=1)):
+        best = int(np.argmax(iou[rank]))
+        if iou[rank, best] > 0:
+            matched_gt[rank] = best
+            iou[:, best] = 0.0
+    return order, matched_gt
+
+
+# ==============================================================================
+# -- Ground Truth --------------------------------------------------------------
+# ==============================================================================
+
+class GroundTruthProjector(object):
+    """Class to project the bounding boxes of relevant actors into a camera frame"""
+
+    def __init__(self, world, width, height, fov, classes=GROUND_TRUTH_CLASSES, max_distance=60.0):
+        self._world = world
+        self._classes = classes
+        self.width = width
+        self.height = height
+        self.max_distance = max_distance
+        self.K = build_projection_matrix(width, height, fov)
+        self._actors = []
+        self._labels = []
+        self._ids = None
+
+    def refresh(self, ids=None):
+        """
+        Re-read the actor list, needed after actors spawn or despawn
+
+        :param ids: ids of every actor of the world, as found in the world snapshot
+        """
+        self._ids = ids
+        self._actors = []
+        self._labels = []
+        for actor in self._world.get_actors():
+            for pattern, label in self._classes:
+                if fnmatch.fnmatch(actor.type_id, pattern):
+                    self._actors.append(actor)
+                    self._labels.append(label)
+                    break
+
+    def project(self, camera_transform, world_snapshot=None):
+        """
+        :param camera_transform: carla.Transform of the camera, e.g. image.transform
+        :param world_snapshot: carla.WorldSnapshot of the frame, defaults to the last
+                               one received by the client
+        :return: (M, 4) boxes, (M,) labels and (M,) actor ids of the visible ground truth
+        """
+        if world_snapshot is None:
+            world_snapshot = self._world.get_snapshot()
+        # The actor list is only read again when actors spawned or despawned
+        ids = frozenset(actor.id for actor in world_snapshot)
+        if ids != self._ids:
+            self.refresh(ids)
+        boxes, visible = project_bounding_boxes(
+            self._actors, camera_transform, self.K, self.width, self.height, self.max_distance)
+        labels = np.array(self._labels, dtype=object)
+        ids = np.array([actor.id for actor in self._actors], dtype=np.int64)
+        return boxes[visible], labels[visible], ids[visible]
+
+
+# ==============================================================================
+# -- Evaluator -----------------------------------------------------------------
+# ==============================================================================
+
+class _ClassStats(object):
+    """Running counters of one class, one slot per confidence threshold"""
+
+    def __init__(self, num_thresholds):
+        self.tp = np.zeros(num_thresholds, dtype=np.int64)
+        self.fp = np.zeros(num_thresholds, dtype=np.int64)
+        self.fn = np.zeros(num_thresholds, dtype=np.int64)
+        self.objects_seen = 0
+        self.objects_detected = np.zeros(num_thresholds, dtype=np.int64)
+        self.latency_sum = np.zeros(num_thresholds)
+        self.latency_max = np.zeros(num_thresholds)
+        self.latency_hist = np.zeros((num_thresholds, len(LATENCY_BINS)), dtype=np.int64)
+
+
+class DetectionEvaluator(object):
+    """
+    Class to stream precision, recall and latency-to-first-detection per class.
+
+    Memory does not grow with the run length: only counters and the objects that are
+    currently in view are kept.
+    """
+
+    def __init__(self, conf_thresholds=(0.75,), iou_threshold=0.5, classes=None, forget_after=2.0):
+        """
+        :param conf_thresholds: confidence thresholds evaluated side by side
+        :param iou_threshold: minimum IoU for a detection to count as a match
+        :param classes: labels to evaluate, None evaluates every label seen
+        :param forget_after: seconds out of view after which an object is dropped
+        """
+        self.conf_thresholds = np.sort(np.asarray(conf_thresholds, dtype=np.float64))
+        self.iou_threshold = iou_threshold
+        self.classes = set(classes) if classes is not None else None
+        self.forget_after = forget_after
+        self.frames = 0
+        self._stats = {}
+        # actor id -> [label, first seen, last seen, detected per threshold]
+        self._tracked = {}
+
+    def _class_stats(self, label):
+        if label not in self._stats:
+            self._stats[label] = _ClassStats(len(self.conf_thresholds))
+        return self._stats[label]
+
+    def update(self, timestamp, det_boxes, det_labels, det_confs, gt_boxes, gt_labels, gt_ids):
+        """
+        Add one frame.
+
+        :param timestamp: frame time in seconds (e.g. image.timestamp)
+        :param det_boxes: (N, 4) raw detections, before any confidence threshold
+        :param gt_boxes: (M, 4) ground truth boxes with their labels and actor ids
+        """
+        self.frames += 1
+        det_boxes = np.asarray(det_boxes, dtype=np.float64).reshape(-1, 4)
+        det_labels = np.asarray(det_labels, dtype=object)
+        det_confs = np.asarray(det_confs, dtype=np.float64)
+        gt_boxes = np.asarray(gt_boxes, dtype=np.float64).reshape(-1, 4)
+        gt_labels = np.asarray(gt_labels, dtype=object)
+        gt_ids = np.asarray(gt_ids)
+
+        labels = set(det_labels.tolist()) | set(gt_labels.tolist())
+        if self.classes is not None:
+            labels &= self.classes
+
+        for label in labels:
+            det_mask = det_labels == label
+            gt_mask = gt_labels == label
+            confs = det_confs[det_mask]
+            order, matched_gt = match_detections(
+                det_boxes[det_mask], confs, gt_boxes[gt_mask], self.iou_threshold)
+            sorted_confs = confs[order]
+
+            # Number of detections kept by each threshold (confidences sorted descending)
+            kept = np.searchsorted(-sorted_confs, -self.conf_thresholds, side='right')
+            tp_prefix = np.concatenate(([0], np.cumsum(matched_gt >= 0)))
+            stats = self._class_stats(label)
+            tp = tp_prefix[kept]
+            stats.tp += tp
+            stats.fp += kept - tp
+            stats.fn += gt_mask.sum() - tp
+
+            # Best confidence each visible object was matched with this frame
+            ids = gt_ids[gt_mask]
+            best_conf = np.full(len(ids), -np.inf)
+            hit = matched_gt >= 0
+            best_conf[matched_gt[hit]] = sorted_confs[hit]
+            self._update_latency(timestamp, label, stats, ids, best_conf)
+
+        self._forget(timestamp)
+
+    def _update_latency(self, timestamp, label, stats, ids, best_conf):
+        for actor_id, conf in zip(ids.tolist(), best_conf):
+            track = self._tracked.get(actor_id)
+            if track is None:
+                track = [label, timestamp, timestamp, np.zeros(len(self.conf_thresholds), dtype=bool)]
+                self._tracked[actor_id] = track
+                stats.objects_seen += 1
+            track[2] = timestamp
+            newly = (conf >= self.conf_thresholds) & ~track[3]
+            if newly.any():
+                latency = timestamp - track[1]
+                track[3] |= newly
+                stats.objects_detected += newly
+                stats.latency_sum[newly] += latency
+                stats.latency_max[newly] = np.maximum(stats.latency_max[newly], latency)
+                stats.latency_hist[newly, np.searchsorted(LATENCY_BINS, latency)] += 1
+
+    def _forget(self, timestamp):
+        stale = [actor_id for actor_id, track in self._tracked.items()
+                 if timestamp - track[2] > self.forget_after]
+        for actor_id in stale:
+            del self._tracked[actor_id]
+
+    def summary(self):
+        """Return the metrics per confidence threshold and per class"""
+        result = {'frames': self.frames, 'iou_threshold': self.iou_threshold, 'thresholds': {}}
+        for index, threshold in enumerate(self.conf_thresholds):
+            per_class = {}
+            for label, stats in sorted(self._stats.items()):
+                tp, fp, fn = int(stats.tp[index]), int(stats.fp[index]), int(stats.fn[index])
+                detected = int(stats.objects_detected[index])
+                per_class[label] = {
+                    'tp': tp,
+                    'fp': fp,
+                    'fn': fn,
+                    'precision': tp / (tp + fp) if tp + fp else None,
+                    'recall': tp / (tp + fn) if tp + fn else None,
+                    'objects_seen': stats.objects_seen,
+                    'objects_detected': detected,
+                    'mean_latency': stats.latency_sum[index] / detected if detected else None,
+                    'max_latency': float(stats.latency_max[index]) if detected else None,
+                    'latency_histogram': dict(zip([str(edge) for edge in LATENCY_BINS],
+                                                  stats.latency_hist[index].tolist())),
+                }
+            result['thresholds']['%.2f' % threshold] = per_class
+        return result
+
+    def save(self, path):
+        """Write the summary to a json file"""
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def print_summary(self):
+        for threshold, per_class in self.summary()['thresholds'].items():
+            print('conf >= %s' % threshold)
+            for label, m in per_class.items():
+                print('  %-16s P=%s R=%s first detection=%s s (%d/%d objects)' % (
+                    label,
+                    '%.2f' % m['precision'] if m['precision'] is not None else '-',
+                    '%.2f' % m['recall'] if m['recall'] is not None else '-',
+                    '%.2f' % m['mean_latency'] if m['mean_latency'] is not None else '-',
+                    m['objects_detected'], m['objects_seen']))
@@ -0,0 +1,129 @@
+"""Post-processing of raw detections and the sign/pedestrian speed decisions.
+
+Kept free of the model, pygame and carla so cached detections can be replayed offline.
+"""
+
+import numpy as np
+
+
+# Minimum confidence for a detection to drive the vehicle behaviour
+CONF_THRESHOLD = 0.75
+
+# Define Area of Interest (AOI) in image coordinates
+AOI_LEFT = 250
+AOI_RIGHT = 550
+AOI_TOP = 300
+AOI_BOTTOM = 600
+AOI = (AOI_LEFT, AOI_TOP, AOI_RIGHT, AOI_BOTTOM)
+
+# Fraction of a pedestrian box that has to lie inside the AOI
+AOI_MIN_OVERLAP = 0.3
+
+# Heuristic: a pedestrian is close if its box is tall or wide enough
+CLOSE_MIN_HEIGHT = 180
+CLOSE_MIN_WIDTH = 50
+
+# Default cruise speed of the game loop (m/s)
+CRUISE_SPEED = 8.16
+
+
+# ---------- 1. Pedestrian AOI Check ----------
+def pedestrian_stop_mask(boxes, aoi=AOI, min_overlap=AOI_MIN_OVERLAP,
+                         min_height=CLOSE_MIN_HEIGHT, min_width=CLOSE_MIN_WIDTH):
+    """
+    Check, for every box at once, if it lies in the AOI and is close enough to stop for.
+
+    :param boxes: (N, 4) array of [x1, y1, x2, y2]
+    :return: (N,) boolean array
+    """
+    boxes = np.asarray(boxes).reshape(-1, 4).astype(np.int64)
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    left, top, right, bottom = aoi
+
+    # Check if bounding box intersects with AOI
+    inter_width = np.clip(np.minimum(x2, right) - np.maximum(x1, left), 0, None)
+    inter_height = np.clip(np.minimum(y2, bottom) - np.maximum(y1, top), 0, None)
+    intersection_area = inter_width * inter_height
+
+    # Total area of bounding box
+    bbox_width = x2 - x1
+    bbox_height = y2 - y1
+    bbox_area = bbox_width * bbox_height
+    in_aoi = (bbox_area != 0) & (intersection_area >= min_overlap * bbox_area)
+
+    close_enough = (bbox_height >= min_height) | (bbox_width >= min_width)
+    return in_aoi & close_enough
+
+# ---------- 2. Threshold and Stop State ----------
+def filter_detections(boxes, confs, labels, conf_threshold=CONF_THRESHOLD, **aoi_params):
+    """
+    Apply the confidence threshold and the pedestrian AOI heuristic to raw detections.
+
+    :param aoi_params: overrides for pedestrian_stop_mask (aoi, min_overlap, ...)
+    :return: pedestrian stop state, kept labels and kept confidences
+    """
+    confs = np.asarray(confs, dtype=np.float64)
+    keep = confs >= conf_threshold
+    kept_labels = [label for label, k in zip(labels, keep) if k]
+    kept_confs = confs[keep].tolist()
+    pedestrians = keep & (np.asarray(labels, dtype=object) == "pedestrian")
+    state = bool(pedestrians.any() and pedestrian_stop_mask(
+        np.asarray(boxes)[pedestrians], **aoi_params).any())
+    return state, kept_labels, kept_confs
+
+
+# ==============================================================================
+# -- Sign Response -------------------------------------------------------------
+# ==============================================================================
+
+class SignResponse(object):
+    """
+    Class holding the speed decisions the game loop takes from detected signs and pedestrians.
+
+    Time is whatever clock the caller uses: wall clock when driving, frame timestamps
+    when replaying cached detections.
+    """
+
+    def __init__(self, now, desired_speed=CRUISE_SPEED):
+        self.desired_speed = desired_speed
+        self.state_time = now - 86400
+        self.vechicle_speed_state = now - 86400
+
+    def update(self, current_time, state, labels):
+        """
+        :param state: pedestrian stop state of the frame
+        :param labels: labels kept after thresholding
+        :return: (some_state, desired_speed), some_state means stop for a pedestrian
+        """
+        if state:
+            self.state_time = current_time
+
+        some_state = False
+
+#        Changing the desired speed based on Sign Detected
+        if labels is None:
+            pass
+        elif current_time - self.state_time < 10.0 and "crosswalk-blue" in labels:
+            some_state = True
+            self.desired_speed = 0
+
+        elif current_time - self.state_time < 2.0:
+            some_state = True
+            self.desired_speed = 0
+
+        elif "crosswalk-red" in labels:
+            self.desired_speed = 15/3.6
+            self.vechicle_speed_state = current_time - 25
+
+        elif "crosswalk-blue" in labels:
+            self.desired_speed = 10/3.6
+            self.vechicle_speed_state = current_time - 30
+        elif "speed-30" in labels:
+            self.desired_speed = 20/3.6
+            self.vechicle_speed_state = current_time
+        elif "speed-60" in labels:
+            self.desired_speed = 30/3.6
+            self.vechicle_speed_state = current_time
+        elif current_time - self.vechicle_speed_state >= 40:
+            self.desired_speed = CRUISE_SPEED
+        return some_state, self.desired_speed
@@ -1,26 +1,24 @@
+import time
+
 import numpy as np
 import cv2
 import pygame
+from Lane_Detection import (roi_mask, crop_to_roi, offset_lines, as_bgr_frame, classify_segments,
+                            fit_lane_model, make_lane_result, segments_residual)
 
-def detect_edges(img):
-    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+def detect_edges(img, code=cv2.COLOR_RGB2GRAY):
+    gray = cv2.cvtColor(img, code)
     blur = cv2.GaussianBlur(gray, (5, 5), 0)
     edges = cv2.Canny(blur, 70, 150)  # Tweak these if needed
     return edges
 
-def region_of_interest(img):
-    height, width = img.shape
-    mask = np.zeros_like(img)
-
-    polygon = np.array([[
-        (int(width * 0.2), height),
-        (int(width * 0.8), height),
-        (int(width * 0.6), int(height * 0.58)),
-        (int(width * 0.4), int(height * 0.58))
-    ]], np.int32)
+ROI_POLYGON = ((0.2, 1.0), (0.8, 1.0), (0.6, 0.58), (0.4, 0.58))
 
-    cv2.fillPoly(mask, polygon, 255)
-    return cv2.bitwise_and(img, mask)
+def region_of_interest(img):
+    (x0, y0, x1, y1), mask = roi_mask(img.shape, ROI_POLYGON)
+    result = np.zeros_like(img)
+    result[y0:y1, x0:x1] = cv2.bitwise_and(img[y0:y1, x0:x1], mask)
+    return result
 
 def detect_lines(img):
     lines = cv2.HoughLinesP(
@@ -37,18 +35,16 @@ def filter_lane_lines(lines, img_height):
     if lines is None:
         return []
 
-    filtered = []
-    for line in lines:
-        x1, y1, x2, y2 = line[0]
-        angle = np.degrees(np.arctan2(y2 - y1, x2 - x1))
-        length = np.hypot(x2 - x1, y2 - y1)
-
-        # Conditions to keep good lane lines:
-        if 25 < abs(angle) < 75 and length > 40:
-            # Skip lines too close to the bottom (arrows)
-            if y1 < img_height - 50 and y2 < img_height - 50:
-                filtered.append(line)
-    return filtered
+    # Conditions to keep good lane lines: 25 < |angle| < 75 and length > 40,
+    # skipping lines too close to the bottom (arrows)
+    segments = lines.reshape(-1, 4)
+    dx = segments[:, 2] - segments[:, 0]
+    dy = segments[:, 3] - segments[:, 1]
+    angle = np.abs(np.degrees(np.arctan2(dy, dx)))
+    length = np.hypot(dx, dy)
+    keep = (angle > 25) & (angle < 75) & (length > 40)
+    keep &= (segments[:, 1] < img_height - 50) & (segments[:, 3] < img_height - 50)
+    return lines[keep]
 
 
 def draw_lines(img, lines, color=(0, 255, 0), thickness=4):
@@ -60,13 +56,46 @@ def draw_lines(img, lines, color=(0, 255, 0), thickness=4):
     return cv2.addWeighted(img, 0.8, line_img, 1, 1)
 
 def detect_lanes_pipeline(rgb_image):
-    edges = detect_edges(rgb_image)
-    cropped_edges = region_of_interest(edges)
-    raw_lines = detect_lines(cropped_edges)
+    # Edges are only computed on the bounding rectangle of the ROI
+    crop, mask, origin = crop_to_roi(rgb_image, ROI_POLYGON)
+    cropped_edges = cv2.bitwise_and(detect_edges(crop), mask)
+    raw_lines = offset_lines(detect_lines(cropped_edges), origin)
     good_lines = filter_lane_lines(raw_lines, rgb_image.shape[0])
     lane_image = draw_lines(rgb_image, good_lines)
     return lane_image
 
+def detect_lanes(img, collector=None):
+    """
+    Headless angle filtered Hough detection of one frame.
+
+    :param img: HxWx3 BGR or HxWx4 BGRA image (or a carla.Image)
+    :param collector: optional Lane_Profiling.StageCollector
+    :return: LaneResult, the confidence is the fraction of both lanes found
+    """
+    img = as_bgr_frame(img)
+    height, width = img.shape[:2]
+    start = time.perf_counter()
+    crop, mask, origin = crop_to_roi(img, ROI_POLYGON)
+    cropped_edges = cv2.bitwise_and(detect_edges(crop, cv2.COLOR_BGR2GRAY), mask)
+    preprocessed = time.perf_counter()
+    raw_lines = offset_lines(detect_lines(cropped_edges), origin)
+    hough = time.perf_counter()
+    good_lines = filter_lane_lines(raw_lines, height) if raw_lines is not None else None
+    # The angle filter already bounds the slope, only the left/right split is left
+    segments, left_mask, right_mask = classify_segments(good_lines, min_slope=0.0)
+    left = fit_lane_model(segments[left_mask])
+    right = fit_lane_model(segments[right_mask])
+    confidence = 0.5 * ((left is not None) + (right is not None))
+    fitted = time.perf_counter()
+    timings = {'preprocess': preprocessed - start, 'hough': hough - preprocessed, 'fit': fitted - hough}
+    if collector is not None:
+        collector.record('canny', timings['preprocess'], pixels=cropped_edges.size,
+                         edge_pixels=cv2.countNonZero(cropped_edges))
+        collector.record('hough', timings['hough'], segments=0 if raw_lines is None else len(raw_lines))
+        collector.record('fit', timings['fit'], lane_segments=int(left_mask.sum() + right_mask.sum()),
+                         residual=segments_residual(((left, segments[left_mask]), (right, segments[right_mask]))))
+    return make_lane_result(left, right, height, width, confidence, timings)
+
 
 def process_image_lane(image):
     # Convert to RGB NumPy array
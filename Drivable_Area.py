@@ -0,0 +1,155 @@
+"""Is this point on a driving lane? For many points at once, without map queries.
+
+DrivableArea rasterizes the driving lanes of a map once: every waypoint of
+map.generate_waypoints() stamps a lane_width wide rectangle along its lane into a
+uint8 raster. A query is then an array lookup for all points together. Other lane
+types (sidewalks) are not generated by the map and are reached sideways from the
+driving lanes. Maps too large for a raster at the requested resolution fall back to
+DrivingLaneCache, map.get_waypoint(project_to_road=False) answers cached by
+quantized location.
+
+Example:
+    drivable = DrivableArea.from_map(world.get_map())
+    on_road = drivable.contains(walker_locations)
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+
+
+class DrivableArea(object):
+    """
+    Class holding a raster of the driving lanes of a map.
+
+    raster[row, col] is 1 on a driving lane, row = (y - origin_y) / resolution and
+    col = (x - origin_x) / resolution.
+    """
+
+    def __init__(self, raster, origin, resolution):
+        self.raster = raster
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.resolution = float(resolution)
+
+    @classmethod
+    def from_map(cls, world_map, resolution=0.25, step=1.0, margin=5.0, max_cells=64 * 1024 * 1024,
+                 lane_type=None):
+        """
+        :param resolution: raster cell size in meters
+        :param step: waypoint spacing of the rasterization, in meters
+        :param max_cells: larger maps get a DrivingLaneCache instead
+        :param lane_type: lane type to rasterize, defaults to carla.LaneType.Driving
+        :return: DrivableArea, or DrivingLaneCache when the raster would be too large
+        """
+        if lane_type is None:
+            import carla
+            lane_type = carla.LaneType.Driving
+        generated = world_map.generate_waypoints(step)
+        waypoints = [w for w in generated if w.lane_type == lane_type]
+        if not waypoints:
+            # generate_waypoints only returns driving lanes
+            waypoints = _lanes_right_of(generated, lane_type)
+        if not waypoints:
+            return DrivingLaneCache(world_map, lane_type=lane_type)
+        centers = np.array([(w.transform.location.x, w.transform.location.y) for w in waypoints])
+        yaws = np.radians([w.transform.rotation.yaw for w in waypoints])
+        half_widths = 0.5 * np.array([w.lane_width for w in waypoints])
+
+        origin = centers.min(axis=0) - margin
+        size = np.ceil((centers.max(axis=0) + margin - origin) / resolution).astype(int)
+        if size[0] * size[1] > max_cells:
+            return DrivingLaneCache(world_map, lane_type=lane_type)
+        raster = np.zeros((size[1], size[0]), dtype=np.uint8)
+
+        # Rectangle of every waypoint: half a step (plus overlap) along the lane, half
+        # the lane width across it
+        forward = np.stack((np.cos(yaws), np.sin(yaws)), axis=1) * (0.5 * step + resolution)
+        right = np.stack((-np.sin(yaws), np.cos(yaws)), axis=1) * half_widths[:, None]
+        corners = np.stack((centers - forward - right, centers + forward - right,
+                            centers + forward + right, centers - forward + right), axis=1)
+        corners = np.rint((corners - origin) / resolution).astype(np.int32)
+        for polygon in corners:
+            cv2.fillConvexPoly(raster, polygon, 1)
+        return cls(raster, origin, resolution)
+
+    def contains(self, points):
+        """
+        :param points: (N, 2) or (N, 3) world positions
+        :return: (N,) bool, True on a driving lane
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if points.ndim == 1:
+            points = points[None, :]
+        cells = np.floor((points[:, :2] - self.origin) / self.resolution).astype(np.int64)
+        height, width = self.raster.shape
+        inside = (cells[:, 0] >= 0) & (cells[:, 0] < width) & (cells[:, 1] >= 0) & (cells[:, 1] < height)
+        result = np.zeros(len(points), dtype=bool)
+        result[inside] = self.raster[cells[inside, 1], cells[inside, 0]] != 0
+        return result
+
+
+def _lanes_right_of(waypoints, lane_type, max_lanes=8):
+    """
+    The first lane of lane_type right of each waypoint, e.g. the sidewalks next to
+    the driving lanes, one waypoint per location
+    """
+    found = {}
+    for waypoint in waypoints:
+        for _ in range(max_lanes):
+            waypoint = waypoint.get_right_lane()
+            if waypoint is None:
+                break
+            if waypoint.lane_type == lane_type:
+                location = waypoint.transform.location
+                found[(round(location.x, 1), round(location.y, 1))] = waypoint
+                break
+    return list(found.values())
+
+
+class DrivingLaneCache(object):
+    """
+    Class caching map.get_waypoint(project_to_road=False) lane type answers by
+    quantized location, least recently used first out.
+
+    Walkers barely move between ticks, so most queries hit the cache.
+    """
+
+    def __init__(self, world_map, quantum=0.5, max_size=4096, lane_type=None):
+        import carla
+        if lane_type is None:
+            lane_type = carla.LaneType.Driving
+        self._location = carla.Location
+        self.map = world_map
+        self.quantum = quantum
+        self.max_size = max_size
+        self.lane_type = lane_type
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _is_driving(self, x, y, z):
+        key = (int(np.floor(x / self.quantum)), int(np.floor(y / self.quantum)))
+        cached = self._cache.get(key)
+        if cached is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return cached
+        self.misses += 1
+        # Ask for the cell center, so every point of the cell shares the answer
+        location = self._location(x=(key[0] + 0.5) * self.quantum, y=(key[1] + 0.5) * self.quantum, z=z)
+        waypoint = self.map.get_waypoint(location, project_to_road=False)
+        cached = waypoint is not None and waypoint.lane_type == self.lane_type
+        self._cache[key] = cached
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return cached
+
+    def contains(self, points):
+        """Same interface as DrivableArea.contains"""
+        points = np.asarray(points, dtype=np.float64)
+        if points.ndim == 1:
+            points = points[None, :]
+        z = points[:, 2] if points.shape[1] > 2 else np.zeros(len(points))
+        return np.array([self._is_driving(x, y, zi) for (x, y), zi in zip(points[:, :2].tolist(), z.tolist())],
+                        dtype=bool)
@@ -0,0 +1,185 @@
+"""One cached state of the ego vehicle per tick, for every consumer.
+
+Within one tick the HUD, change_speed, the agent and the cone tests each asked the
+ego for its velocity, transform, speed limit and light state again. EgoStateProvider
+reads the pose, velocity and acceleration once per tick from the WorldSnapshot that
+wait_for_tick() already returned, gets the IMU and GNSS measurements pushed by
+sensors attached to the ego, and keeps the result as one EgoState. The speed limit
+and light state are read from the vehicle at most once per tick, on first use.
+
+Example:
+    ego = EgoStateProvider(player, world)
+    state = ego.update(world.wait_for_tick())
+    print(state.speed, state.speed_limit, state.compass)
+    ego.destroy()
+"""
+
+import math
+import threading
+import weakref
+
+import carla
+
+from Actor_Snapshot import PITCH, VX, VZ, X, YAW, Z
+
+
+class _Unread(object):
+    """Marker of a field not read from the vehicle yet"""
+
+
+_UNREAD = _Unread()
+
+
+class EgoState(object):
+    """
+    The ego vehicle at one tick.
+
+    transform, velocity, acceleration, angular_velocity: from the WorldSnapshot
+    speed: m/s; accelerometer (m/s^2), gyroscope (rad/s), compass (rad): last IMU
+    measurement; latitude, longitude, altitude: last GNSS measurement (None without
+    the sensor or before its first measurement)
+    """
+
+    def __init__(self, vehicle, frame, timestamp, transform, velocity, acceleration=None,
+                 angular_velocity=None, imu=None, gnss=None):
+        self.vehicle = vehicle
+        self.frame = frame
+        self.timestamp = timestamp
+        self.transform = transform
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.angular_velocity = angular_velocity
+        self.speed = math.sqrt(velocity.x**2 + velocity.y**2 + velocity.z**2)
+        self.accelerometer, self.gyroscope, self.compass = imu or (None, None, None)
+        self.latitude, self.longitude, self.altitude = gnss or (None, None, None)
+        self._speed_limit = _UNREAD
+        self._light_state = _UNREAD
+        self._at_traffic_light = _UNREAD
+
+    @property
+    def location(self):
+        return self.transform.location
+
+    @property
+    def rotation(self):
+        return self.transform.rotation
+
+    @property
+    def speed_limit(self):
+        """Speed limit of the lane in km/h"""
+        if self._speed_limit is _UNREAD:
+            self._speed_limit = self.vehicle.get_speed_limit()
+        return self._speed_limit
+
+    @property
+    def light_state(self):
+        """carla.TrafficLightState of the light affecting the ego"""
+        if self._light_state is _UNREAD:
+            self._light_state = self.vehicle.get_traffic_light_state()
+        return self._light_state
+
+    @property
+    def at_traffic_light(self):
+        if self._at_traffic_light is _UNREAD:
+            self._at_traffic_light = self.vehicle.is_at_traffic_light()
+        return self._at_traffic_light
+
+
+class EgoStateProvider(object):
+    """
+    Class keeping the EgoState of the current tick.
+
+    reads counts the ticks where a WorldSnapshot had to be asked to the server
+    because no WorldSnapshot or ActorTable of the tick was given.
+    """
+
+    def __init__(self, vehicle, world=None, imu=True, gnss=True, sensor_tick=None):
+        """
+        :param world: carla.World to spawn the sensors in, defaults to the vehicle's
+        :param imu, gnss: attach a sensor.other.imu / sensor.other.gnss to the vehicle
+        :param sensor_tick: sensor period in seconds, defaults to every tick
+        """
+        self.vehicle = vehicle
+        self.world = world or vehicle.get_world()
+        self.state = None
+        self.reads = 0
+        self.sensors = []
+        self._lock = threading.Lock()
+        self._imu = None
+        self._gnss = None
+        weak_self = weakref.ref(self)
+        if imu:
+            self._attach('sensor.other.imu', sensor_tick,
+                         lambda measurement: EgoStateProvider._on_imu(weak_self, measurement))
+        if gnss:
+            self._attach('sensor.other.gnss', sensor_tick,
+                         lambda measurement: EgoStateProvider._on_gnss(weak_self, measurement))
+
+    def _attach(self, blueprint_id, sensor_tick, callback):
+        blueprint = self.world.get_blueprint_library().find(blueprint_id)
+        if sensor_tick is not None and blueprint.has_attribute('sensor_tick'):
+            blueprint.set_attribute('sensor_tick', str(sensor_tick))
+        sensor = self.world.spawn_actor(blueprint, carla.Transform(), attach_to=self.vehicle)
+        sensor.listen(callback)
+        self.sensors.append(sensor)
+
+    @staticmethod
+    def _on_imu(weak_self, measurement):
+        self = weak_self()
+        if not self:
+            return
+        with self._lock:
+            self._imu = (measurement.accelerometer, measurement.gyroscope, measurement.compass)
+
+    @staticmethod
+    def _on_gnss(weak_self, measurement):
+        self = weak_self()
+        if not self:
+            return
+        with self._lock:
+            self._gnss = (measurement.latitude, measurement.longitude, measurement.altitude)
+
+    def update(self, world_snapshot=None, table=None):
+        """
+        :param world_snapshot: carla.WorldSnapshot of the tick
+        :param table: Actor_Snapshot.ActorTable of the tick, used without the snapshot
+        :return: EgoState of the tick
+        """
+        with self._lock:
+            imu, gnss = self._imu, self._gnss
+        row = table.row(self.vehicle.id) if table is not None else None
+        if world_snapshot is None and row is None:
+            # The one blocking read of the tick
+            self.reads += 1
+            world_snapshot = self.world.get_snapshot()
+        actor = world_snapshot.find(self.vehicle.id) if world_snapshot is not None else None
+        if actor is not None:
+            self.state = EgoState(self.vehicle, world_snapshot.frame, world_snapshot.timestamp.elapsed_seconds,
+                                  actor.get_transform(), actor.get_velocity(), actor.get_acceleration(),
+                                  actor.get_angular_velocity(), imu, gnss)
+        elif row is not None:
+            x, y, z = table.data[row, X:Z + 1].tolist()
+            yaw, pitch = table.data[row, [YAW, PITCH]].tolist()
+            velocity = carla.Vector3D(*table.data[row, VX:VZ + 1].tolist())
+            self.state = EgoState(self.vehicle, table.frame, table.timestamp,
+                                  carla.Transform(carla.Location(x=x, y=y, z=z), carla.Rotation(pitch=pitch, yaw=yaw)),
+                                  velocity, self._difference(velocity, table.timestamp), None, imu, gnss)
+        else:
+            raise RuntimeError('ego vehicle %d is not in the world snapshot' % self.vehicle.id)
+        return self.state
+
+    def _difference(self, velocity, timestamp):
+        """Acceleration from the velocity of the previous state, None on the first one"""
+        previous = self.state
+        if previous is None or timestamp <= previous.timestamp:
+            return None
+        dt = timestamp - previous.timestamp
+        return carla.Vector3D((velocity.x - previous.velocity.x) / dt, (velocity.y - previous.velocity.y) / dt,
+                              (velocity.z - previous.velocity.z) / dt)
+
+    def destroy(self):
+        """Stop and destroy the sensors"""
+        for sensor in self.sensors:
+            sensor.stop()
+            sensor.destroy()
+        self.sensors = []
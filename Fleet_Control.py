@@ -0,0 +1,217 @@
+"""Speed control of a fleet of vehicles with one batch of commands per tick.
+
+FleetController runs the change_speed decision (Controlling_Automatically.speed_command)
+for every vehicle of the fleet against one shared ActorTable, and sends all the
+resulting commands in a single client.apply_batch / apply_batch_sync call. It also
+remembers the simulate_physics state it set, so SetSimulatePhysics is only sent when
+a vehicle switches between braking and driving.
+
+Example:
+    python Fleet_Control.py --sizes 1,10,30 --ticks 200
+"""
+
+from __future__ import print_function
+
+import glob
+import os
+import sys
+
+try:
+    sys.path.append(glob.glob('../carla/dist/carla-*%d.%d-%s.egg' % (
+        sys.version_info.major,
+        sys.version_info.minor,
+        'win-amd64' if os.name == 'nt' else 'linux-x86_64'))[0])
+except IndexError:
+    pass
+
+import argparse
+import random
+import time
+
+import carla
+
+from Actor_Snapshot import ActorSnapshotService
+from Controlling_Automatically import (SpeedGovernor, governor_batch_commands, speed_batch_commands,
+                                       speed_command)
+from Detection_Postprocess import CRUISE_SPEED, SignResponse
+from Lead_Vehicle import LeadVehicleIndex
+
+
+class FleetVehicle(object):
+    """One controlled vehicle with its own sign response"""
+
+    def __init__(self, actor, now, desired_speed=CRUISE_SPEED, governor=None):
+        self.actor = actor
+        self.response = SignResponse(now, desired_speed)
+        self.governor = governor
+        self.physics = None
+        self.desired_speed = desired_speed
+
+
+class FleetController(object):
+    """
+    Class deciding and sending the speed commands of many vehicles per tick.
+
+    observations of a tick map a vehicle id to its (pedestrian state, labels), the
+    same inputs SignResponse.update takes for the single ego; vehicles without an
+    observation keep their current sign response.
+    """
+
+    def __init__(self, client, world, vehicles, snapshots=None, light_index=None, drivable=None,
+                 synchronous=False, governed=True, leads=None):
+        """
+        :param snapshots: ActorSnapshotService shared with the rest of the client
+        :param leads: Lead_Vehicle.LeadVehicleIndex shared by the fleet, bucketed once per tick
+        :param synchronous: use apply_batch_sync and log the failed commands
+        :param governed: drive every vehicle with a SpeedGovernor, otherwise with the
+                         target velocities of change_speed
+        """
+        self.client = client
+        self.world = world
+        self.map = world.get_map()
+        self.snapshots = snapshots or ActorSnapshotService(world)
+        self.light_index = light_index
+        self.drivable = drivable
+        self.leads = leads
+        self.synchronous = synchronous
+        now = time.time()
+        self.vehicles = [FleetVehicle(vehicle, now, governor=SpeedGovernor() if governed else None)
+                         for vehicle in vehicles]
+        self.ticks = 0
+        self.commands = 0
+        self._decide = 0.0
+        self._send = 0.0
+
+    def tick(self, world_snapshot=None, observations=None, table=None):
+        """
+        :param table: ActorTable already built for this tick, otherwise built from world_snapshot
+        :return: number of commands sent
+        """
+        start = time.perf_counter()
+        if table is None:
+            table = self.snapshots.update(world_snapshot)
+        now = time.time()
+        commands = []
+        for vehicle in self.vehicles:
+            state, labels = (observations or {}).get(vehicle.actor.id, (False, None))
+            some_state, desired_speed = vehicle.response.update(now, state, labels)
+            desired_speed, new_velocity = speed_command(
+                self.world, some_state, self.map, vehicle.actor, desired_speed, table,
+                self.light_index, self.drivable, self.leads)
+            if vehicle.governor is not None:
+                control = vehicle.governor.update(desired_speed, table.speed(vehicle.actor.id) or 0.0,
+                                                  table.timestamp)
+                vehicle_commands = governor_batch_commands(vehicle.actor.id, control, vehicle.physics)
+                if vehicle_commands:
+                    vehicle.physics = True
+            else:
+                vehicle_commands = speed_batch_commands(vehicle.actor.id, desired_speed, new_velocity,
+                                                        vehicle.physics)
+                if vehicle_commands:
+                    vehicle.physics = desired_speed != 0
+            vehicle.desired_speed = desired_speed
+            commands.extend(vehicle_commands)
+        decided = time.perf_counter()
+
+        if commands:
+            if self.synchronous:
+                for response in self.client.apply_batch_sync(commands, False):
+                    if response.error:
+                        print('fleet command failed: %s' % response.error)
+            else:
+                self.client.apply_batch(commands)
+        sent = time.perf_counter()
+
+        self.ticks += 1
+        self.commands += len(commands)
+        self._decide += decided - start
+        self._send += sent - decided
+        return len(commands)
+
+    def stats(self):
+        """Mean time per tick, split in the decisions and the batch call"""
+        ticks = max(self.ticks, 1)
+        return {
+            'vehicles': len(self.vehicles),
+            'ticks': self.ticks,
+            'decide_ms': 1000.0 * self._decide / ticks,
+            'send_ms': 1000.0 * self._send / ticks,
+            'tick_ms': 1000.0 * (self._decide + self._send) / ticks,
+            'commands_per_tick': self.commands / float(ticks),
+            'actor_refreshes': self.snapshots.refreshes,
+        }
+
+
+# ==============================================================================
+# -- main() --------------------------------------------------------------------
+# ==============================================================================
+
+def spawn_fleet(client, world, count, seed=0):
+    """Spawn count vehicles at shuffled spawn points, in one batch"""
+    rng = random.Random(seed)
+    blueprints = [bp for bp in world.get_blueprint_library().filter('vehicle.*')
+                  if int(bp.get_attribute('number_of_wheels')) == 4]
+    spawn_points = world.get_map().get_spawn_points()
+    rng.shuffle(spawn_points)
+    batch = [carla.command.SpawnActor(rng.choice(blueprints), transform)
+             for transform in spawn_points[:count]]
+    ids = [response.actor_id for response in client.apply_batch_sync(batch, True) if not response.error]
+    return list(world.get_actors(ids))
+
+
+def main():
+    """Main method"""
+
+    argparser = argparse.ArgumentParser(description='Per-tick cost of the fleet speed control')
+    argparser.add_argument(
+        '--host',
+        metavar='H',
+        default='127.0.0.1',
+        help='IP of the host server (default: 127.0.0.1)')
+    argparser.add_argument(
+        '-p', '--port',
+        metavar='P',
+        default=2000,
+        type=int,
+        help='TCP port to listen to (default: 2000)')
+    argparser.add_argument(
+        '--sizes',
+        default='1,10,30',
+        help='Comma separated fleet sizes (default: %(default)s)')
+    argparser.add_argument(
+        '--ticks',
+        default=200,
+        type=int,
+        help='Ticks per fleet size (default: 200)')
+    argparser.add_argument(
+        '--no-governor',
+        action='store_true',
+        help='Drive with target velocities instead of the throttle / brake governor')
+    argparser.add_argument(
+        '--sync',
+        action='store_true',
+        help='Send the commands with apply_batch_sync')
+    args = argparser.parse_args()
+
+    client = carla.Client(args.host, args.port)
+    client.set_timeout(10.0)
+    world = client.get_world()
+    snapshots = ActorSnapshotService(world)
+    leads = LeadVehicleIndex(world.get_map())
+    for size in [int(x) for x in args.sizes.split(',')]:
+        vehicles = spawn_fleet(client, world, size)
+        try:
+            fleet = FleetController(client, world, vehicles, snapshots, synchronous=args.sync,
+                                    governed=not args.no_governor, leads=leads)
+            for _ in range(args.ticks):
+                fleet.tick(world.wait_for_tick(10.0))
+            stats = fleet.stats()
+            print('%3d vehicles: %.2f ms/tick (decide %.2f, send %.2f), %.1f commands/tick' % (
+                stats['vehicles'], stats['tick_ms'], stats['decide_ms'], stats['send_ms'],
+                stats['commands_per_tick']))
+        finally:
+            client.apply_batch([carla.command.DestroyActor(vehicle.id) for vehicle in vehicles])
+
+
+if __name__ == '__main__':
+    main()
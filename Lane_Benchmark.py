@@ -0,0 +1,311 @@
+"""Benchmarks of the lane detection stages, runs on a plain CPU without CARLA.
+
+Example:
+    python Lane_Benchmark.py --res 1280x720 --frames 30
+    python Lane_Benchmark.py --suite --res 640x360 --frames 20
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import cv2
+
+import Lane_Detection
+import Lane_DetectionDraft
+import Lane_Strategies
+import Synthetic_Road
+
+
+# ==============================================================================
+# -- Test Frames ---------------------------------------------------------------
+# ==============================================================================
+
+def make_test_frames(width, height, count, seed=0):
+    """Simple BGRA road frames: gray asphalt, two white lane lines and sensor noise"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for index in range(count):
+        frame = np.full((height, width, 4), 70, dtype=np.uint8)
+        shift = int(rng.integers(-width // 20, width // 20))
+        horizon = int(height * 0.62)
+        cv2.line(frame, (int(width * 0.22) + shift, height), (int(width * 0.47), horizon), (255, 255, 255, 255), 10)
+        cv2.line(frame, (int(width * 0.80) + shift, height), (int(width * 0.53), horizon), (255, 255, 255, 255), 10)
+        noise = rng.integers(0, 40, frame.shape, dtype=np.uint8)
+        frames.append(cv2.add(frame, noise))
+    return frames
+
+
+# ==============================================================================
+# -- Measurements --------------------------------------------------------------
+# ==============================================================================
+
+def time_per_frame(function, frames, repeat=3):
+    """Best mean wall time per frame (seconds) over several passes"""
+    function(frames[0])
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for frame in frames:
+            function(frame)
+        best = min(best, (time.perf_counter() - start) / len(frames))
+    return best
+
+def allocated_per_frame(function, frames):
+    """Mean peak of newly allocated bytes per frame, as seen by tracemalloc"""
+    function(frames[0])
+    tracemalloc.start()
+    total = 0
+    for frame in frames:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        function(frame)
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak - before
+    tracemalloc.stop()
+    return total / len(frames)
+
+
+# ==============================================================================
+# -- Preprocessing -------------------------------------------------------------
+# ==============================================================================
+
+def _legacy_region_of_interest(img):
+    """region_of_interest as it was: full frame mask rebuilt on every call"""
+    height, width = img.shape[:2]
+    mask = np.zeros_like(img)
+    polygon = np.array([[
+        (int(width * 0.1), height),
+        (int(width * 0.9), height),
+        (int(width * 0.55), int(height * 0.62)),
+        (int(width * 0.45), int(height * 0.62))
+    ]], dtype=np.int32)
+    cv2.fillPoly(mask, polygon, 255)
+    return cv2.bitwise_and(img, mask)
+
+def legacy_preprocess(frame):
+    """color_filter -> edge_detection -> region_of_interest on the full frame"""
+    bgr = frame[:, :, :3].copy()
+    white = Lane_Detection.color_filter(bgr)
+    edges = Lane_Detection.edge_detection(white)
+    return _legacy_region_of_interest(edges)
+
+def edge_disagreement(frames, preprocessor):
+    """Fraction of legacy edge pixels that the fused stage does not reproduce"""
+    differing = 0
+    total = 0
+    for frame in frames:
+        legacy = legacy_preprocess(frame)
+        edges, (x0, y0) = preprocessor(frame)
+        fused = np.zeros_like(legacy)
+        fused[y0:y0 + edges.shape[0], x0:x0 + edges.shape[1]] = edges
+        differing += np.count_nonzero(legacy != fused)
+        total += np.count_nonzero(legacy)
+    return differing / max(total, 1)
+
+def benchmark_preprocess(frames):
+    preprocessor = Lane_Detection.LanePreprocessor()
+    results = {}
+    for name, function in (('legacy', legacy_preprocess), ('fused', preprocessor)):
+        results[name] = {
+            'ms_per_frame': 1000.0 * time_per_frame(function, frames),
+            'kb_allocated_per_frame': allocated_per_frame(function, frames) / 1024.0,
+        }
+    results['fused']['edge_disagreement'] = edge_disagreement(frames, preprocessor)
+    return results
+
+
+# ==============================================================================
+# -- Lane Fitting --------------------------------------------------------------
+# ==============================================================================
+
+def _legacy_average_lane_lines(img, lines):
+    """average_lane_lines as it was: Python loop over segments and np.polyfit"""
+    left_lines = []
+    right_lines = []
+    if lines is None:
+        return []
+    height, width = img.shape[:2]
+    for line in lines:
+        x1, y1, x2, y2 = line[0]
+        if x2 == x1:
+            continue
+        slope = (y2 - y1) / (x2 - x1)
+        if abs(slope) < 0.5:
+            continue
+        if slope < 0:
+            left_lines.append(line[0])
+        else:
+            right_lines.append(line[0])
+
+    def fit_line(points):
+        if len(points) == 0:
+            return None
+        x_coords = [x1 for x1, y1, x2, y2 in points] + [x2 for x1, y1, x2, y2 in points]
+        y_coords = [y1 for x1, y1, x2, y2 in points] + [y2 for x1, y1, x2, y2 in points]
+        poly = np.polyfit(y_coords, x_coords, deg=1)
+        y1, y2 = height, int(height * 0.6)
+        x1, x2 = int(np.polyval(poly, y1)), int(np.polyval(poly, y2))
+        return [[x1, y1, x2, y2]]
+
+    result_lines = []
+    for fit in (fit_line(left_lines), fit_line(right_lines)):
+        if fit:
+            result_lines.extend(fit)
+    return result_lines
+
+def make_segments(width, height, count, seed=0):
+    """HoughLinesP-like (N, 1, 4) array: two lanes plus random clutter segments"""
+    rng = np.random.default_rng(seed)
+    lanes = np.array([[[int(width * 0.22), height, int(width * 0.47), int(height * 0.62)]],
+                      [[int(width * 0.80), height, int(width * 0.53), int(height * 0.62)]]])
+    clutter = rng.integers(0, min(width, height), (max(count - 2, 0), 1, 4))
+    return np.concatenate((lanes, clutter)).astype(np.int32)
+
+def benchmark_fit(width, height, counts=(10, 100, 1000)):
+    img = np.zeros((height, width, 3), dtype=np.uint8)
+    results = {}
+    for count in counts:
+        lines = make_segments(width, height, count)
+        results['%d segments' % count] = {
+            'legacy_ms': 1000.0 * time_per_frame(lambda l: _legacy_average_lane_lines(img, l), [lines]),
+            'vectorized_ms': 1000.0 * time_per_frame(lambda l: Lane_Detection.average_lane_lines(img, l), [lines]),
+        }
+    return results
+
+
+# ==============================================================================
+# -- Lane Modes ----------------------------------------------------------------
+# ==============================================================================
+
+def benchmark_modes(frames):
+    """Per-frame time of the straight (Hough), curved (sliding window) and pyramid modes, without drawing"""
+    preprocessor = Lane_Detection.LanePreprocessor()
+    finder = Lane_DetectionDraft.SlidingWindowLaneFinder()
+    pyramid = Lane_Detection.PyramidLaneDetector(levels=1)
+    height, width = frames[0].shape[:2]
+
+    def straight(frame):
+        edges, origin = preprocessor(frame)
+        lines = Lane_Detection.offset_lines(Lane_Detection.detect_lines(edges), origin)
+        return Lane_Detection.fit_lanes(lines, height, width)
+
+    return {
+        'straight': {'ms_per_frame': 1000.0 * time_per_frame(straight, frames)},
+        'curved': {'ms_per_frame': 1000.0 * time_per_frame(finder.find, frames)},
+        'pyramid': {'ms_per_frame': 1000.0 * time_per_frame(pyramid.detect, frames)},
+    }
+
+
+# ==============================================================================
+# -- Synthetic Suite -----------------------------------------------------------
+# ==============================================================================
+
+def benchmark_suite(width, height, count, names=None, scenarios=None, seed=0):
+    """
+    Run the lane strategies over every synthetic scenario, against the ground truth.
+
+    :return: dict scenario -> compare_strategies results
+    """
+    results = {}
+    for scenario in scenarios or sorted(Synthetic_Road.SCENARIOS):
+        frames, truths = Synthetic_Road.make_scenario(scenario, width, height, count, seed)
+        reference = [truth.offset_px for truth in truths]
+        results[scenario] = Lane_Strategies.compare_strategies(frames, names, reference)
+    return results
+
+# Scenarios a straight lane model is expected to handle, checked by default
+STRAIGHT_SCENARIOS = sorted(name for name, params in Synthetic_Road.SCENARIOS.items()
+                            if not params.get('curve'))
+
+def check_suite(results, max_error_px, min_detection_rate, names=None, scenarios=None):
+    """List of 'scenario/strategy: problem' strings, empty when everything passes"""
+    failures = []
+    for scenario, strategies in results.items():
+        if scenarios is not None and scenario not in scenarios:
+            continue
+        for name, metrics in strategies.items():
+            if names is not None and name not in names:
+                continue
+            if metrics['detection_rate'] < min_detection_rate:
+                failures.append('%s/%s: detection rate %.2f' % (scenario, name, metrics['detection_rate']))
+            if not metrics['mean_offset_error_px'] <= max_error_px:
+                failures.append('%s/%s: offset error %.1f px' % (scenario, name, metrics['mean_offset_error_px']))
+    return failures
+
+
+# ==============================================================================
+# -- main() --------------------------------------------------------------------
+# ==============================================================================
+
+def print_table(title, results):
+    print(title)
+    for name, metrics in results.items():
+        print('  %-10s %s' % (name, '  '.join(
+            '%s=%.3f' % (key, value) for key, value in metrics.items())))
+
+def main():
+    """Main method"""
+
+    argparser = argparse.ArgumentParser(description='Lane detection benchmarks')
+    argparser.add_argument(
+        '--res',
+        metavar='WIDTHxHEIGHT',
+        default='1280x720',
+        help='Frame resolution (default: 1280x720)')
+    argparser.add_argument(
+        '--frames',
+        default=30,
+        type=int,
+        help='Number of frames (default: 30)')
+    argparser.add_argument(
+        '--suite',
+        action='store_true',
+        help='Run the synthetic road suite instead of the stage benchmarks')
+    argparser.add_argument(
+        '--strategies',
+        default=','.join(Lane_Strategies.strategy_names()),
+        help='Comma separated lane strategies of the suite (default: %(default)s)')
+    argparser.add_argument(
+        '--check',
+        default=Lane_Strategies.DEFAULT_STRATEGY,
+        help='Comma separated strategies whose regressions fail the suite (default: %(default)s)')
+    argparser.add_argument(
+        '--check-scenarios',
+        default=','.join(STRAIGHT_SCENARIOS),
+        help='Comma separated scenarios checked for regressions (default: %(default)s)')
+    argparser.add_argument(
+        '--max-error-px',
+        default=20.0,
+        type=float,
+        help='Maximum mean offset error against the ground truth (default: 20)')
+    argparser.add_argument(
+        '--min-detection',
+        default=0.9,
+        type=float,
+        help='Minimum detection rate (default: 0.9)')
+    args = argparser.parse_args()
+    width, height = [int(x) for x in args.res.split('x')]
+
+    if args.suite:
+        results = benchmark_suite(width, height, args.frames, args.strategies.split(','))
+        for scenario, strategies in results.items():
+            print_table('%s %dx%d' % (scenario, width, height), strategies)
+        failures = check_suite(results, args.max_error_px, args.min_detection,
+                               args.check.split(','), args.check_scenarios.split(','))
+        for failure in failures:
+            print('FAIL %s' % failure)
+        sys.exit(1 if failures else 0)
+
+    frames = make_test_frames(width, height, args.frames)
+    print_table('preprocessing %dx%d' % (width, height), benchmark_preprocess(frames))
+    print_table('lane fitting', benchmark_fit(width, height))
+    print_table('lane modes', benchmark_modes(frames))
+
+
+if __name__ == '__main__':
+    main()
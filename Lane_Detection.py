@@ -1,7 +1,12 @@
+import math
+import time
+
 import numpy as np
 import cv2
 import pygame
 
+from Lane_Profiling import start_timer
+
 # ---------- 1. White Lane Color Filter ----------
 def color_filter(img):
     hls = cv2.cvtColor(img, cv2.COLOR_RGB2HLS)
@@ -18,17 +23,130 @@ def edge_detection(img):
     return edges
 
 # ---------- 3. Region of Interest ----------
-def region_of_interest(img):
-    height, width = img.shape[:2]
-    mask = np.zeros_like(img)
-    polygon = np.array([[
-        (int(width * 0.1), height),
-        (int(width * 0.9), height),
-        (int(width * 0.55), int(height * 0.62)),
-        (int(width * 0.45), int(height * 0.62))
-    ]], dtype=np.int32)
-    cv2.fillPoly(mask, polygon, 255)
-    return cv2.bitwise_and(img, mask)
+# Trapezoid of the road ahead, as (x, y) fractions of the image width and height
+ROI_POLYGON = ((0.1, 1.0), (0.9, 1.0), (0.55, 0.62), (0.45, 0.62))
+
+# (image size, polygon) -> (bounding rectangle, mask cropped to it)
+_ROI_CACHE = {}
+
+def roi_mask(shape, polygon=ROI_POLYGON):
+    """
+    Return the bounding rectangle (x0, y0, x1, y1) of the ROI polygon and its mask
+    cropped to that rectangle. Both only depend on the image size, so they are
+    computed once per (size, polygon) and reused for every frame.
+    """
+    height, width = shape[:2]
+    key = (height, width, polygon)
+    cached = _ROI_CACHE.get(key)
+    if cached is None:
+        points = np.array([[(int(width * fx), int(height * fy)) for fx, fy in polygon]], dtype=np.int32)
+        x0 = max(int(points[0, :, 0].min()), 0)
+        y0 = max(int(points[0, :, 1].min()), 0)
+        x1 = min(int(points[0, :, 0].max()) + 1, width)
+        y1 = min(int(points[0, :, 1].max()) + 1, height)
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv2.fillPoly(mask, points - np.array([x0, y0], dtype=np.int32), 255)
+        mask.setflags(write=False)
+        cached = ((x0, y0, x1, y1), mask)
+        _ROI_CACHE[key] = cached
+    return cached
+
+def crop_to_roi(img, polygon=ROI_POLYGON):
+    """Crop an image to the ROI bounding rectangle, returning the crop, its mask and (x0, y0)"""
+    (x0, y0, x1, y1), mask = roi_mask(img.shape, polygon)
+    return img[y0:y1, x0:x1], mask, (x0, y0)
+
+def region_of_interest(img, polygon=ROI_POLYGON):
+    (x0, y0, x1, y1), mask = roi_mask(img.shape, polygon)
+    result = np.zeros_like(img)
+    crop = img[y0:y1, x0:x1]
+    result[y0:y1, x0:x1] = cv2.bitwise_and(crop, crop, mask=mask)
+    return result
+
+def offset_lines(lines, origin):
+    """Shift Hough segments found in a crop back to full image coordinates"""
+    if lines is None or origin == (0, 0):
+        return lines
+    x0, y0 = origin
+    return lines + np.array([x0, y0, x0, y0], dtype=lines.dtype)
+
+# ---------- 3b. Fused Preprocessing ----------
+class LanePreprocessor(object):
+    """
+    Class turning a BGR/BGRA camera frame into the masked edge map of the ROI.
+
+    It fuses color_filter, edge_detection and region_of_interest: the frame is cropped
+    to the ROI rectangle and every stage writes into buffers that are allocated once
+    and reused (they only grow when a larger crop comes in). The returned edge map is
+    one of those buffers, so it is only valid until the next call; use one
+    preprocessor per thread.
+    """
+
+    def __init__(self, polygon=ROI_POLYGON, canny_low=50, canny_high=150, white_min=200):
+        self.polygon = polygon
+        self.canny_low = canny_low
+        self.canny_high = canny_high
+        self._lower_white = np.array([0, white_min, 0])
+        self._upper_white = np.array([255, 255, 255])
+        self._shape = None
+        self._capacity = 0
+
+    def _allocate(self, crop_shape):
+        height, width = crop_shape[:2]
+        size = height * width
+        if size > self._capacity:
+            self._hls_buffer = np.empty(size * 3, dtype=np.uint8)
+            self._buffers = np.empty((4, size), dtype=np.uint8)
+            self._capacity = size
+        # Leading part of the flat buffers, so the views stay contiguous
+        self._hls = self._hls_buffer[:size * 3].reshape(height, width, 3)
+        self._white, self._gray, self._blur, self._edges = [
+            buffer[:size].reshape(height, width) for buffer in self._buffers]
+        self._shape = crop_shape[:2]
+
+    def __call__(self, frame, collector=None, roi=None):
+        """
+        :param frame: HxWx3 BGR or HxWx4 BGRA image
+        :param collector: optional Lane_Profiling.StageCollector
+        :param roi: optional ((x0, y0, x1, y1), mask) replacing the polygon for this frame
+        :return: edge map of the ROI rectangle and its (x0, y0) in the frame
+        """
+        timer = start_timer(collector)
+        if roi is None:
+            crop, mask, origin = crop_to_roi(frame, self.polygon)
+        else:
+            (x0, y0, x1, y1), mask = roi
+            crop, origin = frame[y0:y1, x0:x1], (x0, y0)
+        if self._shape != crop.shape[:2]:
+            self._allocate(crop.shape)
+        gray_code = cv2.COLOR_BGRA2GRAY if frame.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+        if timer is not None:
+            timer('roi', pixels=self._white.size)
+
+        # White mask from the HLS lightness, then the gray image of the white pixels only
+        cv2.cvtColor(crop, cv2.COLOR_BGR2HLS, dst=self._hls)
+        cv2.inRange(self._hls, self._lower_white, self._upper_white, dst=self._white)
+        if timer is not None:
+            timer('hls', white_pixels=cv2.countNonZero(self._white))
+        cv2.cvtColor(crop, gray_code, dst=self._gray)
+        cv2.bitwise_and(self._gray, self._white, dst=self._gray)
+        if timer is not None:
+            timer('gray')
+
+        cv2.GaussianBlur(self._gray, (5, 5), 0, dst=self._blur)
+        cv2.Canny(self._blur, self.canny_low, self.canny_high, edges=self._edges)
+        cv2.bitwise_and(self._edges, mask, dst=self._edges)
+        if timer is not None:
+            timer('canny', edge_pixels=cv2.countNonZero(self._edges))
+        return self._edges, origin
+
+_preprocessor = LanePreprocessor()
+
+def as_bgr_frame(image):
+    """Accept a carla.Image or an array; return an HxWx3/4 uint8 array without copying"""
+    if hasattr(image, 'raw_data'):
+        return np.frombuffer(image.raw_data, dtype=np.uint8).reshape((image.height, image.width, 4))
+    return image
 
 #------------------check offset--------------------------------
 def get_lane_offset(img, lane_lines):
@@ -56,49 +174,155 @@ def get_lane_offset(img, lane_lines):
 
 
 # ---------- 4. Separate and Average Lane Lines (Handle Left/Right Optional) ----------
-def average_lane_lines(img, lines):
-    left_lines = []
-    right_lines = []
+# Lanes are modelled as x = polyval(model, y); a straight lane is [slope, intercept]
+
+def classify_segments(lines, min_slope=0.5, min_angle=0.0, max_angle=90.0, min_length=0.0,
+                      max_y=None, center_x=None):
+    """
+    Split HoughLinesP segments into left and right lane candidates with boolean masks.
+
+    :param lines: (N, 1, 4) array from cv2.HoughLinesP, or None
+    :param min_slope: minimum |dy/dx|, flatter segments are dropped
+    :param min_angle, max_angle: allowed |angle| range in degrees
+    :param min_length: minimum segment length in pixels
+    :param max_y: drop segments with both ends below this row (e.g. road arrows)
+    :param center_x: if given, left segments must lie left of it and right ones right of it
+    :return: (N, 4) float segments, left mask, right mask
+    """
     if lines is None:
-        return []
+        segments = np.zeros((0, 4))
+        return segments, np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+    segments = lines.reshape(-1, 4).astype(np.float64)
+    dx = segments[:, 2] - segments[:, 0]
+    dy = segments[:, 3] - segments[:, 1]
+    slope = np.divide(dy, dx, out=np.full_like(dy, np.inf), where=dx != 0)
+    angle = np.abs(np.degrees(np.arctan2(dy, dx)))
+    angle = np.minimum(angle, 180.0 - angle)
 
-    height, width = img.shape[:2]
-    for line in lines:
-        x1, y1, x2, y2 = line[0]
-        if x2 == x1:
-            continue
-        slope = (y2 - y1) / (x2 - x1)
-        if abs(slope) < 0.5:
-            continue
-        if slope < 0:
-            left_lines.append(line[0])
-        else:
-            right_lines.append(line[0])
+    keep = (dx != 0) & (np.abs(slope) >= min_slope)
+    keep &= (angle > min_angle) & (angle < max_angle)
+    if min_length:
+        keep &= np.hypot(dx, dy) > min_length
+    if max_y is not None:
+        keep &= (segments[:, 1] < max_y) | (segments[:, 3] < max_y)
+
+    left = keep & (slope < 0)
+    right = keep & (slope > 0)
+    if center_x is not None:
+        mid_x = 0.5 * (segments[:, 0] + segments[:, 2])
+        left &= mid_x < center_x
+        right &= mid_x > center_x
+    return segments, left, right
+
+def fit_lane_model(segments, weights=None):
+    """
+    Weighted least squares fit of x = a*y + b through both ends of every segment.
+
+    :param segments: (K, 4) float array
+    :param weights: (K,) weights, defaults to the segment lengths
+    :return: np.array([a, b]) or None
+    """
+    if len(segments) == 0:
+        return None
+    if weights is None:
+        weights = np.hypot(segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1])
+    x = segments[:, [0, 2]].ravel()
+    y = segments[:, [1, 3]].ravel()
+    return _fit_line(x, y, np.repeat(weights, 2))
 
-    def fit_line(points):
-        if len(points) == 0:
-            return None
-        x_coords = [x1 for x1, y1, x2, y2 in points] + [x2 for x1, y1, x2, y2 in points]
-        y_coords = [y1 for x1, y1, x2, y2 in points] + [y2 for x1, y1, x2, y2 in points]
-        poly = np.polyfit(y_coords, x_coords, deg=1)
-        y1, y2 = height, int(height * 0.6)
-        x1, x2 = int(np.polyval(poly, y1)), int(np.polyval(poly, y2))
-        return [[x1, y1, x2, y2]]
+def _fit_line(x, y, w):
+    """Weighted least squares line x = a*y + b; None when degenerate"""
+    # Normal equations of the 2x2 system, solved in closed form
+    sw, swy, swx = w.sum(), (w * y).sum(), (w * x).sum()
+    swyy, swxy = (w * y * y).sum(), (w * x * y).sum()
+    det = sw * swyy - swy * swy
+    if abs(det) < 1e-9:
+        return None
+    a = (sw * swxy - swy * swx) / det
+    b = (swx - a * swy) / sw
+    return np.array([a, b])
 
-    result_lines = []
-    left_avg = fit_line(left_lines)
-    right_avg = fit_line(right_lines)
+def fit_residual(model, x, y):
+    """RMS horizontal distance (pixels) of points to a lane model; None without a model"""
+    if model is None or len(x) == 0:
+        return None
+    return float(np.sqrt(np.mean((np.asarray(x) - np.polyval(model, y)) ** 2)))
 
-    if left_avg:
-        result_lines.extend(left_avg)
-    if right_avg:
-        result_lines.extend(right_avg)
+def mean_residual(residuals):
+    """Mean of the residuals that are not None"""
+    residuals = [r for r in residuals if r is not None]
+    return sum(residuals) / len(residuals) if residuals else None
 
-    return result_lines
+def segments_residual(fits):
+    """Mean fit residual of (model, segments) pairs, over both ends of the segments"""
+    return mean_residual([fit_residual(model, segments[:, [0, 2]].ravel(), segments[:, [1, 3]].ravel())
+                          for model, segments in fits])
+
+def fit_lane_points(x, y, degree=1, weights=None):
+    """Least squares fit of x = polyval(model, y) through edge pixels; None if too few"""
+    if len(x) <= degree + 1 or np.ptp(y) < 1:
+        return None
+    if degree == 1:
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        return _fit_line(x, y, np.ones_like(x) if weights is None else np.square(weights))
+    return np.polyfit(y, x, degree, w=weights)
+
+def lane_offset(left_model, right_model, height, width, half_lane_px=200):
+    """
+    Offset of the image center from the lane center at the bottom row, in pixels.
+
+    With a single lane the center is guessed from a typical half lane width.
+    """
+    img_center = width // 2
+    x_positions = [int(np.polyval(model, height)) for model in (left_model, right_model)
+                   if model is not None]
+    if not x_positions:
+        return None  # No lines detected
+    if len(x_positions) == 1:
+        # Only one line, assume typical lane width to guess center
+        lane_center = x_positions[0] + (half_lane_px if x_positions[0] < img_center else -half_lane_px)
+    else:
+        lane_center = sum(x_positions) // len(x_positions)
+    return img_center - lane_center
+
+def fit_lanes(lines, height, width, **classify_params):
+    """
+    Classify Hough segments and fit both lanes without Python loops over segments.
+
+    :param classify_params: forwarded to classify_segments
+    :return: left model, right model (None when not found) and the offset in pixels
+    """
+    segments, left, right = classify_segments(lines, **classify_params)
+    left_model = fit_lane_model(segments[left])
+    right_model = fit_lane_model(segments[right])
+    return left_model, right_model, lane_offset(left_model, right_model, height, width)
+
+def model_to_line(model, height, top=0.6):
+    """Endpoints [x1, y1, x2, y2] of a lane model between the bottom row and top * height"""
+    y1, y2 = height, int(height * top)
+    return [int(np.polyval(model, y1)), y1, int(np.polyval(model, y2)), y2]
+
+def average_lane_lines(img, lines):
+    if lines is None:
+        return []
+    height, width = img.shape[:2]
+    left_model, right_model, _ = fit_lanes(lines, height, width)
+    return [model_to_line(model, height) for model in (left_model, right_model) if model is not None]
 
 # ---------- 5. Hough Transform ----------
-def detect_lines(img):
-    return cv2.HoughLinesP(img, 1, np.pi / 180, threshold=60, minLineLength=40, maxLineGap=50)
+# Full resolution parameters; votes, lengths and gaps are all counted in pixels
+HOUGH_THRESHOLD = 60
+HOUGH_MIN_LENGTH = 40
+HOUGH_MAX_GAP = 50
+
+def detect_lines(img, scale=1.0):
+    """
+    :param scale: resolution of img relative to the camera frame (0.5 for half resolution),
+                  the pixel thresholds shrink with it
+    """
+    return cv2.HoughLinesP(img, 1, np.pi / 180, threshold=max(int(round(HOUGH_THRESHOLD * scale)), 1),
+                           minLineLength=HOUGH_MIN_LENGTH * scale, maxLineGap=HOUGH_MAX_GAP * scale)
 
 # ---------- 6. Draw Detected Lane Lines ----------
 def draw_lines(img, lines, color=(0, 255, 0), thickness=5):
@@ -108,33 +332,265 @@ def draw_lines(img, lines, color=(0, 255, 0), thickness=5):
             cv2.line(line_img, (x1, y1), (x2, y2), color, thickness)
     return cv2.addWeighted(img, 0.8, line_img, 1, 1)
 
-# ---------- 7. Full Pipeline ----------
-def detect_lanes_pipeline(img):
-    white = color_filter(img)
-    edges = edge_detection(white)
-    roi = region_of_interest(edges)
-    raw_lines = detect_lines(roi)
-    averaged_lines = average_lane_lines(img, raw_lines)
-    lane_img =  draw_lines(img, averaged_lines)
+# ---------- 7. Lane Result ----------
+# Typical lane width in meters, used to turn pixel offsets into meters
+LANE_WIDTH_M = 3.5
+# Half lane width in pixels assumed when only one lane is visible
+HALF_LANE_PX = 200
 
-    offset = get_lane_offset(lane_img, averaged_lines)
+class LaneResult(object):
+    """
+    Numbers of one lane detection, without any drawing.
 
-    return lane_img, offset
+    left, right: lane models x = polyval(model, y), None when not found
+    offset_px: image center minus lane center at the bottom row (positive: vehicle right of center)
+    offset_m: offset_px converted with the detected lane width
+    heading_error: angle (rad) between the lane center direction and the image vertical,
+                   positive when the lane turns right of the vehicle heading
+    confidence: 0 (nothing found) to 1
+    timings: seconds spent per stage
+    space: 'image' if the models are in camera pixels, 'birdseye' for the warped view
+    """
 
-# ---------- 8. Carla Integration ----------
-def process_image_lane(image):
-    # img_array = np.frombuffer(image.raw_data, dtype=np.uint8)
-    # img_array = img_array.reshape((image.height, image.width, 4))
-    # rgb_image = img_array[:, :, :3][:, :, ::-1]
+    def __init__(self, left=None, right=None, offset_px=None, offset_m=None, heading_error=None,
+                 confidence=0.0, timings=None, space='image'):
+        self.left = left
+        self.right = right
+        self.offset_px = offset_px
+        self.offset_m = offset_m
+        self.heading_error = heading_error
+        self.confidence = confidence
+        self.timings = timings if timings is not None else {}
+        self.space = space
 
-    lane_img, offset = detect_lanes_pipeline(image)
+    @property
+    def detected(self):
+        return self.offset_px is not None
+
+    def __repr__(self):
+        return 'LaneResult(offset_px=%s, offset_m=%s, heading_error=%s, confidence=%.2f)' % (
+            self.offset_px, self.offset_m, self.heading_error, self.confidence)
+
+def make_lane_result(left, right, height, width, confidence, timings=None, bottom=None):
+    """
+    Build a LaneResult from two image space lane models.
+
+    :param bottom: row where the offset is measured, defaults to the bottom of the image
+    """
+    bottom = height if bottom is None else bottom
+    offset_px = lane_offset(left, right, height, width, HALF_LANE_PX)
+    if offset_px is None:
+        return LaneResult(left, right, confidence=confidence, timings=timings)
+    if left is not None and right is not None:
+        lane_px = np.polyval(right, bottom) - np.polyval(left, bottom)
+        center_slope = 0.5 * (np.polyval(np.polyder(left), bottom) + np.polyval(np.polyder(right), bottom))
+    else:
+        lane_px = 2 * HALF_LANE_PX
+        center_slope = np.polyval(np.polyder(left if left is not None else right), bottom)
+    offset_m = offset_px * LANE_WIDTH_M / lane_px if lane_px > 0 else None
+    # center_slope is dx/dy; going up the image (dy < 0) the lane moves right when it is negative
+    heading_error = -math.atan(center_slope)
+    return LaneResult(left, right, offset_px, offset_m, heading_error, confidence, timings)
+
+# ---------- 8. Headless Detection ----------
+def _lane_coverage(segments, roi_height):
+    """Fraction of the ROI height spanned by a lane's segments"""
+    if len(segments) == 0:
+        return 0.0
+    ys = segments[:, [1, 3]]
+    return min(1.0, (ys.max() - ys.min()) / float(roi_height))
+
+def detect_lanes(img, preprocessor=None, collector=None):
+    """
+    Detect both lanes and return a LaneResult, without drawing anything.
+
+    :param img: HxWx3 BGR or HxWx4 BGRA image (or a carla.Image)
+    :param collector: optional Lane_Profiling.StageCollector
+    """
+    img = as_bgr_frame(img)
+    start = time.perf_counter()
+    roi, origin = (preprocessor or _preprocessor)(img, collector)
+    return lanes_from_edges(roi, origin, img.shape, collector, {'preprocess': time.perf_counter() - start})
+
+def lanes_from_edges(roi, origin, shape, collector=None, timings=None):
+    """
+    Hough and lane fits on the edge map of a LanePreprocessor.
+
+    :param shape: shape of the camera frame
+    :param timings: timings of the earlier stages, completed with 'hough' and 'fit'
+    """
+    height, width = shape[:2]
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    raw_lines = offset_lines(detect_lines(roi), origin)
+    hough = time.perf_counter()
+    segments, left_mask, right_mask = classify_segments(raw_lines)
+    left = fit_lane_model(segments[left_mask])
+    right = fit_lane_model(segments[right_mask])
+    confidence = 0.5 * (_lane_coverage(segments[left_mask], roi.shape[0]) +
+                        _lane_coverage(segments[right_mask], roi.shape[0]))
+    fitted = time.perf_counter()
+    timings['hough'] = hough - start
+    timings['fit'] = fitted - hough
+    if collector is not None:
+        collector.record('hough', timings['hough'], segments=len(segments))
+        collector.record('fit', timings['fit'], lane_segments=int(left_mask.sum() + right_mask.sum()),
+                         residual=segments_residual(((left, segments[left_mask]), (right, segments[right_mask]))))
+    return make_lane_result(left, right, height, width, confidence, timings)
+
+# ---------- 8b. Coarse-to-fine Detection ----------
+class PyramidLaneDetector(object):
+    """
+    Class detecting lanes on a downscaled ROI first, then refining them at full resolution.
+
+    The ROI rectangle is shrunk by 2 ** levels before the white filter, Canny and Hough,
+    whose thresholds scale with it. With refine=True, each coarse lane is refitted on the
+    white pixels of a strip of +/- strip_px around it, gathered from the full resolution
+    frame (a few thousand pixels instead of the whole ROI).
+    """
+
+    def __init__(self, levels=1, refine=True, strip_px=12, polygon=ROI_POLYGON, white_min=200,
+                 **preprocessor_params):
+        self.levels = levels
+        self.scale = 0.5 ** levels
+        self.refine = refine
+        self.strip_px = strip_px
+        self.polygon = polygon
+        self.white_min = white_min
+        self.preprocessor_params = preprocessor_params
+        self._key = None
+
+    def _setup(self, shape):
+        """ROI rectangle, downscaled size and a preprocessor for the downscaled crop"""
+        height, width = shape[:2]
+        (x0, y0, x1, y1), _ = roi_mask(shape, self.polygon)
+        # Trim the rectangle to a multiple of the pyramid factor: INTER_AREA then takes
+        # its fast integer path, about 15x faster than an arbitrary ratio
+        factor = 2 ** self.levels
+        x1 = x0 + (x1 - x0) // factor * factor
+        y1 = y0 + (y1 - y0) // factor * factor
+        self._rect = (x0, y0, x1, y1)
+        self._small_size = ((x1 - x0) // factor, (y1 - y0) // factor)
+        self._unscale = float(factor)
+        self._origin = np.array([x0, y0, x0, y0], dtype=np.float64)
+        # Same polygon, as fractions of the ROI rectangle
+        crop_polygon = tuple(((fx * width - x0) / float(x1 - x0), (fy * height - y0) / float(y1 - y0))
+                             for fx, fy in self.polygon)
+        self._preprocessor = LanePreprocessor(crop_polygon, white_min=self.white_min,
+                                              **self.preprocessor_params)
+        self._small = None
+        self._rows = np.arange(y0, y1)
+        self._row_starts = (self._rows * width)[:, None]
+        self._strip = np.arange(-self.strip_px, self.strip_px + 1)
+        self._key = shape
+
+    def _refine(self, frame, models):
+        """
+        Refit lanes on the white pixels of a strip around each of them.
+
+        :return: list of (model or None, fraction of the rows with white pixels)
+        """
+        rows = self._rows
+        width = frame.shape[1]
+        # One gather of every strip pixel, through flat pixel indices
+        cols = np.rint([np.polyval(model, rows) for model in models]).astype(np.int64)[:, :, None] + self._strip
+        inside = (cols >= 0) & (cols < width)
+        np.clip(cols, 0, width - 1, out=cols)
+        pixels = np.take(frame.reshape(-1, frame.shape[2]), self._row_starts + cols, axis=0)
+        strips = pixels.reshape(-1, cols.shape[2], frame.shape[2])
+        lightness = cv2.cvtColor(strips, cv2.COLOR_BGR2HLS)[:, :, 1].reshape(cols.shape)
+        white = inside & (lightness >= self.white_min)
+        refined = []
+        for side in range(len(models)):
+            ys = np.broadcast_to(rows[:, None], cols.shape[1:])[white[side]]
+            coverage = np.count_nonzero(white[side].any(axis=1)) / float(len(rows))
+            refined.append((fit_lane_points(cols[side][white[side]], ys, degree=len(models[side]) - 1),
+                            coverage))
+        return refined
+
+    def detect(self, frame, collector=None):
+        """
+        :param frame: HxWx3 BGR or HxWx4 BGRA image (or a carla.Image)
+        :param collector: optional Lane_Profiling.StageCollector
+        :return: LaneResult
+        """
+        frame = as_bgr_frame(frame)
+        height, width = frame.shape[:2]
+        if self._key != frame.shape:
+            self._setup(frame.shape)
+        x0, y0, x1, y1 = self._rect
+        start = time.perf_counter()
+        self._small = cv2.resize(frame[y0:y1, x0:x1], self._small_size, dst=self._small,
+                                 interpolation=cv2.INTER_AREA)
+        resized = time.perf_counter()
+        edges, origin = self._preprocessor(self._small, collector)
+        preprocessed = time.perf_counter()
+        lines = detect_lines(edges, self.scale)
+        if lines is not None:
+            lines = (lines + np.array(origin * 2)) * self._unscale + self._origin
+        hough = time.perf_counter()
+        segments, left_mask, right_mask = classify_segments(lines)
+        models = [fit_lane_model(segments[left_mask]), fit_lane_model(segments[right_mask])]
+        confidence = 0.5 * (_lane_coverage(segments[left_mask], y1 - y0) +
+                            _lane_coverage(segments[right_mask], y1 - y0))
+        fitted = time.perf_counter()
+        timings = {'resize': resized - start, 'preprocess': preprocessed - resized,
+                   'hough': hough - preprocessed, 'fit': fitted - hough}
+
+        if self.refine:
+            sides = [side for side in (0, 1) if models[side] is not None]
+            coverages = []
+            if sides:
+                for side, (refined, coverage) in zip(sides, self._refine(frame, [models[side] for side in sides])):
+                    if refined is not None:
+                        models[side] = refined
+                        coverages.append(coverage)
+            if coverages:
+                confidence = sum(coverages) / 2.0
+            timings['refine'] = time.perf_counter() - fitted
+
+        if collector is not None:
+            collector.record('resize', timings['resize'], pixels=(x1 - x0) * (y1 - y0))
+            collector.record('hough', timings['hough'], segments=len(segments))
+            collector.record('fit', timings['fit'], lane_segments=int(left_mask.sum() + right_mask.sum()),
+                             residual=segments_residual(((models[0], segments[left_mask]),
+                                                         (models[1], segments[right_mask]))))
+            if self.refine:
+                collector.record('refine', timings['refine'],
+                                 pixels=2 * (2 * self.strip_px + 1) * (y1 - y0))
+        return make_lane_result(models[0], models[1], height, width, confidence, timings)
+
+# ---------- 9. Overlay Renderer ----------
+def render_lane_overlay(img, result, top=0.6):
+    """Draw the lane models and the offset of a LaneResult over a copy of the frame"""
+    height = img.shape[0]
+    lines = [model_to_line(model, height, top) for model in (result.left, result.right)
+             if model is not None]
+    lane_img = draw_lines(img, lines)
 
     # Visual correction indicator
-    if offset is not None:
-        direction = "Left" if offset > 0 else "Right"
-        correction = f"Offset: {abs(offset)} px {direction}"
+    if result.offset_px is not None:
+        direction = "Left" if result.offset_px > 0 else "Right"
+        correction = f"Offset: {abs(result.offset_px)} px {direction}"
         cv2.putText(lane_img, correction, (30, 60), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 255), 3)
+    return lane_img
 
-    frame = cv2.cvtColor(lane_img, cv2.COLOR_BGR2RGB)
+def to_surface(img):
+    """Convert a BGR/BGRA frame to a pygame surface"""
+    frame = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB if img.shape[2] == 4 else cv2.COLOR_BGR2RGB)
     return pygame.surfarray.make_surface(frame.swapaxes(0, 1))
 
+# ---------- 10. Full Pipeline ----------
+def detect_lanes_pipeline(img, preprocessor=None, collector=None):
+    result = detect_lanes(img, preprocessor, collector)
+    timer = start_timer(collector)
+    lane_img = render_lane_overlay(img, result)
+    if timer is not None:
+        timer('overlay')
+    return lane_img, result.offset_px
+
+# ---------- 11. Carla Integration ----------
+def process_image_lane(image):
+    image = as_bgr_frame(image)
+    lane_img, offset = detect_lanes_pipeline(image)
+    return to_surface(lane_img)
@@ -1,6 +1,13 @@
+import math
+import time
+
 import numpy as np
 import cv2
-import pygame
+import Lane_Detection
+from Lane_Detection import (roi_mask, LanePreprocessor, LaneResult, LANE_WIDTH_M, as_bgr_frame,
+                            fit_lane_points, fit_residual, mean_residual, offset_lines, detect_lines,
+                            to_surface)
+from Lane_Profiling import start_timer
 
 def color_filter(img):
     hls = cv2.cvtColor(img, cv2.COLOR_RGB2HLS)
@@ -15,163 +22,273 @@ def edge_detection(img):
     edges = cv2.Canny(blur, 50, 150)
     return edges
 
+# Wider polygon to accommodate curves
+ROI_POLYGON = ((0.05, 1.0), (0.95, 1.0), (0.65, 0.5), (0.35, 0.5))
+
 def region_of_interest(img):
-    height, width = img.shape[:2]
-    mask = np.zeros_like(img)
-    # Wider polygon to accommodate curves
-    polygon = np.array([[
-        (int(width * 0.05), height),
-        (int(width * 0.95), height),
-        (int(width * 0.65), int(height * 0.5)),
-        (int(width * 0.35), int(height * 0.5))
-    ]], dtype=np.int32)
-    cv2.fillPoly(mask, polygon, 255)
-    return cv2.bitwise_and(img, mask)
-
-def sliding_window_polyfit(img):
-    # Take a histogram of the bottom half of the image
-    histogram = np.sum(img[img.shape[0]//2:,:], axis=0)
-    
-    # Find the peak of the left and right halves
-    midpoint = np.int(histogram.shape[0]//2)
-    leftx_base = np.argmax(histogram[:midpoint])
-    rightx_base = np.argmax(histogram[midpoint:]) + midpoint
-    
-    # Choose the number of sliding windows
-    nwindows = 9
-    window_height = np.int(img.shape[0]//nwindows)
-    
-    # Identify the x and y positions of all nonzero pixels in the image
-    nonzero = img.nonzero()
-    nonzeroy = np.array(nonzero[0])
-    nonzerox = np.array(nonzero[1])
-    
-    # Current positions to be updated for each window
-    leftx_current = leftx_base
-    rightx_current = rightx_base
-    
-    # Set the width of the windows +/- margin
-    margin = 100
-    # Set minimum number of pixels found to recenter window
-    minpix = 50
-    
-    # Create empty lists to receive left and right lane pixel indices
-    left_lane_inds = []
-    right_lane_inds = []
-    
-    # Step through the windows one by one
-    for window in range(nwindows):
-        # Identify window boundaries in x and y
-        win_y_low = img.shape[0] - (window+1)*window_height
-        win_y_high = img.shape[0] - window*window_height
-        win_xleft_low = leftx_current - margin
-        win_xleft_high = leftx_current + margin
-        win_xright_low = rightx_current - margin
-        win_xright_high = rightx_current + margin
-        
-        # Identify the nonzero pixels in x and y within the window
-        good_left_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & 
-                          (nonzerox >= win_xleft_low) & (nonzerox < win_xleft_high)).nonzero()[0]
-        good_right_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & 
-                           (nonzerox >= win_xright_low) & (nonzerox < win_xright_high)).nonzero()[0]
-        
-        # Append these indices to the lists
-        left_lane_inds.append(good_left_inds)
-        right_lane_inds.append(good_right_inds)
-        
-        # If you found > minpix pixels, recenter next window on their mean position
-        if len(good_left_inds) > minpix:
-            leftx_current = np.int(np.mean(nonzerox[good_left_inds]))
-        if len(good_right_inds) > minpix:        
-            rightx_current = np.int(np.mean(nonzerox[good_right_inds]))
-    
-    # Concatenate the arrays of indices
-    left_lane_inds = np.concatenate(left_lane_inds)
-    right_lane_inds = np.concatenate(right_lane_inds)
-    
-    # Extract left and right line pixel positions
-    leftx = nonzerox[left_lane_inds]
-    lefty = nonzeroy[left_lane_inds] 
-    rightx = nonzerox[right_lane_inds]
-    righty = nonzeroy[right_lane_inds]
-    
-    # Fit a second order polynomial to each
-    left_fit = np.polyfit(lefty, leftx, 2)
-    right_fit = np.polyfit(righty, rightx, 2)
-    
+    (x0, y0, x1, y1), mask = roi_mask(img.shape, ROI_POLYGON)
+    result = np.zeros_like(img)
+    crop = img[y0:y1, x0:x1]
+    result[y0:y1, x0:x1] = cv2.bitwise_and(crop, crop, mask=mask)
+    return result
+
+# ---------- Bird's-eye Warp ----------
+# Road trapezoid in the camera image (top-left, top-right, bottom-right, bottom-left)
+# and the rectangle it maps to in the bird's-eye view, as fractions of each image size
+WARP_SRC = ((0.40, 0.55), (0.60, 0.55), (0.95, 1.0), (0.05, 1.0))
+WARP_DST = ((0.25, 0.0), (0.75, 0.0), (0.75, 1.0), (0.25, 1.0))
+
+class BirdEyeWarp(object):
+    """
+    Perspective warp to a bird's-eye view. The remap tables are computed once per
+    camera configuration (image size, trapezoid, output size, crop origin), so each
+    frame costs a single cv2.remap into a reused buffer.
+    """
+
+    def __init__(self, shape, origin=(0, 0), src=WARP_SRC, dst=WARP_DST, scale=0.5):
+        """
+        :param shape: shape of the camera image
+        :param origin: (x0, y0) of the crop the warp will read from
+        :param scale: size of the bird's-eye view relative to the camera image
+        """
+        height, width = shape[:2]
+        self.image_size = (width, height)
+        self.size = (int(width * scale), int(height * scale))
+        src = np.float32(src) * np.float32([width, height])
+        dst = np.float32(dst) * np.float32(self.size)
+        self.M = cv2.getPerspectiveTransform(src, dst)
+        self.Minv = cv2.getPerspectiveTransform(dst, src)
+
+        # Camera pixel of every bird's-eye pixel, relative to the crop origin
+        grid = np.mgrid[0:self.size[1], 0:self.size[0]].astype(np.float32)
+        points = np.stack((grid[1], grid[0]), axis=-1).reshape(-1, 1, 2)
+        source = cv2.perspectiveTransform(points, self.Minv).reshape(self.size[1], self.size[0], 2)
+        map_x = source[:, :, 0] - origin[0]
+        map_y = source[:, :, 1] - origin[1]
+        self._map, _ = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2, nninterpolation=True)
+        self._out = np.empty((self.size[1], self.size[0]), dtype=np.uint8)
+
+    def warp(self, img):
+        """Warp a single channel image (read from the crop origin) into the reused output buffer"""
+        return cv2.remap(img, self._map, None, cv2.INTER_NEAREST, dst=self._out,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    def to_image(self, x, y):
+        """Map bird's-eye points back to camera image coordinates"""
+        points = np.stack((np.asarray(x, np.float32), np.asarray(y, np.float32)), axis=-1).reshape(-1, 1, 2)
+        return cv2.perspectiveTransform(points, self.Minv).reshape(-1, 2)
+
+# (image shape, origin, src, dst, scale) -> BirdEyeWarp
+_WARP_CACHE = {}
+
+def get_warp(shape, origin=(0, 0), src=WARP_SRC, dst=WARP_DST, scale=0.5):
+    key = (shape[:2], tuple(origin), src, dst, scale)
+    warp = _WARP_CACHE.get(key)
+    if warp is None:
+        warp = BirdEyeWarp(shape, origin, src, dst, scale)
+        _WARP_CACHE[key] = warp
+    return warp
+
+# ---------- Sliding Window Search ----------
+class SlidingWindowLaneFinder(object):
+    """
+    Class to find curved lanes with sliding windows in the bird's-eye view.
+
+    The nonzero pixels are indexed once per frame (sorted by row), so each window
+    only scans its own row slice. Window centers of a successful frame seed the
+    windows of the next one, which skips the histogram search.
+    """
+
+    def __init__(self, nwindows=9, margin=50, minpix=25, polygon=ROI_POLYGON,
+                 src=WARP_SRC, dst=WARP_DST, scale=0.5):
+        """
+        :param margin: half width of the windows in bird's-eye pixels
+        :param minpix: minimum number of pixels found to recenter a window
+        """
+        self.nwindows = nwindows
+        self.margin = margin
+        self.minpix = minpix
+        self.src = src
+        self.dst = dst
+        self.scale = scale
+        self.preprocessor = LanePreprocessor(polygon=polygon)
+        self.warp = None
+        self._centers = None
+        self._found = None
+        self._points = None
+
+    def reset(self):
+        self._centers = None
+
+    def _base_positions(self, nonzerox, nonzeroy, height, width):
+        # Histogram of the bottom half of the image
+        histogram = np.bincount(nonzerox[nonzeroy >= height // 2], minlength=width)
+        midpoint = width // 2
+        return int(np.argmax(histogram[:midpoint])), int(np.argmax(histogram[midpoint:]) + midpoint)
+
+    def search(self, birdseye):
+        """
+        :param birdseye: binary bird's-eye image
+        :return: left and right second order fits x = f(y) in bird's-eye pixels (or None)
+        """
+        height, width = birdseye.shape
+        nonzeroy, nonzerox = np.nonzero(birdseye)
+        window_height = height // self.nwindows
+
+        # Row slices of every window, from the bottom up
+        highs = height - np.arange(self.nwindows) * window_height
+        lows = highs - window_height
+        starts = np.searchsorted(nonzeroy, lows)
+        ends = np.searchsorted(nonzeroy, highs)
+
+        previous = self._centers
+        current = list(self._base_positions(nonzerox, nonzeroy, height, width)) if previous is None else None
+        centers = np.zeros((self.nwindows, 2), dtype=np.int64)
+        found = np.zeros((self.nwindows, 2), dtype=bool)
+        lane_inds = ([], [])
+        for window in range(self.nwindows):
+            xs = nonzerox[starts[window]:ends[window]]
+            for side in (0, 1):
+                center = previous[window, side] if previous is not None else current[side]
+                good = np.flatnonzero(np.abs(xs - center) < self.margin) + starts[window]
+                lane_inds[side].append(good)
+                # If you found > minpix pixels, recenter window on their mean position
+                if len(good) > self.minpix:
+                    found[window, side] = True
+                    center = int(np.mean(nonzerox[good]))
+                    if current is not None:
+                        current[side] = center
+                centers[window, side] = center
+
+        fits = []
+        self._points = []
+        for side in (0, 1):
+            inds = np.concatenate(lane_inds[side])
+            self._points.append((nonzerox[inds], nonzeroy[inds]))
+            fits.append(fit_lane_points(nonzerox[inds], nonzeroy[inds], degree=2))
+        self._centers = centers if fits[0] is not None and fits[1] is not None else None
+        self._found = found
+        return fits[0], fits[1]
+
+    def find(self, frame, collector=None):
+        """
+        :param frame: HxWx3 BGR or HxWx4 BGRA image
+        :param collector: optional Lane_Profiling.StageCollector
+        :return: left fit, right fit (bird's-eye pixels) and the offset in camera pixels
+        """
+        edges, origin = self.preprocessor(frame, collector)
+        timer = start_timer(collector)
+        self.warp = get_warp(frame.shape, origin, self.src, self.dst, self.scale)
+        birdseye = self.warp.warp(edges)
+        if timer is not None:
+            timer('warp', pixels=birdseye.size)
+        left_fit, right_fit = self.search(birdseye)
+        if timer is not None:
+            timer('search', lane_pixels=sum(len(x) for x, _ in self._points),
+                  residual=mean_residual([fit_residual(fit, x, y) for fit, (x, y)
+                                          in zip((left_fit, right_fit), self._points)]))
+        if left_fit is None or right_fit is None:
+            return left_fit, right_fit, None
+        return left_fit, right_fit, get_lane_offset(self.warp, left_fit, right_fit)
+
+    def detect(self, frame, collector=None):
+        """
+        Headless detection of one frame.
+
+        :return: LaneResult with bird's-eye models; offset_m uses the detected lane width
+        """
+        frame = as_bgr_frame(frame)
+        start = time.perf_counter()
+        left_fit, right_fit, offset = self.find(frame, collector)
+        if offset is None:
+            return LaneResult(left_fit, right_fit, timings={'search': time.perf_counter() - start},
+                              space='birdseye')
+        bottom = self.warp.size[1] - 1
+        left_x, right_x = np.polyval(left_fit, bottom), np.polyval(right_fit, bottom)
+        # Lane width at the bottom row, measured in camera pixels
+        edges = self.warp.to_image([left_x, right_x], [bottom, bottom])
+        lane_px = edges[1, 0] - edges[0, 0]
+        offset_m = offset * LANE_WIDTH_M / lane_px if lane_px > 0 else None
+        center_slope = 0.5 * (np.polyval(np.polyder(left_fit), bottom) + np.polyval(np.polyder(right_fit), bottom))
+        # Fraction of the windows that found enough pixels on both sides
+        confidence = float(np.mean(self._found)) if self._found is not None else 0.0
+        return LaneResult(left_fit, right_fit, float(offset), offset_m, -math.atan(center_slope),
+                          confidence, {'search': time.perf_counter() - start}, 'birdseye')
+
+def sliding_window_polyfit(img, finder=None):
+    """Fit both lanes of a binary bird's-eye image; raises ValueError when a lane is missing"""
+    left_fit, right_fit = (finder or SlidingWindowLaneFinder()).search(img)
+    if left_fit is None or right_fit is None:
+        raise ValueError('lane not found')
     return left_fit, right_fit
 
-def draw_polyfit(img, left_fit, right_fit):
-    ploty = np.linspace(0, img.shape[0]-1, img.shape[0])
-    left_fitx = left_fit[0]*ploty**2 + left_fit[1]*ploty + left_fit[2]
-    right_fitx = right_fit[0]*ploty**2 + right_fit[1]*ploty + right_fit[2]
-    
+def draw_polyfit(img, left_fit, right_fit, warp):
+    width, height = warp.size
+    ploty = np.linspace(0, height - 1, height)
+    left_fitx = np.polyval(left_fit, ploty)
+    right_fitx = np.polyval(right_fit, ploty)
+
     # Create an image to draw the lines on
-    warp_zero = np.zeros_like(img).astype(np.uint8)
-    color_warp = np.dstack((warp_zero, warp_zero, warp_zero))
-    
+    color_warp = np.zeros((height, width, img.shape[2]), dtype=np.uint8)
+
     # Recast the x and y points into usable format for cv2.fillPoly()
     pts_left = np.array([np.transpose(np.vstack([left_fitx, ploty]))])
     pts_right = np.array([np.flipud(np.transpose(np.vstack([right_fitx, ploty])))])
     pts = np.hstack((pts_left, pts_right))
-    
+
     # Draw the lane onto the warped blank image
     cv2.fillPoly(color_warp, np.int_([pts]), (0,255, 0))
-    
+
     # Draw the lane lines
-    for i in range(len(ploty)-1):
-        cv2.line(color_warp, (int(left_fitx[i]), int(ploty[i])), 
-                 (int(left_fitx[i+1]), int(ploty[i+1])), (255,0,0), 5)
-        cv2.line(color_warp, (int(right_fitx[i]), int(ploty[i])), 
-                 (int(right_fitx[i+1]), int(ploty[i+1])), (0,0,255), 5)
-    
-    # Combine the result with the original image
-    result = cv2.addWeighted(img, 1, color_warp, 0.3, 0)
+    cv2.polylines(color_warp, np.int_(pts_left), False, (255, 0, 0), 5)
+    cv2.polylines(color_warp, np.int_(pts_right), False, (0, 0, 255), 5)
+
+    # Warp back to the camera view and combine the result with the original image
+    overlay = cv2.warpPerspective(color_warp, warp.Minv, warp.image_size)
+    result = cv2.addWeighted(img, 1, overlay, 0.3, 0)
     return result
 
-def get_lane_offset(img, left_fit, right_fit):
-    height = img.shape[0]
-    img_center = img.shape[1] // 2
-    
-    # Calculate x positions at bottom of image
-    left_x = left_fit[0]*height**2 + left_fit[1]*height + left_fit[2]
-    right_x = right_fit[0]*height**2 + right_fit[1]*height + right_fit[2]
-    
-    lane_center = (left_x + right_x) // 2
+def get_lane_offset(warp, left_fit, right_fit):
+    height = warp.size[1] - 1
+    img_center = warp.image_size[0] // 2
+
+    # Calculate x positions at bottom of the bird's-eye view, then map the lane center back
+    left_x = np.polyval(left_fit, height)
+    right_x = np.polyval(right_fit, height)
+    lane_center = warp.to_image((left_x + right_x) / 2.0, height)[0, 0]
     offset = img_center - lane_center
     return offset
 
-def detect_lanes_pipeline(img):
-    white = color_filter(img)
-    edges = edge_detection(white)
-    roi = region_of_interest(edges)
-    
-    try:
-        left_fit, right_fit = sliding_window_polyfit(roi)
-        lane_img = draw_polyfit(img, left_fit, right_fit)
-        offset = get_lane_offset(img, left_fit, right_fit)
-    except:
+_finder = SlidingWindowLaneFinder()
+
+def detect_lanes_pipeline(img, finder=None, collector=None):
+    finder = finder or _finder
+    left_fit, right_fit, offset = finder.find(img, collector)
+    timer = start_timer(collector)
+
+    if offset is not None:
+        lane_img = draw_polyfit(img, left_fit, right_fit, finder.warp)
+    else:
         # Fallback to straight line detection if polynomial fit fails
-        raw_lines = cv2.HoughLinesP(roi, 1, np.pi/180, 60, minLineLength=40, maxLineGap=50)
-        averaged_lines = average_lane_lines(img, raw_lines)
-        lane_img = draw_lines(img, averaged_lines)
-        offset = get_lane_offset(img, averaged_lines)
-    
+        edges, origin = finder.preprocessor(img)
+        raw_lines = offset_lines(detect_lines(edges), origin)
+        averaged_lines = Lane_Detection.average_lane_lines(img, raw_lines)
+        lane_img = Lane_Detection.draw_lines(img, averaged_lines)
+        offset = Lane_Detection.get_lane_offset(img, averaged_lines)
+    if timer is not None:
+        timer('overlay')
+
     return lane_img, offset
 
 def process_image_lane(image):
-    img_array = np.frombuffer(image.raw_data, dtype=np.uint8)
-    img_array = img_array.reshape((image.height, image.width, 4))
-    rgb_image = img_array[:, :, :3][:, :, ::-1]
+    image = as_bgr_frame(image)
 
-    lane_img, offset = detect_lanes_pipeline(rgb_image)
+    lane_img, offset = detect_lanes_pipeline(image)
 
     if offset is not None:
         direction = "Left" if offset > 0 else "Right"
         correction = f"Offset: {abs(offset):.1f} px {direction}"
         cv2.putText(lane_img, correction, (30, 60), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 255), 3)
 
-    frame = cv2.cvtColor(lane_img, cv2.COLOR_BGR2RGB)
-    return pygame.surfarray.make_surface(frame.swapaxes(0, 1))
-
+    return to_surface(lane_img)
 
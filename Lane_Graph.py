@@ -0,0 +1,75 @@
+"""Walking lanes ahead through their successors, with the lane ends cached.
+
+Finding "the next X along my lane" (a stop line, a leading vehicle) only needs the
+current lane and, near its end, the lanes that follow. The end of a lane and its
+successors are found once with the waypoint API and kept per (road_id, lane_id).
+"""
+
+
+class LaneGraph(object):
+    """Class discovering and caching the lane ends and successor lanes of a map"""
+
+    def __init__(self, step=2.0):
+        """
+        :param step: waypoint spacing used to walk to the end of a lane
+        """
+        self.step = step
+        # (road_id, lane_id) -> (s at the lane end, successor (key, s, waypoint) list)
+        self._lane_ends = {}
+
+    def lane_end(self, waypoint):
+        """(s at the end of the lane of a waypoint, successor lanes), cached by lane"""
+        key = (waypoint.road_id, waypoint.lane_id)
+        cached = self._lane_ends.get(key)
+        if cached is not None:
+            return cached
+        if hasattr(waypoint, 'next_until_lane_end'):
+            lane = waypoint.next_until_lane_end(self.step)
+            last = lane[-1] if lane else waypoint
+        else:
+            last = waypoint
+            while True:
+                options = [w for w in last.next(self.step) if (w.road_id, w.lane_id) == key]
+                if not options:
+                    break
+                last = options[0]
+        successors = [((w.road_id, w.lane_id), w.s, w) for w in last.next(self.step)
+                      if (w.road_id, w.lane_id) != key]
+        cached = self._lane_ends[key] = (last.s, successors)
+        return cached
+
+    def search(self, waypoint, max_distance, find, s=None):
+        """
+        Closest item ahead along the lane of a waypoint and its successors.
+
+        At a junction every successor lane is searched and the closest item wins.
+
+        :param find: find(key, s, budget) -> (item, distance along that lane) or (None, None),
+                     the closest item at most budget meters ahead of s on lane key
+        :param s: position on the lane, defaults to waypoint.s
+        :return: (item, distance along the lanes) or (None, None)
+        """
+        if waypoint is None:
+            return None, None
+        best, best_distance = None, None
+        pending = [((waypoint.road_id, waypoint.lane_id), waypoint.s if s is None else s, waypoint, 0.0)]
+        visited = set()
+        while pending:
+            key, s, lane_waypoint, travelled = pending.pop()
+            if key in visited:
+                continue
+            visited.add(key)
+            budget = max_distance - travelled
+            if best_distance is not None:
+                budget = min(budget, best_distance - travelled)
+            item, distance = find(key, s, budget)
+            if item is not None:
+                best, best_distance = item, travelled + distance
+                continue
+            end_s, successors = self.lane_end(lane_waypoint)
+            travelled += abs(end_s - s) + self.step
+            if travelled >= max_distance:
+                continue
+            pending.extend((next_key, next_s, next_waypoint, travelled)
+                           for next_key, next_s, next_waypoint in successors)
+        return best, best_distance
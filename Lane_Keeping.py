@@ -0,0 +1,235 @@
+"""Lane keeping driven directly by the lane results, at the camera rate.
+
+The steering is computed and applied in the sensor callback (or the last stage of
+the lane pipeline) as soon as a LaneResult is available, instead of waiting for the
+next world tick. The time from the arrival of the camera image to the return of
+apply_control is recorded for every frame, since with perception in the loop the
+end-to-end latency, not the planner throughput, limits how well the car follows
+the lane.
+
+Example:
+    python Lane_Keeping.py --strategy pyramid --scenario curved_left --frames 120
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import time
+
+import numpy as np
+
+
+class LaneKeepingController(object):
+    """
+    PD steering on the lateral offset plus a feed forward on the heading error.
+
+    CARLA steering is positive to the right. The offset is positive when the vehicle
+    is right of the lane center, so it steers left; the heading error is positive when
+    the lane turns right, so it steers right.
+    """
+
+    def __init__(self, kp=0.35, kd=0.08, kh=0.6, max_steer=0.5, max_steer_rate=2.0,
+                 throttle=0.35, min_confidence=0.2, hold_frames=5, decay=0.8):
+        """
+        :param kp, kd: gains on the offset (per meter) and on its rate (per m/s)
+        :param kh: gain on the heading error (per radian)
+        :param max_steer_rate: largest steering change per second
+        :param min_confidence: lane results below this are treated as lost
+        :param hold_frames: frames without lanes before the throttle is released
+        :param decay: steering factor applied on every frame without lanes
+        """
+        self.kp = kp
+        self.kd = kd
+        self.kh = kh
+        self.max_steer = max_steer
+        self.max_steer_rate = max_steer_rate
+        self.throttle = throttle
+        self.min_confidence = min_confidence
+        self.hold_frames = hold_frames
+        self.decay = decay
+        self.reset()
+
+    def reset(self):
+        self.steer = 0.0
+        self.lost = 0
+        self._last_offset = None
+        self._last_timestamp = None
+
+    def step(self, result, timestamp):
+        """
+        :param result: LaneResult of the frame
+        :param timestamp: sensor time of the frame in seconds (carla.Image.timestamp)
+        :return: (throttle, steer)
+        """
+        dt = timestamp - self._last_timestamp if self._last_timestamp is not None else None
+        self._last_timestamp = timestamp
+        if (not result.detected or result.offset_m is None
+                or result.confidence < self.min_confidence):
+            self.lost += 1
+            self._last_offset = None
+            self.steer *= self.decay
+            return (self.throttle if self.lost <= self.hold_frames else 0.0), self.steer
+
+        self.lost = 0
+        rate = 0.0
+        if self._last_offset is not None and dt:
+            rate = (result.offset_m - self._last_offset) / dt
+        self._last_offset = result.offset_m
+        heading = result.heading_error or 0.0
+        target = -self.kp * result.offset_m - self.kd * rate + self.kh * heading
+        target = float(np.clip(target, -self.max_steer, self.max_steer))
+        if dt:
+            # The steering column cannot jump, and noisy frames should not shake it either
+            limit = self.max_steer_rate * dt
+            target = min(max(target, self.steer - limit), self.steer + limit)
+        self.steer = target
+        return self.throttle, self.steer
+
+
+class LaneKeeper(object):
+    """
+    Class applying LaneKeepingController outputs to a vehicle and timing every frame.
+
+    latency_ms: image arrival (sensor callback or pipeline submission) to the return
+                of apply_control
+    detect_ms: share of it spent in lane detection
+    frame_lag: world frames elapsed between the image and the control, when a world
+               is given
+    """
+
+    def __init__(self, vehicle, controller=None, world=None, control_type=None, history=1000):
+        """
+        :param control_type: callable(throttle=, steer=, brake=) building the control,
+                             defaults to carla.VehicleControl
+        :param history: per-frame records kept for the report
+        """
+        if control_type is None:
+            import carla
+            control_type = carla.VehicleControl
+        self.vehicle = vehicle
+        self.controller = controller or LaneKeepingController()
+        self.world = world
+        self.control_type = control_type
+        self.records = collections.deque(maxlen=history)
+        self.frames = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+
+    def on_result(self, frame_id, result, timestamp, received, detected=None):
+        """
+        Steer from one lane result, right away.
+
+        :param timestamp: sensor time of the image in seconds
+        :param received: time.perf_counter() when the image arrived
+        :param detected: time.perf_counter() when the lane result was ready
+        :return: the latency in milliseconds
+        """
+        throttle, steer = self.controller.step(result, timestamp)
+        self.vehicle.apply_control(self.control_type(throttle=throttle, steer=steer, brake=0.0))
+        applied = time.perf_counter()
+
+        latency = applied - received
+        frame_lag = None
+        if self.world is not None:
+            frame_lag = self.world.get_snapshot().frame - frame_id
+        self.frames += 1
+        self._latency_sum += latency
+        self._latency_max = max(self._latency_max, latency)
+        self.records.append((frame_id, timestamp, 1000.0 * latency,
+                             1000.0 * (detected - received) if detected is not None else None,
+                             frame_lag, result.offset_m, steer))
+        return 1000.0 * latency
+
+    def summary(self):
+        """Latency over the whole run, percentiles over the kept records"""
+        if not self.frames:
+            return {'frames': 0}
+        latencies = np.array([record[2] for record in self.records])
+        lags = [record[4] for record in self.records if record[4] is not None]
+        return {
+            'frames': self.frames,
+            'mean_latency_ms': 1000.0 * self._latency_sum / self.frames,
+            'p50_latency_ms': float(np.percentile(latencies, 50)),
+            'p95_latency_ms': float(np.percentile(latencies, 95)),
+            'max_latency_ms': 1000.0 * self._latency_max,
+            'max_frame_lag': max(lags) if lags else None,
+        }
+
+    def save(self, path):
+        """Write the per-frame records to a csv file"""
+        with open(path, 'w') as f:
+            f.write('frame,timestamp,latency_ms,detect_ms,frame_lag,offset_m,steer\n')
+            for record in self.records:
+                f.write(','.join('' if value is None else str(value) for value in record) + '\n')
+
+
+# ==============================================================================
+# -- main() --------------------------------------------------------------------
+# ==============================================================================
+
+class _RecordingVehicle(object):
+    """Stands in for the carla.Vehicle, keeps the last control"""
+
+    def __init__(self):
+        self.control = None
+
+    def apply_control(self, control):
+        self.control = control
+
+
+class _Control(object):
+    def __init__(self, throttle=0.0, steer=0.0, brake=0.0):
+        self.throttle = throttle
+        self.steer = steer
+        self.brake = brake
+
+
+def main():
+    """Main method"""
+
+    import Lane_Strategies
+    import Synthetic_Road
+
+    argparser = argparse.ArgumentParser(description='Lane keeping latency on synthetic frames')
+    argparser.add_argument(
+        '--strategy',
+        choices=Lane_Strategies.strategy_names(),
+        default=Lane_Strategies.DEFAULT_STRATEGY,
+        help='Lane strategy (default: %(default)s)')
+    argparser.add_argument(
+        '--scenario',
+        choices=sorted(Synthetic_Road.SCENARIOS),
+        default='straight_dashed',
+        help='Synthetic road scenario (default: %(default)s)')
+    argparser.add_argument(
+        '--res',
+        metavar='WIDTHxHEIGHT',
+        default='1280x720',
+        help='Frame resolution (default: 1280x720)')
+    argparser.add_argument(
+        '--frames',
+        default=60,
+        type=int,
+        help='Number of frames (default: 60)')
+    argparser.add_argument(
+        '--save',
+        metavar='PATH',
+        help='Write the per-frame records to a csv file')
+    args = argparser.parse_args()
+    width, height = [int(x) for x in args.res.split('x')]
+
+    frames, _ = Synthetic_Road.make_scenario(args.scenario, width, height, args.frames)
+    strategy = Lane_Strategies.get_strategy(args.strategy)
+    keeper = LaneKeeper(_RecordingVehicle(), control_type=_Control)
+    for index, frame in enumerate(frames):
+        received = time.perf_counter()
+        result = strategy.detect(frame)
+        keeper.on_result(index, result, index / 20.0, received, time.perf_counter())
+    print(keeper.summary())
+    if args.save:
+        keeper.save(args.save)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""Map-guided lane search: the CARLA map says where the ego lane is, vision confirms it.
+
+The ego lane boundaries (waypoint center +/- lane_width / 2) are collected along
+waypoint.next() and projected into the camera image. Two narrow bands around them
+replace the fixed ROI trapezoid, so only their bounding rectangle goes through the
+white filter and Canny, and arrows or crosswalk stripes between the bands are never
+seen. Edge pixels are fitted per band; a lane without enough pixels falls back to
+the map boundary itself as the fit prior.
+"""
+
+import math
+import time
+from collections import OrderedDict
+
+import numpy as np
+import cv2
+
+from Camera_Projection import build_projection_matrix, project_points, world_to_camera_matrix
+from Lane_Detection import (LanePreprocessor, LaneResult, as_bgr_frame, fit_lane_points,
+                            make_lane_result)
+
+
+# Labels of the two bands in the search mask. Canny edges are 255, so after the
+# mask is applied an edge pixel holds the label of its band (3 where they overlap).
+LEFT_BAND = 1
+RIGHT_BAND = 2
+
+
+class MapLaneGuide(object):
+    """
+    Class projecting the ego lane boundaries of the map into the camera image.
+
+    The boundary points only depend on the map, so they are cached by the id of the
+    first waypoint. That waypoint is snapped to a multiple of step along the lane, so
+    consecutive frames share it and only the projection is redone.
+    """
+
+    def __init__(self, world_map, distance=40.0, step=2.0, max_cached=256):
+        """
+        :param distance: length of the lane ahead to project, in meters
+        :param step: spacing of the boundary points, in meters
+        """
+        self.map = world_map
+        self.distance = distance
+        self.step = step
+        self.max_cached = max_cached
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _anchor(self, waypoint):
+        """Waypoint of the same lane at s rounded down to a multiple of step"""
+        if not hasattr(self.map, 'get_waypoint_xodr'):
+            return waypoint
+        s = math.floor(waypoint.s / self.step) * self.step
+        anchor = self.map.get_waypoint_xodr(waypoint.road_id, waypoint.lane_id, s)
+        return anchor if anchor is not None else waypoint
+
+    def _follow(self, waypoint):
+        """Waypoints along the lane, preferring the straightest branch at junctions"""
+        waypoints = [waypoint]
+        for _ in range(int(self.distance / self.step)):
+            options = waypoints[-1].next(self.step)
+            if not options:
+                break
+            yaw = waypoints[-1].transform.rotation.yaw
+            waypoints.append(min(options, key=lambda w: abs(
+                (w.transform.rotation.yaw - yaw + 180.0) % 360.0 - 180.0)))
+        return waypoints
+
+    def boundaries(self, location):
+        """
+        :param location: carla.Location on or near the ego lane
+        :return: (N, 3) left and (N, 3) right boundary points in world coordinates, or None
+        """
+        waypoint = self.map.get_waypoint(location)
+        if waypoint is None:
+            return None
+        anchor = self._anchor(waypoint)
+        cached = self._cache.get(anchor.id)
+        if cached is not None:
+            self.hits += 1
+            self._cache.move_to_end(anchor.id)
+            return cached
+        self.misses += 1
+
+        waypoints = self._follow(anchor)
+        centers = np.array([(w.transform.location.x, w.transform.location.y, w.transform.location.z)
+                            for w in waypoints])
+        yaws = np.radians([w.transform.rotation.yaw for w in waypoints])
+        half_widths = 0.5 * np.array([w.lane_width for w in waypoints])
+        # Right vector of a UE4 yaw: (-sin, cos, 0)
+        right = np.stack((-np.sin(yaws), np.cos(yaws), np.zeros_like(yaws)), axis=1) * half_widths[:, None]
+        cached = (centers - right, centers + right)
+        self._cache[anchor.id] = cached
+        if len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return cached
+
+    def project(self, camera_transform, K, min_depth=1.0):
+        """
+        :return: for the left and right boundaries, (M, 2) pixels and (M,) depths of the
+                 points in front of the camera, or None when off the map
+        """
+        points = self.boundaries(camera_transform.location)
+        if points is None:
+            return None
+        world_to_camera = world_to_camera_matrix(camera_transform)
+        projected = []
+        for side in points:
+            pixels, depth = project_points(side, world_to_camera, K)
+            front = depth > min_depth
+            projected.append((pixels[front], depth[front]))
+        return projected
+
+
+def band_mask(projected, shape, focal, band_m=0.4, min_band_px=3, max_band_px=40, top=0.45):
+    """
+    Draw the labelled search bands of both boundaries.
+
+    :param projected: output of MapLaneGuide.project
+    :param band_m: half width of a band on the road, in meters
+    :param top: bands are clipped above this fraction of the image height
+    :return: ((x0, y0, x1, y1), mask cropped to that rectangle) or None when nothing is visible
+    """
+    height, width = shape[:2]
+    visible = [(pixels, depth) for pixels, depth in projected if len(pixels) >= 2]
+    if not visible:
+        return None
+    all_pixels = np.vstack([pixels for pixels, _ in visible])
+    margin = max_band_px
+    x0 = int(max(all_pixels[:, 0].min() - margin, 0))
+    x1 = int(min(all_pixels[:, 0].max() + margin, width))
+    y0 = int(max(all_pixels[:, 1].min() - margin, height * top, 0))
+    y1 = int(min(all_pixels[:, 1].max() + margin, height))
+    if x1 - x0 < 2 or y1 - y0 < 2:
+        return None
+
+    bands = []
+    for label, (pixels, depth) in zip((LEFT_BAND, RIGHT_BAND), projected):
+        band = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        points = np.rint(pixels - (x0, y0)).astype(np.int32)
+        # Band width shrinks with the distance, like the lane marking itself
+        half_px = np.clip(band_m * focal / np.maximum(depth, 1e-3), min_band_px, max_band_px)
+        for index in range(len(points) - 1):
+            thickness = int(2 * max(half_px[index], half_px[index + 1]))
+            cv2.line(band, tuple(int(v) for v in points[index]), tuple(int(v) for v in points[index + 1]),
+                     label, thickness)
+        bands.append(band)
+    # OR keeps the overlap of both bands labelled 3
+    return (x0, y0, x1, y1), np.bitwise_or(bands[0], bands[1])
+
+
+class MapGuidedLaneDetector(object):
+    """Class fitting both lanes inside the map-guided search bands"""
+
+    def __init__(self, world_map, fov=90.0, degree=2, min_pixels=30, band_m=0.4, use_prior=True,
+                 **guide_params):
+        """
+        :param fov: camera field of view, used when the frame is not a carla.Image
+        :param use_prior: fall back to the map boundary for a lane with too few edge pixels
+        """
+        self.guide = MapLaneGuide(world_map, **guide_params)
+        self.fov = fov
+        self.degree = degree
+        self.min_pixels = min_pixels
+        self.band_m = band_m
+        self.use_prior = use_prior
+        self.camera_transform = None
+        self.preprocessor = LanePreprocessor()
+        self._intrinsics = {}
+
+    def _K(self, width, height, fov):
+        key = (width, height, fov)
+        if key not in self._intrinsics:
+            self._intrinsics[key] = build_projection_matrix(width, height, fov)
+        return self._intrinsics[key]
+
+    def detect(self, image, camera_transform=None, collector=None):
+        """
+        :param image: carla.Image, or a frame array with camera_transform given (or set on
+                      the detector)
+        :return: LaneResult; nothing detected when the camera is off the map
+        """
+        transform = camera_transform or getattr(image, 'transform', None) or self.camera_transform
+        frame = as_bgr_frame(image)
+        height, width = frame.shape[:2]
+        start = time.perf_counter()
+        if transform is None:
+            return LaneResult(timings={'guide': 0.0})
+        K = self._K(width, height, getattr(image, 'fov', self.fov))
+        projected = self.guide.project(transform, K)
+        roi = band_mask(projected, frame.shape, K[0, 0], self.band_m) if projected else None
+        guided = time.perf_counter()
+        if roi is None:
+            return LaneResult(timings={'guide': guided - start})
+
+        edges, (x0, y0) = self.preprocessor(frame, collector, roi)
+        preprocessed = time.perf_counter()
+        # findNonZero is several times faster than np.nonzero on a uint8 image
+        points = cv2.findNonZero(edges)
+        points = points.reshape(-1, 2) if points is not None else np.zeros((0, 2), dtype=np.int32)
+        labels = edges[points[:, 1], points[:, 0]]
+        xs = points[:, 0] + x0
+        ys = points[:, 1] + y0
+
+        models = []
+        coverages = []
+        for label, (pixels, _) in zip((LEFT_BAND, RIGHT_BAND), projected):
+            inside = labels == label
+            model = None
+            if np.count_nonzero(inside) >= self.min_pixels:
+                model = fit_lane_points(xs[inside], ys[inside], self.degree)
+            if model is not None:
+                rows = np.count_nonzero(np.bincount(ys[inside] - y0))
+                band_rows = max(np.ptp(pixels[:, 1]) if len(pixels) else 0, 1)
+                coverages.append(min(1.0, rows / float(band_rows)))
+            elif self.use_prior and len(pixels) > self.degree:
+                model = fit_lane_points(pixels[:, 0], pixels[:, 1], self.degree)
+            models.append(model)
+        fitted = time.perf_counter()
+        timings = {'guide': guided - start, 'preprocess': preprocessed - guided, 'fit': fitted - preprocessed}
+        if collector is not None:
+            collector.record('guide', timings['guide'], pixels=edges.size)
+            collector.record('fit', timings['fit'], edge_pixels=len(xs))
+        confidence = sum(coverages) / 2.0
+        return make_lane_result(models[0], models[1], height, width, confidence, timings)
@@ -0,0 +1,331 @@
+"""Pipelined execution of the lane stages over worker threads.
+
+Each stage runs on its own thread behind a bounded queue, so while frame N is in
+Hough and fitting, frame N+1 is preprocessed and frame N-1 is drawn. OpenCV releases
+the GIL, so the stages really overlap. One thread per stage and FIFO queues keep
+the frames in order; a full first queue drops the new frame instead of blocking the
+sensor callback.
+
+Example:
+    python Lane_Pipeline.py --res 1280x720 --frames 120
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from Lane_Detection import as_bgr_frame, to_surface
+from Lane_Profiling import start_timer
+
+
+_STOP = object()
+
+
+class FrameJob(object):
+    """One frame going through the pipeline, each stage adds its results"""
+
+    __slots__ = ('frame_id', 'image', 'frame', 'submitted', 'edges', 'origin', 'timings', 'result',
+                 'surface', 'detected')
+
+    def __init__(self, frame_id, image):
+        self.frame_id = frame_id
+        self.image = image  # keeps the carla.Image buffer alive while the frame is in flight
+        self.frame = None
+        self.submitted = time.perf_counter()
+        self.edges = None
+        self.origin = None
+        self.timings = None
+        self.result = None
+        self.surface = None
+        self.detected = None
+
+
+class _StageStats(object):
+    def __init__(self):
+        self.processed = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.max_seconds = 0.0
+        self.max_queued = 0
+
+
+class StagePipeline(object):
+    """
+    Class running a list of (name, function) stages on one thread each.
+
+    function(job) fills in the job; on_output(job) is called on the last stage's
+    thread, in submission order.
+    """
+
+    def __init__(self, stages, on_output=None, queue_size=2, block=False):
+        """
+        :param queue_size: jobs waiting in front of each stage
+        :param block: wait for room in the first queue instead of dropping the frame
+        """
+        self.stages = stages
+        self.on_output = on_output
+        self.block = block
+        self.dropped = 0
+        self.completed = 0
+        self._latency_sum = 0.0
+        self._latency_max = 0.0
+        self._stats = [_StageStats() for _ in stages]
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._threads = []
+        for index, (name, _) in enumerate(stages):
+            thread = threading.Thread(target=self._run, args=(index,), name='lane-%s' % name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, job):
+        """Queue a job; return False when it was dropped"""
+        try:
+            self._queues[0].put(job, block=self.block)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        return True
+
+    def _run(self, index):
+        name, function = self.stages[index]
+        inbox = self._queues[index]
+        outbox = self._queues[index + 1] if index + 1 < len(self._queues) else None
+        stats = self._stats[index]
+        while True:
+            job = inbox.get()
+            if job is _STOP:
+                if outbox is not None:
+                    outbox.put(_STOP)
+                return
+            stats.max_queued = max(stats.max_queued, inbox.qsize() + 1)
+            start = time.perf_counter()
+            try:
+                function(job)
+            except Exception:
+                stats.errors += 1
+                logging.exception('lane stage %s failed on frame %s', name, job.frame_id)
+                continue
+            seconds = time.perf_counter() - start
+            stats.processed += 1
+            stats.busy += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            if outbox is not None:
+                outbox.put(job)
+                continue
+            latency = time.perf_counter() - job.submitted
+            with self._lock:
+                self.completed += 1
+                self._latency_sum += latency
+                self._latency_max = max(self._latency_max, latency)
+            if self.on_output is not None:
+                self.on_output(job)
+
+    def stop(self, timeout=2.0):
+        """Finish the queued jobs and stop the threads"""
+        self._queues[0].put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        """Per-stage occupancy (busy fraction of the wall time), queue depth and latency"""
+        elapsed = max(time.perf_counter() - self._started, 1e-9)
+        stages = {}
+        for (name, _), stats, inbox in zip(self.stages, self._stats, self._queues):
+            stages[name] = {
+                'processed': stats.processed,
+                'errors': stats.errors,
+                'occupancy': stats.busy / elapsed,
+                'queued': inbox.qsize(),
+                'max_queued': stats.max_queued,
+                'mean_ms': 1000.0 * stats.busy / stats.processed if stats.processed else None,
+                'max_ms': 1000.0 * stats.max_seconds,
+            }
+        return {
+            'completed': self.completed,
+            'dropped': self.dropped,
+            'mean_latency_ms': 1000.0 * self._latency_sum / self.completed if self.completed else None,
+            'max_latency_ms': 1000.0 * self._latency_max,
+            'stages': stages,
+        }
+
+
+# ==============================================================================
+# -- Lane Pipeline -------------------------------------------------------------
+# ==============================================================================
+
+class LanePipeline(object):
+    """
+    Class running a lane strategy as a pipeline fed by sensor callbacks.
+
+    Strategies with a preprocessor of their own (make_preprocessor) are split into
+    preprocess / detect / render stages; the others keep detection in one stage,
+    overlapped with the rendering.
+    """
+
+    def __init__(self, strategy, on_result, draw_overlay=True, queue_size=2, block=False,
+                 on_detect=None, collector=None):
+        """
+        :param on_result: called with (frame_id, LaneResult, surface or None) in frame order
+        :param on_detect: called with the FrameJob on the detect thread as soon as its result
+                          is ready, before the rendering; for consumers of the result that
+                          should not wait for the overlay (lane keeping)
+        :param collector: optional Lane_Profiling.StageCollector, fed from the stage threads
+        """
+        self.strategy = strategy
+        self.on_result = on_result
+        self.on_detect = on_detect
+        self.draw_overlay = draw_overlay
+        self.collector = collector
+        self._frame_id = 0
+        self._slot = 0
+        stages = []
+        preprocessor = strategy.make_preprocessor()
+        if preprocessor is not None:
+            # The edge map is a preprocessor buffer, so every job in flight needs its own:
+            # one per queued job of both queues plus the one being written
+            self._preprocessors = [preprocessor] + [strategy.make_preprocessor()
+                                                    for _ in range(queue_size + 1)]
+            stages.append(('preprocess', self._preprocess))
+            stages.append(('detect', self._detect_edges))
+        else:
+            stages.append(('detect', self._detect))
+        if draw_overlay:
+            stages.append(('render', self._render))
+        self.pipeline = StagePipeline(stages, self._output, queue_size, block)
+
+    def submit(self, image):
+        """Sensor callback entry point, image is a carla.Image or a frame array"""
+        job = FrameJob(getattr(image, 'frame', self._frame_id), image)
+        self._frame_id += 1
+        return self.pipeline.submit(job)
+
+    def _preprocess(self, job):
+        job.frame = as_bgr_frame(job.image)
+        # Jobs leave this stage in order, so consecutive slots are never in flight together
+        preprocessor = self._preprocessors[self._slot]
+        self._slot = (self._slot + 1) % len(self._preprocessors)
+        start = time.perf_counter()
+        job.edges, job.origin = preprocessor(job.frame, self.collector)
+        job.timings = {'preprocess': time.perf_counter() - start}
+
+    def _detect_edges(self, job):
+        job.result = self.strategy.detect_edges(job.edges, job.origin, job.frame.shape, self.collector,
+                                                job.timings)
+        job.edges = None
+        self._detected(job)
+
+    def _detect(self, job):
+        job.frame = as_bgr_frame(job.image)
+        job.result = self.strategy.detect(job.image if self.strategy.needs_map else job.frame, self.collector)
+        self._detected(job)
+
+    def _detected(self, job):
+        job.detected = time.perf_counter()
+        if self.on_detect is not None:
+            self.on_detect(job)
+
+    def _render(self, job):
+        lane_img = self.strategy.render(job.frame, job.result, self.collector)
+        timer = start_timer(self.collector)
+        job.surface = to_surface(lane_img)
+        if timer is not None:
+            timer('surface')
+
+    def _output(self, job):
+        if self.collector is not None:
+            self.collector.frame()
+        self.on_result(job.frame_id, job.result, job.surface)
+
+    def stats(self):
+        return self.pipeline.stats()
+
+    def stop(self, timeout=2.0):
+        self.pipeline.stop(timeout)
+
+
+# ==============================================================================
+# -- main() --------------------------------------------------------------------
+# ==============================================================================
+
+def main():
+    """Main method"""
+
+    import Lane_Strategies
+    import Synthetic_Road
+
+    argparser = argparse.ArgumentParser(description='Sequential vs pipelined lane throughput')
+    argparser.add_argument(
+        '--strategy',
+        choices=Lane_Strategies.strategy_names(),
+        default=Lane_Strategies.DEFAULT_STRATEGY,
+        help='Lane strategy (default: %(default)s)')
+    argparser.add_argument(
+        '--res',
+        metavar='WIDTHxHEIGHT',
+        default='1280x720',
+        help='Frame resolution (default: 1280x720)')
+    argparser.add_argument(
+        '--frames',
+        default=120,
+        type=int,
+        help='Number of frames (default: 120)')
+    argparser.add_argument(
+        '--fps',
+        default=30.0,
+        type=float,
+        help='Camera frame rate of the latency run (default: 30)')
+    args = argparser.parse_args()
+    width, height = [int(x) for x in args.res.split('x')]
+
+    frames, _ = Synthetic_Road.make_scenario('straight_dashed', width, height, args.frames)
+    strategy = Lane_Strategies.get_strategy(args.strategy)
+
+    start = time.perf_counter()
+    for frame in frames:
+        to_surface(strategy.render(frame, strategy.detect(frame)))
+    sequential = time.perf_counter() - start
+    print('sequential: %.1f frames/s, %.2f ms/frame' % (
+        len(frames) / sequential, 1000.0 * sequential / len(frames)))
+
+    # Throughput: frames submitted as fast as the pipeline takes them
+    order = []
+    pipeline = LanePipeline(Lane_Strategies.get_strategy(args.strategy),
+                            lambda frame_id, result, surface: order.append(frame_id), block=True)
+    start = time.perf_counter()
+    for frame in frames:
+        pipeline.submit(frame)
+    pipeline.stop(timeout=None)
+    pipelined = time.perf_counter() - start
+    print('pipelined:  %.1f frames/s, in order: %s' % (
+        len(frames) / pipelined, order == sorted(order) and len(order) == len(frames)))
+    for name, stage in pipeline.stats()['stages'].items():
+        print('  %-10s occupancy=%.2f mean=%.2f ms max=%.2f ms max_queued=%d' % (
+            name, stage['occupancy'], stage['mean_ms'], stage['max_ms'], stage['max_queued']))
+
+    # Latency: frames arriving at the camera frame rate
+    pipeline = LanePipeline(Lane_Strategies.get_strategy(args.strategy), lambda *result: None)
+    interval = 1.0 / args.fps
+    start = time.perf_counter()
+    for index, frame in enumerate(frames):
+        time.sleep(max(start + index * interval - time.perf_counter(), 0.0))
+        pipeline.submit(frame)
+    pipeline.stop(timeout=None)
+    stats = pipeline.stats()
+    print('paced at %.1f frames/s: latency %.2f ms (max %.2f), %d dropped' % (
+        1.0 / interval, stats['mean_latency_ms'], stats['max_latency_ms'], stats['dropped']))
+
+
+if __name__ == '__main__':
+    main()
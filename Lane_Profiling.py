@@ -0,0 +1,170 @@
+"""Per-stage timings and sizes of the lane pipelines.
+
+Every lane stage that takes a collector argument records its time and sizes into
+it (pixels processed, segment count, fit residual...). With collector=None the
+pipelines only pay for a few `is None` checks.
+
+Example:
+    python Lane_Profiling.py --strategy sliding_window --scenario curved_left --save stages.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import threading
+import time
+
+import numpy as np
+
+
+# Upper edges of the stage time histogram bins, in milliseconds
+STAGE_BINS_MS = np.array([0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, np.inf])
+
+
+class StageTimer(object):
+    """Lap timer: each call records the time since the previous call as one stage"""
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.last = time.perf_counter()
+
+    def __call__(self, stage, **sizes):
+        now = time.perf_counter()
+        self.collector.record(stage, now - self.last, **sizes)
+        self.last = now
+
+
+class _StageStats(object):
+    """Running totals of one stage, memory does not grow with the run length"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.hist = np.zeros(len(STAGE_BINS_MS), dtype=np.int64)
+        self.size_sums = {}
+        self.size_max = {}
+
+
+class StageCollector(object):
+    """Class to aggregate the stage timings and sizes of a run, from any thread"""
+
+    def __init__(self):
+        self._stages = {}
+        self.frames = 0
+        self._lock = threading.Lock()
+
+    def timer(self):
+        return StageTimer(self)
+
+    def frame(self):
+        """Count one processed frame"""
+        with self._lock:
+            self.frames += 1
+
+    def record(self, stage, seconds, **sizes):
+        with self._lock:
+            self._record(stage, seconds, sizes)
+
+    def _record(self, stage, seconds, sizes):
+        stats = self._stages.get(stage)
+        if stats is None:
+            stats = self._stages[stage] = _StageStats()
+        stats.count += 1
+        stats.seconds += seconds
+        stats.max_seconds = max(stats.max_seconds, seconds)
+        stats.hist[np.searchsorted(STAGE_BINS_MS, 1000.0 * seconds)] += 1
+        for name, value in sizes.items():
+            if value is None:
+                continue
+            stats.size_sums[name] = stats.size_sums.get(name, 0.0) + value
+            stats.size_max[name] = max(stats.size_max.get(name, value), value)
+
+    def summary(self):
+        """Return the metrics per stage, slowest stage first"""
+        stages = {}
+        for stage, stats in sorted(self._stages.items(), key=lambda item: -item[1].seconds):
+            stages[stage] = {
+                'count': stats.count,
+                'mean_ms': 1000.0 * stats.seconds / stats.count,
+                'max_ms': 1000.0 * stats.max_seconds,
+                'ms_per_frame': 1000.0 * stats.seconds / self.frames if self.frames else None,
+                'histogram_ms': dict(zip([str(edge) for edge in STAGE_BINS_MS], stats.hist.tolist())),
+                'sizes': {name: {'mean': total / stats.count, 'max': stats.size_max[name]}
+                          for name, total in sorted(stats.size_sums.items())},
+            }
+        return {'frames': self.frames, 'stages': stages}
+
+    def save(self, path):
+        """Write the summary to a json file"""
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def print_summary(self):
+        summary = self.summary()
+        print('lane stages over %d frames' % summary['frames'])
+        for stage, m in summary['stages'].items():
+            print(('  %-12s mean=%.3f ms max=%.3f ms per frame=%s ms %s' % (
+                stage, m['mean_ms'], m['max_ms'],
+                '%.3f' % m['ms_per_frame'] if m['ms_per_frame'] is not None else '-',
+                ' '.join('%s=%.1f' % (name, s['mean']) for name, s in m['sizes'].items()))).rstrip())
+
+
+def start_timer(collector):
+    """StageTimer of a collector, or None when profiling is off"""
+    return StageTimer(collector) if collector is not None else None
+
+
+# ==============================================================================
+# -- main() --------------------------------------------------------------------
+# ==============================================================================
+
+def main():
+    """Main method"""
+
+    import Lane_Strategies
+    import Synthetic_Road
+
+    argparser = argparse.ArgumentParser(description='Profile the stages of a lane strategy')
+    argparser.add_argument(
+        '--strategy',
+        choices=Lane_Strategies.strategy_names(),
+        default=Lane_Strategies.DEFAULT_STRATEGY,
+        help='Lane strategy (default: %(default)s)')
+    argparser.add_argument(
+        '--scenario',
+        choices=sorted(Synthetic_Road.SCENARIOS),
+        default='straight_dashed',
+        help='Synthetic road scenario (default: %(default)s)')
+    argparser.add_argument(
+        '--res',
+        metavar='WIDTHxHEIGHT',
+        default='1280x720',
+        help='Frame resolution (default: 1280x720)')
+    argparser.add_argument(
+        '--frames',
+        default=60,
+        type=int,
+        help='Number of frames (default: 60)')
+    argparser.add_argument(
+        '--save',
+        metavar='PATH',
+        help='Write the stage summary to a json file')
+    args = argparser.parse_args()
+    width, height = [int(x) for x in args.res.split('x')]
+
+    frames, _ = Synthetic_Road.make_scenario(args.scenario, width, height, args.frames)
+    strategy = Lane_Strategies.get_strategy(args.strategy)
+    collector = StageCollector()
+    for frame in frames:
+        result = strategy.detect(frame, collector)
+        strategy.render(frame, result, collector)
+        collector.frame()
+    collector.print_summary()
+    if args.save:
+        collector.save(args.save)
+
+
+if __name__ == '__main__':
+    main()
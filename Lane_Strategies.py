@@ -0,0 +1,285 @@
+"""Registry of the lane detection strategies and a side-by-side comparison harness.
+
+Every strategy wraps one of the lane pipelines behind the same interface:
+detect(frame) returns a LaneResult, render(frame, result) draws it and reset()
+forgets any state kept between frames. detect and render take an optional
+Lane_Profiling.StageCollector for per-stage timings.
+
+Example:
+    python Lane_Strategies.py --strategies hough,sliding_window,tracker --frames 60
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+
+import Draft_code
+import Lane_Detection
+import Lane_DetectionDraft
+from Lane_MapGuide import MapGuidedLaneDetector
+from Lane_Profiling import start_timer
+from Lane_Tracking import LaneTracker
+
+
+LANE_STRATEGIES = {}
+
+DEFAULT_STRATEGY = 'hough'
+
+
+def register_strategy(name):
+    """Class decorator adding a LaneStrategy subclass to LANE_STRATEGIES"""
+    def register(cls):
+        cls.name = name
+        LANE_STRATEGIES[name] = cls
+        return cls
+    return register
+
+def get_strategy(name, **params):
+    """Create a strategy by name; params are forwarded to its constructor"""
+    if name not in LANE_STRATEGIES:
+        raise ValueError('unknown lane strategy %r, choose from %s' % (
+            name, ', '.join(sorted(LANE_STRATEGIES))))
+    return LANE_STRATEGIES[name](**params)
+
+def strategy_names(needs_map=False):
+    """
+    Registered names, the default strategy first.
+
+    :param needs_map: also list the strategies that need a CARLA map (world_map=...)
+    """
+    names = [name for name, cls in LANE_STRATEGIES.items() if needs_map or not cls.needs_map]
+    return [DEFAULT_STRATEGY] + sorted(set(names) - {DEFAULT_STRATEGY})
+
+
+# ==============================================================================
+# -- Strategies ----------------------------------------------------------------
+# ==============================================================================
+
+class LaneStrategy(object):
+    """Base class of the lane detection strategies"""
+
+    name = None
+    # Strategies that need the CARLA map take it as world_map and a carla.Image as frame
+    needs_map = False
+
+    def detect(self, frame, collector=None):
+        """
+        :param frame: HxWx3 BGR or HxWx4 BGRA image (or a carla.Image)
+        :param collector: optional Lane_Profiling.StageCollector
+        :return: LaneResult
+        """
+        raise NotImplementedError
+
+    def make_preprocessor(self):
+        """
+        A new edge preprocessor of this strategy, for pipelines running it as its own
+        stage before detect_edges(); None when detection is a single stage
+        """
+        return None
+
+    def detect_edges(self, edges, origin, shape, collector=None, timings=None):
+        """Detection on the (edges, origin) output of a make_preprocessor() preprocessor"""
+        raise NotImplementedError
+
+    def render(self, frame, result, collector=None):
+        """Draw a result of this strategy over a copy of the frame"""
+        timer = start_timer(collector)
+        lane_img = self.draw(frame, result)
+        if timer is not None:
+            timer('overlay')
+        return lane_img
+
+    def draw(self, frame, result):
+        return Lane_Detection.render_lane_overlay(frame, result)
+
+    def reset(self):
+        """Forget the state kept between frames (new video, respawn...)"""
+        pass
+
+
+@register_strategy('hough')
+class HoughStrategy(LaneStrategy):
+    """Straight lanes: HLS white filter, Hough segments and weighted line fits"""
+
+    def __init__(self, **preprocessor_params):
+        self.preprocessor_params = preprocessor_params
+        self.preprocessor = Lane_Detection.LanePreprocessor(**preprocessor_params)
+
+    def detect(self, frame, collector=None):
+        return Lane_Detection.detect_lanes(frame, self.preprocessor, collector)
+
+    def make_preprocessor(self):
+        return Lane_Detection.LanePreprocessor(**self.preprocessor_params)
+
+    def detect_edges(self, edges, origin, shape, collector=None, timings=None):
+        return Lane_Detection.lanes_from_edges(edges, origin, shape, collector, timings)
+
+
+@register_strategy('pyramid')
+class PyramidStrategy(LaneStrategy):
+    """Straight lanes: Hough on a half resolution ROI, refined in full resolution strips"""
+
+    def __init__(self, **detector_params):
+        self.detector = Lane_Detection.PyramidLaneDetector(**detector_params)
+
+    def detect(self, frame, collector=None):
+        return self.detector.detect(frame, collector)
+
+
+@register_strategy('angle_hough')
+class AngleHoughStrategy(LaneStrategy):
+    """Straight lanes: plain Canny and Hough segments filtered by angle and length"""
+
+    def detect(self, frame, collector=None):
+        return Draft_code.detect_lanes(frame, collector)
+
+
+@register_strategy('sliding_window')
+class SlidingWindowStrategy(LaneStrategy):
+    """Curved lanes: second order fits with sliding windows in the bird's-eye view"""
+
+    def __init__(self, **finder_params):
+        self.finder = Lane_DetectionDraft.SlidingWindowLaneFinder(**finder_params)
+
+    def detect(self, frame, collector=None):
+        return self.finder.detect(frame, collector)
+
+    def draw(self, frame, result):
+        if result.space != 'birdseye' or not result.detected:
+            return Lane_Detection.render_lane_overlay(frame, Lane_Detection.LaneResult())
+        lane_img = Lane_DetectionDraft.draw_polyfit(frame, result.left, result.right, self.finder.warp)
+        return Lane_Detection.render_lane_overlay(
+            lane_img, Lane_Detection.LaneResult(offset_px=int(round(result.offset_px))))
+
+    def reset(self):
+        self.finder.reset()
+
+
+@register_strategy('map_guided')
+class MapGuidedStrategy(LaneStrategy):
+    """Any lane shape: edge pixels fitted in search bands projected from the CARLA map"""
+
+    needs_map = True
+
+    def __init__(self, world_map, **detector_params):
+        self.detector = MapGuidedLaneDetector(world_map, **detector_params)
+
+    def detect(self, frame, collector=None):
+        return self.detector.detect(frame, collector=collector)
+
+
+@register_strategy('tracker')
+class TrackerStrategy(LaneStrategy):
+    """Straight lanes tracked from frame to frame with band searches around the previous fit"""
+
+    def __init__(self, **tracker_params):
+        self.tracker = LaneTracker(**tracker_params)
+
+    def detect(self, frame, collector=None):
+        return self.tracker.update(frame, collector)
+
+    def reset(self):
+        self.tracker.reset()
+
+
+# ==============================================================================
+# -- Comparison ----------------------------------------------------------------
+# ==============================================================================
+
+def compare_strategies(frames, names=None, reference=None, tolerance_px=20):
+    """
+    Run several strategies over the same frames.
+
+    :param names: strategy names, defaults to strategy_names()
+    :param reference: per-frame reference offsets in pixels (None where unknown), e.g.
+                      ground truth; defaults to the offsets of the first strategy
+    :param tolerance_px: offsets closer than this to the reference count as agreeing
+    :return: dict name -> metrics (latency in ms, detection rate, offset agreement and
+             the mean time of every stage the strategy reports)
+    """
+    names = list(names or strategy_names())
+    offsets = {}
+    latencies = {}
+    stages = {}
+    for name in names:
+        strategy = get_strategy(name)
+        strategy.detect(frames[0])  # Warm up caches and buffers
+        strategy.reset()
+        offsets[name] = np.full(len(frames), np.nan)
+        latencies[name] = np.zeros(len(frames))
+        stages[name] = {}
+        for index, frame in enumerate(frames):
+            start = time.perf_counter()
+            result = strategy.detect(frame)
+            latencies[name][index] = time.perf_counter() - start
+            for stage, seconds in result.timings.items():
+                stages[name][stage] = stages[name].get(stage, 0.0) + seconds
+            if result.detected:
+                offsets[name][index] = result.offset_px
+
+    if reference is None:
+        reference = offsets[names[0]]
+    else:
+        reference = np.array([np.nan if r is None else r for r in reference], dtype=np.float64)
+
+    results = {}
+    for name in names:
+        both = ~np.isnan(offsets[name]) & ~np.isnan(reference)
+        error = np.abs(offsets[name][both] - reference[both])
+        results[name] = {
+            'mean_ms': 1000.0 * latencies[name].mean(),
+            'p95_ms': 1000.0 * np.percentile(latencies[name], 95),
+            'detection_rate': float(np.mean(~np.isnan(offsets[name]))),
+            'mean_offset_error_px': float(error.mean()) if both.any() else float('nan'),
+            'agreement': float(np.mean(error <= tolerance_px)) if both.any() else float('nan'),
+        }
+        for stage, seconds in stages[name].items():
+            results[name]['%s_ms' % stage] = 1000.0 * seconds / len(frames)
+    return results
+
+def pick_strategy(results, min_detection_rate=0.9, min_agreement=0.8):
+    """Name of the fastest strategy that is good enough, or None"""
+    good = [name for name, metrics in results.items()
+            if metrics['detection_rate'] >= min_detection_rate
+            and not metrics['agreement'] < min_agreement]
+    return min(good, key=lambda name: results[name]['mean_ms']) if good else None
+
+
+# ==============================================================================
+# -- main() --------------------------------------------------------------------
+# ==============================================================================
+
+def main():
+    """Main method"""
+
+    from Lane_Benchmark import make_test_frames, print_table
+
+    argparser = argparse.ArgumentParser(description='Compare lane detection strategies')
+    argparser.add_argument(
+        '--strategies',
+        default=','.join(strategy_names()),
+        help='Comma separated strategies, the first one is the reference (default: %(default)s)')
+    argparser.add_argument(
+        '--res',
+        metavar='WIDTHxHEIGHT',
+        default='1280x720',
+        help='Frame resolution (default: 1280x720)')
+    argparser.add_argument(
+        '--frames',
+        default=30,
+        type=int,
+        help='Number of frames (default: 30)')
+    args = argparser.parse_args()
+    width, height = [int(x) for x in args.res.split('x')]
+
+    frames = make_test_frames(width, height, args.frames)
+    results = compare_strategies(frames, args.strategies.split(','))
+    print_table('lane strategies %dx%d' % (width, height), results)
+    print('fastest good enough: %s' % pick_strategy(results))
+
+
+if __name__ == '__main__':
+    main()
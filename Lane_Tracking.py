@@ -0,0 +1,125 @@
+"""Stateful lane tracking: search narrow bands around the previous lane models."""
+
+import time
+
+import numpy as np
+
+from Lane_Detection import (LanePreprocessor, as_bgr_frame, detect_lines, offset_lines, fit_lanes,
+                            fit_lane_points, fit_residual, make_lane_result, mean_residual)
+
+
+class LaneTracker(object):
+    """
+    Class to track the left and right lane models from frame to frame.
+
+    Without a confident previous fit it runs the full search (Hough over the whole
+    ROI). Once both lanes are known it only keeps the edge pixels inside a band of
+    +/- band_px around each previous model and refits them directly, skipping Hough.
+    Models are smoothed with an exponential moving average; a lane missing for more
+    than max_lost frames, or a confidence below min_confidence, falls back to the
+    full search.
+    """
+
+    def __init__(self, band_px=40, smoothing=0.5, max_lost=5, min_confidence=0.4,
+                 preprocessor=None, degree=1):
+        """
+        :param band_px: half width of the search band around each previous lane, in pixels
+        :param smoothing: weight of the new measurement in the moving average (1 = no smoothing)
+        :param max_lost: frames a lane may be missing before a full search
+        :param min_confidence: confidence under which the next frame uses a full search
+        :param degree: polynomial degree of the lane models in tracking mode
+        """
+        self.band_px = band_px
+        self.smoothing = smoothing
+        self.max_lost = max_lost
+        self.min_confidence = min_confidence
+        self.degree = degree
+        self.preprocessor = preprocessor or LanePreprocessor()
+        self.reset()
+
+    def reset(self):
+        self.left = None
+        self.right = None
+        self.confidence = 0.0
+        self.tracking = False
+        self._lost = [0, 0]
+        self.full_searches = 0
+        self.band_searches = 0
+
+    # ---------- Search Modes ----------
+    def _full_search(self, edges, origin, height, width):
+        self.full_searches += 1
+        lines = offset_lines(detect_lines(edges), origin)
+        left, right, _ = fit_lanes(lines, height, width)
+        return [left, right]
+
+    def _band_search(self, xs, ys):
+        self.band_searches += 1
+        models = []
+        for previous in (self.left, self.right):
+            inside = np.abs(xs - np.polyval(previous, ys)) <= self.band_px
+            models.append(fit_lane_points(xs[inside], ys[inside], self.degree))
+        return models
+
+    def _support(self, model, xs, ys, num_rows):
+        """Fraction of ROI rows that have edge pixels close to a model"""
+        if model is None or len(ys) == 0:
+            return 0.0
+        inside = np.abs(xs - np.polyval(model, ys)) <= self.band_px / 2.0
+        rows = np.unique(ys[inside]).size
+        return min(1.0, rows / float(num_rows))
+
+    # ---------- Update ----------
+    def _smooth(self, previous, measured):
+        if previous is None or measured is None or len(previous) != len(measured):
+            return measured
+        return self.smoothing * measured + (1.0 - self.smoothing) * previous
+
+    def update(self, frame, collector=None):
+        """
+        Process one frame.
+
+        :param frame: HxWx3 BGR or HxWx4 BGRA image (or a carla.Image)
+        :param collector: optional Lane_Profiling.StageCollector
+        :return: LaneResult
+        """
+        frame = as_bgr_frame(frame)
+        height, width = frame.shape[:2]
+        start = time.perf_counter()
+        edges, origin = self.preprocessor(frame, collector)
+        preprocessed = time.perf_counter()
+        # Edge pixels in full image coordinates, shared by the band search and the confidence
+        ys, xs = np.nonzero(edges)
+        xs = xs + origin[0]
+        ys = ys + origin[1]
+
+        stage = 'band_search' if self.tracking else 'full_search'
+        if self.tracking:
+            measured = self._band_search(xs, ys)
+        else:
+            measured = self._full_search(edges, origin, height, width)
+        searched = time.perf_counter()
+
+        previous = [self.left, self.right]
+        for side in (0, 1):
+            if measured[side] is None:
+                self._lost[side] += 1
+                if self._lost[side] > self.max_lost:
+                    previous[side] = None
+            else:
+                self._lost[side] = 0
+                previous[side] = self._smooth(previous[side] if self.tracking else None, measured[side])
+        self.left, self.right = previous
+
+        supports = [self._support(model, xs, ys, edges.shape[0]) for model in (self.left, self.right)]
+        self.confidence = 0.5 * (supports[0] + supports[1])
+        self.tracking = (self.left is not None and self.right is not None
+                         and self.confidence >= self.min_confidence)
+        timings = {'preprocess': preprocessed - start, 'track': time.perf_counter() - preprocessed}
+        if collector is not None:
+            near = [np.abs(xs - np.polyval(model, ys)) <= self.band_px if model is not None else None
+                    for model in measured]
+            collector.record(stage, searched - preprocessed, edge_pixels=len(xs),
+                             residual=mean_residual([fit_residual(model, xs[inside], ys[inside])
+                                                     for model, inside in zip(measured, near)]))
+        return make_lane_result(self.left, self.right, height, width, self.confidence, timings)
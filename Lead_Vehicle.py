@@ -0,0 +1,180 @@
+"""Lane-aware search of the vehicle driving ahead in the ego lane.
+
+The cone test of change_speed takes any vehicle within 10 m and 90 degrees as the
+leader, oncoming traffic in the next lane included. LeadVehicleIndex puts the
+vehicles within search range of the ego (from the proximity grid of the tick) in a
+bucket per (road_id, lane_id), sorted by their s along the lane, and looks for the
+leader only in the ego lane and, near its end, the lanes that follow
+(Lane_Graph.LaneGraph). The lane of a vehicle is computed once per tick, however
+many egos look at it, and the waypoint lookups are cached by quantized location:
+vehicles keep driving over the same lane cells, so once the cache is warm a tick
+costs no map queries.
+
+Example:
+    leads = LeadVehicleIndex(world.get_map())
+    lead = leads.leader(table, table.row(ego.id), 30.0)
+    if lead is not None and lead[0] is not None:
+        row, gap, closing_speed = lead
+"""
+
+import bisect
+import math
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from Actor_Snapshot import VEHICLE, VX, VY, YAW
+from Lane_Graph import LaneGraph
+
+
+# Half length of a vehicle whose bounding box is unknown, about a mid-size car
+DEFAULT_HALF_LENGTH = 2.25
+
+
+class _LaneCell(object):
+    """Cached waypoint of a quantized location: its lane, s and driving direction"""
+
+    __slots__ = ('key', 'waypoint', 's', 'x', 'y', 'along_x', 'along_y')
+
+    def __init__(self, waypoint):
+        self.key = (waypoint.road_id, waypoint.lane_id)
+        self.waypoint = waypoint
+        self.s = waypoint.s
+        location = waypoint.transform.location
+        yaw = math.radians(waypoint.transform.rotation.yaw)
+        self.x, self.y = location.x, location.y
+        # Negative lane ids drive towards increasing s, positive ones against it, so
+        # moving along the waypoint yaw changes s by +-1 per meter
+        sign = 1.0 if waypoint.lane_id < 0 else -1.0
+        self.along_x, self.along_y = sign * math.cos(yaw), sign * math.sin(yaw)
+
+    def s_at(self, x, y):
+        """s of a point of the cell, projected on the waypoint direction"""
+        return self.s + (x - self.x) * self.along_x + (y - self.y) * self.along_y
+
+
+class LeadVehicleIndex(object):
+    """
+    Class bucketing the vehicles around an ego by lane to find its leader along the lane.
+
+    hits / misses count the cached waypoint lookups.
+    """
+
+    def __init__(self, world_map, quantum=1.0, max_size=32768, step=2.0):
+        """
+        :param quantum: cell size of the waypoint cache in meters
+        :param max_size: cached cells, least recently used first out; a town's driving
+                         lanes at 1 m are in the order of 10^4 cells
+        :param step: waypoint spacing used to walk to the end of a lane
+        """
+        import carla
+        self._location = carla.Location
+        self.map = world_map
+        self.quantum = quantum
+        self.max_size = max_size
+        self.lanes = LaneGraph(step)
+        self.table = None
+        self.hits = 0
+        self.misses = 0
+        self._cells = OrderedDict()
+        self._vehicles = {}
+        self._buckets = {}
+        self._actors = None
+        self._half_lengths = np.zeros(0)
+
+    def _cell(self, x, y, z):
+        """_LaneCell of a location, None off the road"""
+        key = (int(math.floor(x / self.quantum)), int(math.floor(y / self.quantum)))
+        if key in self._cells:
+            self.hits += 1
+            self._cells.move_to_end(key)
+            return self._cells[key]
+        self.misses += 1
+        location = self._location(x=(key[0] + 0.5) * self.quantum, y=(key[1] + 0.5) * self.quantum, z=z)
+        waypoint = self.map.get_waypoint(location)
+        cell = self._cells[key] = _LaneCell(waypoint) if waypoint is not None else None
+        if len(self._cells) > self.max_size:
+            self._cells.popitem(last=False)
+        return cell
+
+    def update(self, table):
+        """Start a new tick from an Actor_Snapshot.ActorTable"""
+        if table.actors is not self._actors:
+            # Bounding boxes are part of the actor description, read once per layout
+            self._actors = table.actors
+            self._half_lengths = np.array([
+                actor.bounding_box.extent.x if actor is not None and hasattr(actor, 'bounding_box')
+                else DEFAULT_HALF_LENGTH for actor in table.actors], dtype=np.float64)
+        self._vehicles = {}
+        self.table = table
+
+    def _vehicle(self, row):
+        """(_LaneCell, s) of a vehicle row of the tick, None off the road"""
+        if row in self._vehicles:
+            return self._vehicles[row]
+        x, y, z = self.table.locations[row].tolist()
+        cell = self._cell(x, y, z)
+        vehicle = self._vehicles[row] = (cell, cell.s_at(x, y)) if cell is not None else None
+        return vehicle
+
+    def _bucket(self, rows):
+        """Bucket vehicle rows by lane, sorted by s"""
+        buckets = defaultdict(lambda: ([], []))
+        for row in rows.tolist():
+            vehicle = self._vehicle(row)
+            if vehicle is None:
+                continue
+            cell, s = vehicle
+            bucket_s, bucket_rows = buckets[cell.key]
+            index = bisect.bisect(bucket_s, s)
+            bucket_s.insert(index, s)
+            bucket_rows.insert(index, row)
+        self._buckets = dict(buckets)
+
+    def _on_lane(self, key, s, budget):
+        """Closest vehicle ahead of s on one lane within budget meters: (row, distance)"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return None, None
+        bucket_s, bucket_rows = bucket
+        # Strictly ahead, which also leaves out the ego itself
+        if key[1] < 0:
+            index = bisect.bisect_right(bucket_s, s)
+            if index < len(bucket_s) and bucket_s[index] - s <= budget:
+                return bucket_rows[index], bucket_s[index] - s
+        else:
+            index = bisect.bisect_left(bucket_s, s) - 1
+            if index >= 0 and s - bucket_s[index] <= budget:
+                return bucket_rows[index], s - bucket_s[index]
+        return None, None
+
+    def leader(self, table, ego_row, max_distance=30.0):
+        """
+        Leading vehicle of the ego along its lane, updating the buckets when the
+        table is a new one.
+
+        :param max_distance: search range along the lanes, center to center; a leader
+                             that far along the lanes is at most that far in a
+                             straight line, so only the grid cells within it are
+                             bucketed
+        :return: (row, gap, closing_speed), row None when nobody leads within range;
+                 None when the ego itself is not on a lane. gap is bumper to bumper
+                 in meters, closing_speed in m/s along the ego heading, positive when
+                 the ego is catching up
+        """
+        if table is not self.table:
+            self.update(table)
+        ego = self._vehicle(ego_row)
+        if ego is None:
+            return None
+        cell, s = ego
+        nearby = table.grid.candidates(table.locations[ego_row], max_distance)
+        self._bucket(nearby[table.mask(VEHICLE)[nearby]])
+        row, distance = self.lanes.search(cell.waypoint, max_distance, self._on_lane, s=s)
+        if row is None:
+            return None, None, None
+        gap = max(float(distance - self._half_lengths[ego_row] - self._half_lengths[row]), 0.0)
+        yaw = math.radians(table.data[ego_row, YAW])
+        forward = np.array([math.cos(yaw), math.sin(yaw)])
+        closing_speed = float((table.data[ego_row, VX:VY + 1] - table.data[row, VX:VY + 1]).dot(forward))
+        return row, gap, closing_speed
@@ -0,0 +1,330 @@
+"""Bird's-eye occupancy raster around the ego, for free-space queries.
+
+OccupancyGrid keeps a square uint8 raster centered on the ego and aligned with its
+heading, forward up: row 0 is size / 2 meters ahead, the ego sits in the middle.
+Every tick the oriented bounding boxes of the actors near the ego are stamped into
+it from the ActorTable, as one NumPy inside-the-box test over a window of cells
+per box for all the boxes together, and only the cells stamped the tick before are
+cleared. The driving lane and sidewalk layers are rasterized from the map once
+(Drivable_Area.DrivableArea) and warped into the ego frame, again only when the
+ego moved by more than half a cell.
+
+"Is the corridor ahead free for X m" is then a count over a slice of the raster:
+its cost depends on the corridor size, not on the number of actors.
+
+Example:
+    occupancy = OccupancyGrid(world.get_map())
+    occupancy.update(table, table.row(ego.id))
+    if occupancy.corridor_free(15.0): ...
+    cv2.imshow('occupancy', occupancy.to_image())
+"""
+
+from __future__ import print_function
+
+import glob
+import os
+import sys
+
+try:
+    sys.path.append(glob.glob('../carla/dist/carla-*%d.%d-%s.egg' % (
+        sys.version_info.major,
+        sys.version_info.minor,
+        'win-amd64' if os.name == 'nt' else 'linux-x86_64'))[0])
+except IndexError:
+    pass
+
+import argparse
+import math
+import time
+
+import numpy as np
+import cv2
+
+from Actor_Snapshot import VEHICLE, WALKER, X, Y, YAW
+from Drivable_Area import DrivableArea
+
+
+# Cell values of the dynamic layer
+FREE = 0
+OCCUPIED_VEHICLE = 1
+OCCUPIED_WALKER = 2
+
+# Half extents (length, width) of actors without a bounding box
+_DEFAULT_EXTENTS = {VEHICLE: (2.25, 1.0), WALKER: (0.3, 0.3)}
+
+# BGR colors of the debug image
+_COLORS = {
+    'lane': (70, 70, 70),
+    'sidewalk': (120, 110, 100),
+    OCCUPIED_VEHICLE: (60, 60, 230),
+    OCCUPIED_WALKER: (40, 210, 240),
+    'ego': (80, 200, 80),
+}
+
+
+class OccupancyGrid(object):
+    """
+    Class holding the ego-centric occupancy raster of one tick.
+
+    occupancy: (cells, cells) uint8, FREE / OCCUPIED_VEHICLE / OCCUPIED_WALKER
+    lanes, sidewalks: (cells, cells) uint8 static layers in the same frame, None
+                      without a map (or when the map is too large to rasterize)
+    A point forward / right of the ego (ego frame, meters) is cell
+    (half - forward / resolution, half + right / resolution).
+    """
+
+    def __init__(self, world_map=None, size=60.0, resolution=0.25, pose_tolerance=1.0):
+        """
+        :param size: side of the raster in meters
+        :param resolution: cell size in meters
+        :param pose_tolerance: heading change in degrees that re-warps the static layers
+        """
+        self.resolution = float(resolution)
+        self.cells = int(round(size / self.resolution))
+        self.half = self.cells / 2.0
+        self.size = self.cells * self.resolution
+        self.pose_tolerance = pose_tolerance
+        self.occupancy = np.zeros((self.cells, self.cells), dtype=np.uint8)
+        self.lanes = None
+        self.sidewalks = None
+        self.ego_extent = _DEFAULT_EXTENTS[VEHICLE]
+        self.frame = None
+        self._world_lanes = None
+        self._world_sidewalks = None
+        if world_map is not None:
+            import carla
+            self._world_lanes = DrivableArea.from_map(world_map, self.resolution)
+            self._world_sidewalks = DrivableArea.from_map(world_map, self.resolution,
+                                                          lane_type=carla.LaneType.Sidewalk)
+            # Large maps fall back to a waypoint cache, which cannot be warped
+            if not isinstance(self._world_lanes, DrivableArea):
+                self._world_lanes = None
+            if not isinstance(self._world_sidewalks, DrivableArea):
+                self._world_sidewalks = None
+        self._painted = np.zeros(0, dtype=np.int64)
+        self._static_pose = None
+        self._actors = None
+        self._extents = np.zeros((0, 4))
+
+    def _box_extents(self, table):
+        """(N, 4) half length, half width, x and y offset of the boxes, once per layout"""
+        if table.actors is not self._actors:
+            self._actors = table.actors
+            extents = []
+            for actor, kind in zip(table.actors, table.kinds.tolist()):
+                box = getattr(actor, 'bounding_box', None) if actor is not None else None
+                if box is not None:
+                    extents.append((box.extent.x, box.extent.y, box.location.x, box.location.y))
+                else:
+                    extents.append(_DEFAULT_EXTENTS.get(kind, (0.5, 0.5)) + (0.0, 0.0))
+            self._extents = np.array(extents, dtype=np.float64).reshape(-1, 4)
+        return self._extents
+
+    def update(self, table, ego_row):
+        """Stamp the actors of an Actor_Snapshot.ActorTable around the ego of ego_row"""
+        self.frame = table.frame
+        ego_x, ego_y, ego_yaw = table.data[ego_row, [X, Y, YAW]].tolist()
+        yaw = math.radians(ego_yaw)
+        forward = np.array([math.cos(yaw), math.sin(yaw)])
+        right = np.array([-math.sin(yaw), math.cos(yaw)])
+        extents = self._box_extents(table)
+        self.ego_extent = tuple(extents[ego_row, :2].tolist())
+
+        self.occupancy.flat[self._painted] = FREE
+        self._painted = np.zeros(0, dtype=np.int64)
+        # Everything whose box can reach the raster, corners included
+        mask = table.mask(VEHICLE) | table.mask(WALKER)
+        rows, _ = table.grid.query((ego_x, ego_y), self.size * 0.75, rows=mask, exclude=ego_row,
+                                   planar=True)
+        if len(rows):
+            self._stamp(table, rows, extents[rows], np.array([ego_x, ego_y]), forward, right)
+        self._update_static(ego_x, ego_y, ego_yaw, forward, right)
+
+    def _stamp(self, table, rows, extents, ego, forward, right):
+        """Rasterize the oriented boxes of rows: the cells of a window around each box
+        whose centers fall inside it, grown by half a cell, all boxes at once"""
+        yaws = np.radians(table.data[rows, YAW])
+        cos, sin = np.cos(yaws), np.sin(yaws)
+        # Box centers in the ego frame, in meters and in cells
+        world_x = table.data[rows, X] + extents[:, 2] * cos - extents[:, 3] * sin - ego[0]
+        world_y = table.data[rows, Y] + extents[:, 2] * sin + extents[:, 3] * cos - ego[1]
+        box_forward = world_x * forward[0] + world_y * forward[1]
+        box_right = world_x * right[0] + world_y * right[1]
+        center_rows = np.floor(self.half - box_forward / self.resolution).astype(np.int64)
+        center_cols = np.floor(self.half + box_right / self.resolution).astype(np.int64)
+        # Box axes in the ego frame
+        relative = yaws - math.atan2(forward[1], forward[0])
+        axis_cos, axis_sin = np.cos(relative)[:, None], np.sin(relative)[:, None]
+
+        reach = int(math.ceil(np.hypot(extents[:, 0], extents[:, 1]).max() / self.resolution)) + 1
+        steps = np.arange(-reach, reach + 1)
+        window_rows, window_cols = [w.ravel() for w in np.meshgrid(steps, steps, indexing='ij')]
+        cell_rows = center_rows[:, None] + window_rows[None, :]
+        cell_cols = center_cols[:, None] + window_cols[None, :]
+        offset_forward = (self.half - cell_rows - 0.5) * self.resolution - box_forward[:, None]
+        offset_right = (cell_cols + 0.5 - self.half) * self.resolution - box_right[:, None]
+        along = offset_forward * axis_cos + offset_right * axis_sin
+        across = offset_right * axis_cos - offset_forward * axis_sin
+        grow = 0.5 * self.resolution
+        inside = ((np.abs(along) <= extents[:, 0:1] + grow) & (np.abs(across) <= extents[:, 1:2] + grow)
+                  & (cell_rows >= 0) & (cell_rows < self.cells) & (cell_cols >= 0) & (cell_cols < self.cells))
+        values = np.where(table.kinds[rows] == WALKER, OCCUPIED_WALKER, OCCUPIED_VEHICLE).astype(np.uint8)
+        values = np.broadcast_to(values[:, None], inside.shape)
+        flat = cell_rows[inside] * self.cells + cell_cols[inside]
+        self.occupancy.flat[flat] = values[inside]
+        self._painted = flat
+
+    def _update_static(self, ego_x, ego_y, ego_yaw, forward, right):
+        """Warp the map layers into the ego frame when the ego moved enough"""
+        if self._world_lanes is None and self._world_sidewalks is None:
+            return
+        if self._static_pose is not None:
+            last_x, last_y, last_yaw = self._static_pose
+            turned = abs((ego_yaw - last_yaw + 180.0) % 360.0 - 180.0)
+            if (math.hypot(ego_x - last_x, ego_y - last_y) < 0.5 * self.resolution
+                    and turned < self.pose_tolerance):
+                return
+        self._static_pose = (ego_x, ego_y, ego_yaw)
+        self.lanes = self._warp(self._world_lanes, ego_x, ego_y, forward, right)
+        self.sidewalks = self._warp(self._world_sidewalks, ego_x, ego_y, forward, right)
+
+    def _warp(self, area, ego_x, ego_y, forward, right):
+        """Ego frame raster of a DrivableArea, nearest cell"""
+        if area is None:
+            return None
+        # Ego cell (col, row) -> world raster pixel, pixel centers at integer coordinates
+        scale = self.resolution / area.resolution
+        offset = scale * (0.5 - self.half)
+        matrix = np.array([
+            [scale * right[0], -scale * forward[0], (ego_x - area.origin[0]) / area.resolution - 0.5
+             + offset * (right[0] - forward[0])],
+            [scale * right[1], -scale * forward[1], (ego_y - area.origin[1]) / area.resolution - 0.5
+             + offset * (right[1] - forward[1])],
+        ])
+        return cv2.warpAffine(area.raster, matrix, (self.cells, self.cells),
+                              flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    def _corridor(self, length, width, margin):
+        """Raster slice of the corridor in front of the ego bumper"""
+        if width is None:
+            width = 2.0 * self.ego_extent[1]
+        width += 2.0 * margin
+        front = int(math.floor(self.half - self.ego_extent[0] / self.resolution))
+        start = max(front - int(math.ceil(length / self.resolution)), 0)
+        half_width = int(math.ceil(0.5 * width / self.resolution))
+        center = int(self.half)
+        return self.occupancy[start:front, max(center - half_width, 0):center + half_width]
+
+    def corridor_free(self, length, width=None, margin=0.2):
+        """
+        :param length: corridor length in meters ahead of the ego bumper
+        :param width: corridor width in meters, defaults to the ego width
+        :param margin: extra clearance on each side in meters
+        :return: True when no actor occupies the corridor
+        """
+        return not np.count_nonzero(self._corridor(length, width, margin))
+
+    def free_distance(self, max_length=None, width=None, margin=0.2):
+        """Free length in meters ahead of the ego bumper, up to max_length"""
+        if max_length is None:
+            max_length = self.size / 2.0 - self.ego_extent[0]
+        corridor = self._corridor(max_length, width, margin)
+        occupied = np.flatnonzero(corridor.any(axis=1))
+        if not len(occupied):
+            return float(len(corridor) * self.resolution)
+        # Rows run from far to near, the last occupied row is the closest
+        return float((len(corridor) - 1 - occupied[-1]) * self.resolution)
+
+    def to_image(self, scale=2):
+        """BGR debug image of the layers, forward up"""
+        image = np.zeros((self.cells, self.cells, 3), dtype=np.uint8)
+        if self.sidewalks is not None:
+            image[self.sidewalks != 0] = _COLORS['sidewalk']
+        if self.lanes is not None:
+            image[self.lanes != 0] = _COLORS['lane']
+        for value in (OCCUPIED_VEHICLE, OCCUPIED_WALKER):
+            image[self.occupancy == value] = _COLORS[value]
+        length, width = self.ego_extent
+        top_left = (int(self.half - width / self.resolution), int(self.half - length / self.resolution))
+        bottom_right = (int(self.half + width / self.resolution), int(self.half + length / self.resolution))
+        cv2.rectangle(image, top_left, bottom_right, _COLORS['ego'], -1)
+        if scale != 1:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST)
+        return image
+
+
+# ==============================================================================
+# -- main() --------------------------------------------------------------------
+# ==============================================================================
+
+def main():
+    """Main method"""
+
+    argparser = argparse.ArgumentParser(description='Occupancy raster around the hero vehicle')
+    argparser.add_argument(
+        '--host',
+        metavar='H',
+        default='127.0.0.1',
+        help='IP of the host server (default: 127.0.0.1)')
+    argparser.add_argument(
+        '-p', '--port',
+        metavar='P',
+        default=2000,
+        type=int,
+        help='TCP port to listen to (default: 2000)')
+    argparser.add_argument(
+        '--size',
+        default=60.0,
+        type=float,
+        help='Raster side in meters (default: 60)')
+    argparser.add_argument(
+        '--resolution',
+        default=0.25,
+        type=float,
+        help='Cell size in meters (default: 0.25)')
+    argparser.add_argument(
+        '--corridor',
+        default=15.0,
+        type=float,
+        help='Corridor length checked ahead, in meters (default: 15)')
+    args = argparser.parse_args()
+
+    import carla
+    from Actor_Snapshot import ActorSnapshotService
+
+    client = carla.Client(args.host, args.port)
+    client.set_timeout(10.0)
+    world = client.get_world()
+    vehicles = world.get_actors().filter('vehicle.*')
+    heroes = [v for v in vehicles if v.attributes.get('role_name') == 'hero'] or list(vehicles)
+    if not heroes:
+        print('No vehicle to follow')
+        return
+    ego = heroes[0]
+    snapshots = ActorSnapshotService(world)
+    occupancy = OccupancyGrid(world.get_map(), args.size, args.resolution)
+    try:
+        while True:
+            table = snapshots.update(world.wait_for_tick(10.0))
+            row = table.row(ego.id)
+            if row is None:
+                break
+            start = time.perf_counter()
+            occupancy.update(table, row)
+            updated = time.perf_counter()
+            free = occupancy.corridor_free(args.corridor)
+            queried = time.perf_counter()
+            image = occupancy.to_image()
+            cv2.putText(image, 'update %.2f ms, query %.3f ms, %s' % (
+                1000.0 * (updated - start), 1000.0 * (queried - updated), 'free' if free else 'blocked'),
+                (5, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 255, 255), 1)
+            cv2.imshow('occupancy', image)
+            if cv2.waitKey(1) & 0xFF in (27, ord('q')):
+                break
+    finally:
+        cv2.destroyAllWindows()
+
+
+if __name__ == '__main__':
+    main()
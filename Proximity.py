@@ -0,0 +1,96 @@
+"""Uniform grid over the actor positions for "what is ahead of me" queries.
+
+The grid is rebuilt every tick with one argsort of the cell keys: the rows of the
+actors are sorted by cell, so the actors of a cell are one contiguous slice found
+with searchsorted. A query only visits the cells overlapping its radius, then runs
+the exact distance and forward cone tests on those candidates as array operations,
+comparing against cosine thresholds instead of calling acos per target. The cost of
+a query grows with the actors nearby, not with all the actors of the town.
+
+Example:
+    grid = ProximityGrid(table.locations)
+    rows, distances = grid.query(ego_location, 20.0, forward=ego_forward, max_angle=90)
+"""
+
+import math
+
+import numpy as np
+
+
+# Cell keys pack (cx, cy) into one int64; CARLA towns are far smaller than this
+_KEY_SPAN = 1 << 20
+
+
+class ProximityGrid(object):
+    """
+    Class indexing (N, 3) positions by square cells of the XY plane.
+
+    Query results are row indices into the positions, so they index the
+    ActorTable the positions come from.
+    """
+
+    def __init__(self, positions, cell_size=10.0):
+        """
+        :param positions: (N, 3) world positions (or (N, 2))
+        :param cell_size: cell side in meters, about the typical query radius
+        """
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.cell_size = float(cell_size)
+        cells = np.floor(self.positions[:, :2] / self.cell_size).astype(np.int64)
+        keys = self._keys(cells[:, 0], cells[:, 1])
+        self._order = np.argsort(keys, kind='stable')
+        self._keys_sorted = keys[self._order]
+
+    @staticmethod
+    def _keys(cx, cy):
+        return (cx + _KEY_SPAN // 2) * _KEY_SPAN + (cy + _KEY_SPAN // 2)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def candidates(self, center, radius):
+        """Rows of the cells overlapping the square around center, in no useful order"""
+        if not len(self.positions):
+            return self._order[:0]
+        x0, y0 = (int(math.floor((center[axis] - radius) / self.cell_size)) for axis in (0, 1))
+        x1, y1 = (int(math.floor((center[axis] + radius) / self.cell_size)) for axis in (0, 1))
+        # Cells of a column are consecutive keys, so each column is one searchsorted range
+        columns = np.arange(x0, x1 + 1, dtype=np.int64)
+        starts = np.searchsorted(self._keys_sorted, self._keys(columns, y0), side='left')
+        ends = np.searchsorted(self._keys_sorted, self._keys(columns, y1), side='right')
+        if len(columns) == 1:
+            return self._order[starts[0]:ends[0]]
+        return np.concatenate([self._order[start:end] for start, end in zip(starts, ends) if end > start]
+                              or [self._order[:0]])
+
+    def query(self, center, radius, forward=None, max_angle=None, rows=None, exclude=None,
+              planar=False):
+        """
+        Targets within radius of center and, with forward, inside the cone of
+        half angle max_angle (degrees) around it.
+
+        :param forward: forward vector of the ego, e.g. Transform.get_forward_vector(); with
+                        planar only its XY part is used, normalized
+        :param rows: optional boolean mask over all rows (e.g. one actor kind)
+        :param exclude: row to leave out, usually the ego itself
+        :param planar: measure distances and angles in the XY plane only
+        :return: rows and distances of the targets, closest first
+        """
+        candidates = self.candidates(center, radius)
+        if rows is not None:
+            candidates = candidates[rows[candidates]]
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+        dims = 2 if planar else self.positions.shape[1]
+        offsets = self.positions[candidates, :dims] - np.asarray(center, dtype=np.float64)[:dims]
+        squared = np.einsum('ij,ij->i', offsets, offsets)
+        keep = (squared <= radius * radius) & (squared > 0.0)
+        if forward is not None and max_angle is not None:
+            # angle < max_angle  <=>  offset . forward > |offset| cos(max_angle)
+            forward = np.asarray(forward, dtype=np.float64)[:dims]
+            dots = offsets.dot(forward / np.linalg.norm(forward))
+            keep &= dots > np.sqrt(squared) * math.cos(math.radians(max_angle))
+        candidates = candidates[keep]
+        distances = np.sqrt(squared[keep])
+        order = np.argsort(distances, kind='stable')
+        return candidates[order], distances[order]
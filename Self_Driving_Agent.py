@@ -96,11 +96,19 @@ class SelfDrivingAgent(BehaviorAgent):
         :param world: The Carla world object.
         :param speed_limit: The speed limit for the agent in km/h.
         """
-        self.speed = get_speed(self.vehicle)
+        # The ego state (Ego_State) or the actor table (Actor_Snapshot) of the tick
+        # already have the speed
+        ego = getattr(world, 'ego_state', None)
+        snapshot = getattr(world, 'snapshot', None)
+        if ego is not None:
+            speed = ego.speed
+        else:
+            speed = snapshot.speed(self.vehicle.id) if snapshot is not None else None
+        self.speed = 3.6 * speed if speed is not None else get_speed(self.vehicle)
         if speed_limit is not None:
             self.speed_limit = speed_limit
         else:
-            self.speed_limit = self.vehicle.get_speed_limit()
+            self.speed_limit = ego.speed_limit if ego is not None else self.vehicle.get_speed_limit()
         self._local_planner.set_speed(self.speed_limit)
         self.direction = self._local_planner.target_road_option
         if self.direction is None:
@@ -110,13 +118,14 @@ class SelfDrivingAgent(BehaviorAgent):
 
         self.incoming_waypoint, self.incoming_direction = self._local_planner.get_incoming_waypoint_and_direction(
             steps=self.look_ahead_steps)
-        self.is_at_traffic_light = world.player.is_at_traffic_light()
+        self.is_at_traffic_light = (ego.at_traffic_light if ego is not None
+                                    else world.player.is_at_traffic_light())
         current_time = time.time()
         if self.ignore_traffic_light:
             self.light_state = "Green"
         else:
             #This method also includes stop sign and intersections.
-            new_state = str(self.vehicle.get_traffic_light_state())
+            new_state = str(ego.light_state if ego is not None else self.vehicle.get_traffic_light_state())
 
             if new_state == "Green":
                 self.light_state = "Green"
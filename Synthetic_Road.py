@@ -0,0 +1,172 @@
+"""Synthetic road frames with a known lane geometry, for lane tests without CARLA.
+
+The road is drawn directly in camera space: below the horizon row, t = 0 at the
+horizon and 1 at the bottom row, the lane center is at
+    width / 2 + shift * t + curve * width * (1 - t) ** 2
+and the lane half width grows linearly with t, like a flat road seen by a pinhole
+camera. Lane borders are then exact polynomials x = polyval(model, y), so the ground
+truth is a LaneResult in the same convention as the detectors.
+"""
+
+import numpy as np
+import cv2
+
+from Lane_Detection import make_lane_result
+
+
+# Horizon row and lane half width at the bottom row, as fractions of the image size
+HORIZON = 0.55
+HALF_LANE = 0.3
+
+ASPHALT = 80
+MARKING = 235
+SKY = (200, 170, 120)
+GRASS = (60, 110, 70)
+
+
+class RoadScene(object):
+    """
+    Class describing one synthetic road layout.
+
+    shift: lane center minus image center at the bottom row, in pixels
+    curve: lateral bend of the lane at the horizon, as a fraction of the width
+           (negative: bends left)
+    dashed: draw the lane borders as dashes (the phase moves them along the road)
+    arrows, shadows: number of road arrows and shadow bands drawn over the road
+    noise: standard deviation of the gaussian sensor noise
+    """
+
+    def __init__(self, width, height, shift=0.0, curve=0.0, dashed=False, phase=0.0,
+                 arrows=0, shadows=0, noise=8.0):
+        self.width = width
+        self.height = height
+        self.shift = shift
+        self.curve = curve
+        self.dashed = dashed
+        self.phase = phase
+        self.arrows = arrows
+        self.shadows = shadows
+        self.noise = noise
+        self.horizon = int(height * HORIZON)
+
+    # ---------- Geometry ----------
+    def _t(self, y):
+        return (np.asarray(y, dtype=np.float64) - self.horizon) / float(self.height - self.horizon)
+
+    def center(self, y):
+        t = self._t(y)
+        return self.width / 2.0 + self.shift * t + self.curve * self.width * (1.0 - t) ** 2
+
+    def half_lane(self, y):
+        return HALF_LANE * self.width * self._t(y)
+
+    def lane_models(self):
+        """Exact left and right lane models x = polyval(model, y)"""
+        ys = np.linspace(self.horizon, self.height, 5)
+        degree = 2 if self.curve else 1
+        left = np.polyfit(ys, self.center(ys) - self.half_lane(ys), degree)
+        right = np.polyfit(ys, self.center(ys) + self.half_lane(ys), degree)
+        return left, right
+
+    def ground_truth(self):
+        left, right = self.lane_models()
+        return make_lane_result(left, right, self.height, self.width, confidence=1.0)
+
+    # ---------- Rendering ----------
+    def render(self, rng=None):
+        """
+        :return: HxWx4 BGRA uint8 frame, like a CARLA camera image
+        """
+        rng = rng if rng is not None else np.random.default_rng(0)
+        height, width = self.height, self.width
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[:self.horizon] = SKY
+        frame[self.horizon:] = GRASS
+
+        ys = np.arange(self.horizon, height)
+        t = np.maximum(self._t(ys), 1e-3)[:, None]
+        xs = np.arange(width)[None, :]
+        center = self.center(ys)[:, None]
+        half_lane = self.half_lane(ys)[:, None]
+        road = frame[self.horizon:]
+
+        # Asphalt a bit wider than the lane, slightly lighter towards the horizon
+        asphalt = np.abs(xs - center) < 1.8 * half_lane
+        shade = (ASPHALT + 15 * (1.0 - t)).astype(np.uint8)
+        road[asphalt] = np.repeat(shade, width, axis=1)[asphalt][:, None]
+
+        # Lane borders, a marking width of 1.2% of the image width at the bottom row
+        half_marking = 0.006 * width * t
+        markings = np.zeros(asphalt.shape, dtype=bool)
+        for side in (-1, 1):
+            markings |= np.abs(xs - (center + side * half_lane)) < np.maximum(half_marking, 0.5)
+        if self.dashed:
+            # Distance along the road is proportional to 1 / t on a flat road
+            distance = 1.0 / t + self.phase
+            markings &= (distance % 1.5) < 0.75
+        road[markings] = MARKING
+
+        for _ in range(self.arrows):
+            self._draw_arrow(frame, rng)
+        for _ in range(self.shadows):
+            self._draw_shadow(frame, rng)
+
+        if self.noise:
+            noisy = frame + rng.normal(0.0, self.noise, frame.shape)
+            frame = np.clip(noisy, 0, 255).astype(np.uint8)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+
+    def _draw_arrow(self, frame, rng):
+        """Straight ahead road arrow in the lane center, a typical source of false segments"""
+        y = self.horizon + rng.uniform(0.6, 0.9) * (self.height - self.horizon)
+        scale = self.half_lane(y) / 4.0
+        x = self.center(y)
+        outline = np.array([(-0.25, 1.0), (0.25, 1.0), (0.25, -0.6), (0.6, -0.6),
+                            (0.0, -1.4), (-0.6, -0.6), (-0.25, -0.6)])
+        points = np.round(np.column_stack((x + scale * outline[:, 0],
+                                           y + 0.6 * scale * outline[:, 1]))).astype(np.int32)
+        cv2.fillPoly(frame, [points], (MARKING, MARKING, MARKING))
+
+    def _draw_shadow(self, frame, rng):
+        """Dark band across the road, e.g. the shadow of a tree or a building"""
+        y0 = self.horizon + rng.uniform(0.1, 0.9) * (self.height - self.horizon)
+        band = rng.uniform(0.02, 0.08) * self.height
+        skew = rng.uniform(-0.2, 0.2) * self.width
+        points = np.array([(0, y0), (self.width, y0 + skew * 0.2),
+                           (self.width, y0 + band + skew * 0.2), (0, y0 + band)], dtype=np.int32)
+        mask = np.zeros(frame.shape[:2], dtype=np.uint8)
+        cv2.fillPoly(mask, [points], 1)
+        frame[mask.astype(bool)] //= 2
+
+
+# ==============================================================================
+# -- Scenarios -----------------------------------------------------------------
+# ==============================================================================
+
+SCENARIOS = {
+    'straight_solid': {},
+    'straight_dashed': {'dashed': True},
+    'curved_left': {'curve': -0.12},
+    'curved_right': {'curve': 0.12, 'dashed': True},
+    'arrows': {'dashed': True, 'arrows': 2},
+    'shadows': {'shadows': 3},
+    'noisy': {'noise': 25.0},
+}
+
+def make_scenario(name, width, height, count, seed=0):
+    """
+    Render a short drive through one scenario: the vehicle drifts across the lane
+    and the dashes move towards the camera.
+
+    :return: list of BGRA frames and the list of their ground truth LaneResults
+    """
+    params = SCENARIOS[name]
+    rng = np.random.default_rng(seed)
+    frames = []
+    truths = []
+    for index in range(count):
+        drift = 0.08 * width * np.sin(2.0 * np.pi * index / max(count, 1))
+        scene = RoadScene(width, height, shift=drift, phase=0.2 * index, **params)
+        frames.append(scene.render(rng))
+        truths.append(scene.ground_truth())
+    return frames, truths
@@ -0,0 +1,424 @@
+"""Synthetic CARLA world with counted calls, for controller benchmarks without a server.
+
+The fakes expose the methods the controller uses on the real objects -
+world.get_actors().filter(...), actor.get_transform() / get_velocity(),
+TrafficLight.state, map.get_waypoint(...) and the WorldSnapshot of wait_for_tick() -
+and count every call that would be a server round trip (or, for the map, a lookup)
+in calls. Only the carla client library is needed, for the Transform / Location /
+Vector3D values and the enums.
+
+The town is a stack of straight two-lane roads along x, ROAD_SPACING apart. On road
+r, lane -1 drives towards +x at y = r * ROAD_SPACING + LANE_WIDTH / 2 and lane 1
+towards -x on the other side; s is x on both lanes. Sidewalks run along the outer
+borders. Actors move along x at constant speed and wrap around at the road ends.
+
+Example:
+    world = SyntheticWorld(vehicles=1000, walkers=500, lights=50)
+    snapshot = world.wait_for_tick()
+    world.reset_calls()
+    ...
+    print(sum(world.calls.values()))
+"""
+
+import fnmatch
+import math
+from collections import Counter
+
+import numpy as np
+
+import carla
+
+
+LANE_WIDTH = 3.5
+SIDEWALK_WIDTH = 2.0
+ROAD_SPACING = 20.0
+# Vehicles per lane of the generated populations, sets the number of roads
+VEHICLES_PER_LANE = 40
+
+
+# ==============================================================================
+# -- Map -----------------------------------------------------------------------
+# ==============================================================================
+
+class SyntheticWaypoint(object):
+    """Waypoint of a SyntheticMap lane (or sidewalk)"""
+
+    def __init__(self, town, road_id, lane_id, s, lane_type=None):
+        self._town = town
+        self.road_id = road_id
+        self.lane_id = lane_id
+        self.s = s
+        self.lane_type = carla.LaneType.Driving if lane_type is None else lane_type
+        self.lane_width = SIDEWALK_WIDTH if self.lane_type == carla.LaneType.Sidewalk else LANE_WIDTH
+
+    @property
+    def transform(self):
+        center = self.road_id * ROAD_SPACING
+        offset = 0.5 * LANE_WIDTH if self.lane_type == carla.LaneType.Driving else LANE_WIDTH + 0.5 * SIDEWALK_WIDTH
+        y = center + offset if self.lane_id < 0 else center - offset
+        return carla.Transform(carla.Location(x=self.s, y=y, z=0.0),
+                               carla.Rotation(yaw=0.0 if self.lane_id < 0 else 180.0))
+
+    def get_right_lane(self):
+        # Lane -1 drives towards +x, so its right is +y: the sidewalk; lane 1 mirrors it
+        if self.lane_type != carla.LaneType.Driving:
+            return None
+        return SyntheticWaypoint(self._town, self.road_id, 2 * self.lane_id, self.s, carla.LaneType.Sidewalk)
+
+    def get_left_lane(self):
+        if self.lane_type != carla.LaneType.Driving:
+            return SyntheticWaypoint(self._town, self.road_id, int(self.lane_id / 2), self.s)
+        return SyntheticWaypoint(self._town, self.road_id, -self.lane_id, self.s)
+
+    def next(self, distance):
+        s = self.s + distance if self.lane_id < 0 else self.s - distance
+        if s < 0.0 or s > self._town.length:
+            return []
+        return [SyntheticWaypoint(self._town, self.road_id, self.lane_id, s, self.lane_type)]
+
+    def next_until_lane_end(self, distance):
+        waypoints = []
+        waypoint = self
+        while True:
+            following = waypoint.next(distance)
+            if not following:
+                return waypoints
+            waypoint = following[0]
+            waypoints.append(waypoint)
+
+
+class SyntheticMap(object):
+    """Map of a SyntheticWorld; get_waypoint calls are counted"""
+
+    name = 'Synthetic'
+
+    def __init__(self, town, calls):
+        self._town = town
+        self._calls = calls
+
+    def get_waypoint(self, location, project_to_road=True, lane_type=None):
+        self._calls['get_waypoint'] += 1
+        road = int(min(max(round(location.y / ROAD_SPACING), 0), self._town.roads - 1))
+        offset = location.y - road * ROAD_SPACING
+        s = min(max(location.x, 0.0), self._town.length)
+        lane_id = -1 if offset >= 0.0 else 1
+        if project_to_road:
+            return SyntheticWaypoint(self._town, road, lane_id, s)
+        if abs(offset) <= LANE_WIDTH:
+            return SyntheticWaypoint(self._town, road, lane_id, s)
+        if abs(offset) <= LANE_WIDTH + SIDEWALK_WIDTH:
+            return SyntheticWaypoint(self._town, road, 2 * lane_id, s, carla.LaneType.Sidewalk)
+        return None
+
+    def generate_waypoints(self, distance):
+        self._calls['generate_waypoints'] += 1
+        return [SyntheticWaypoint(self._town, road, lane_id, s)
+                for road in range(self._town.roads) for lane_id in (-1, 1)
+                for s in np.arange(0.0, self._town.length, distance).tolist()]
+
+    def get_spawn_points(self):
+        return [waypoint.transform for waypoint in self.generate_waypoints(50.0)]
+
+
+# ==============================================================================
+# -- Actors --------------------------------------------------------------------
+# ==============================================================================
+
+class _BoundingBox(object):
+    def __init__(self, extent):
+        self.location = carla.Location()
+        self.extent = carla.Vector3D(*extent)
+
+
+class SyntheticActor(object):
+    """Actor whose state is one row of the SyntheticWorld arrays"""
+
+    def __init__(self, world, row, actor_id, type_id, extent):
+        self._world = world
+        self._row = row
+        self.id = actor_id
+        self.type_id = type_id
+        self.attributes = {}
+        self.bounding_box = _BoundingBox(extent)
+
+    def _count(self, name):
+        self._world.calls[name] += 1
+
+    def get_world(self):
+        return self._world
+
+    def get_transform(self):
+        self._count('get_transform')
+        return self._world.transform(self._row)
+
+    def get_location(self):
+        self._count('get_location')
+        return self._world.transform(self._row).location
+
+    def get_velocity(self):
+        self._count('get_velocity')
+        return carla.Vector3D(*self._world.velocities[self._row].tolist())
+
+    def get_acceleration(self):
+        self._count('get_acceleration')
+        return carla.Vector3D()
+
+    def get_angular_velocity(self):
+        self._count('get_angular_velocity')
+        return carla.Vector3D()
+
+
+class SyntheticVehicle(SyntheticActor):
+    """Vehicle; the last speed command it received is kept in command"""
+
+    def __init__(self, world, row, actor_id, type_id='vehicle.synthetic.sedan', extent=(2.25, 1.0, 0.8)):
+        super(SyntheticVehicle, self).__init__(world, row, actor_id, type_id, extent)
+        self.light_state = carla.TrafficLightState.Green
+        self.command = None
+        self._control = carla.VehicleControl()
+
+    def get_traffic_light_state(self):
+        self._count('get_traffic_light_state')
+        return self.light_state
+
+    def is_at_traffic_light(self):
+        self._count('is_at_traffic_light')
+        return False
+
+    def get_speed_limit(self):
+        self._count('get_speed_limit')
+        return 30.0
+
+    def get_control(self):
+        self._count('get_control')
+        return self._control
+
+    def apply_control(self, control):
+        self._count('apply_control')
+        self._control = control
+        if control.brake > 0.0:
+            self.command = ('brake',)
+
+    def set_target_velocity(self, velocity):
+        self._count('set_target_velocity')
+        self.command = ('velocity', round(velocity.x, 3), round(velocity.y, 3), round(velocity.z, 3))
+
+    def set_simulate_physics(self, enabled=True):
+        self._count('set_simulate_physics')
+
+    def set_autopilot(self, enabled=True, port=None):
+        self._count('set_autopilot')
+
+
+class SyntheticWalker(SyntheticActor):
+    def __init__(self, world, row, actor_id):
+        super(SyntheticWalker, self).__init__(world, row, actor_id, 'walker.pedestrian.0001', (0.3, 0.3, 0.9))
+
+
+class SyntheticTrafficLight(SyntheticActor):
+    """Traffic light with one stop line per lane of its road"""
+
+    def __init__(self, world, row, actor_id, road, s, state):
+        super(SyntheticTrafficLight, self).__init__(world, row, actor_id, 'traffic.traffic_light', (0.5, 0.5, 3.0))
+        self._stops = [SyntheticWaypoint(world.town, road, -1, s), SyntheticWaypoint(world.town, road, 1, s)]
+        self._state = state
+
+    @property
+    def state(self):
+        self._count('state')
+        return self._state
+
+    def get_stop_waypoints(self):
+        self._count('get_stop_waypoints')
+        return list(self._stops)
+
+
+class SyntheticActorList(list):
+    """carla.ActorList: filter matches the type id with wildcards, on the client"""
+
+    def filter(self, pattern):
+        return SyntheticActorList(actor for actor in self if fnmatch.fnmatchcase(actor.type_id, pattern))
+
+    def find(self, actor_id):
+        for actor in self:
+            if actor.id == actor_id:
+                return actor
+        return None
+
+
+# ==============================================================================
+# -- Snapshot ------------------------------------------------------------------
+# ==============================================================================
+
+class _Timestamp(object):
+    def __init__(self, frame, elapsed_seconds):
+        self.frame = frame
+        self.elapsed_seconds = elapsed_seconds
+
+
+class SyntheticActorSnapshot(object):
+    """carla.ActorSnapshot: the state pushed with the tick, no calls counted"""
+
+    def __init__(self, world, row, actor_id):
+        self._world = world
+        self._row = row
+        self.id = actor_id
+
+    def get_transform(self):
+        return self._world.transform(self._row)
+
+    def get_velocity(self):
+        return carla.Vector3D(*self._world.velocities[self._row].tolist())
+
+    def get_acceleration(self):
+        return carla.Vector3D()
+
+    def get_angular_velocity(self):
+        return carla.Vector3D()
+
+
+class SyntheticWorldSnapshot(object):
+    """carla.WorldSnapshot of one tick"""
+
+    def __init__(self, world):
+        self._world = world
+        self.frame = world.frame
+        self.timestamp = _Timestamp(world.frame, world.frame * world.dt)
+
+    def __iter__(self):
+        return (SyntheticActorSnapshot(self._world, row, actor.id) for row, actor in enumerate(self._world.actors))
+
+    def __len__(self):
+        return len(self._world.actors)
+
+    def find(self, actor_id):
+        row = self._world.rows.get(actor_id)
+        return SyntheticActorSnapshot(self._world, row, actor_id) if row is not None else None
+
+
+# ==============================================================================
+# -- World ---------------------------------------------------------------------
+# ==============================================================================
+
+class _Town(object):
+    def __init__(self, roads, length):
+        self.roads = roads
+        self.length = length
+
+
+class SyntheticWorld(object):
+    """
+    Class holding a synthetic population and counting the calls made on it.
+
+    ego: vehicle 0, on road 0 with a slower vehicle 8 m ahead and a traffic light 30 m
+         ahead. With the light red (red_light) change_speed stops before looking at
+         the other actors; with it green the vehicle and walker checks run.
+    calls: collections.Counter of the calls since reset_calls()
+    """
+
+    def __init__(self, vehicles=100, walkers=50, lights=10, length=1000.0, dt=0.05, seed=0, red_light=False):
+        rng = np.random.default_rng(seed)
+        vehicles = max(vehicles, 2)
+        self.town = _Town(max(1, int(math.ceil(vehicles / (2.0 * VEHICLES_PER_LANE)))), length)
+        self.dt = dt
+        self.calls = Counter()
+        self.map = SyntheticMap(self.town, self.calls)
+        self.frame = 0
+
+        positions, yaws, velocities = [], [], []
+        # The ego, its leader, then random vehicles on random lanes
+        placed = [(0, -1, 0.2 * length, 6.0), (0, -1, 0.2 * length + 8.0, 6.0)]
+        for _ in range(vehicles - 2):
+            placed.append((int(rng.integers(self.town.roads)), int(rng.choice((-1, 1))),
+                           float(rng.uniform(0.0, length)), float(rng.uniform(0.0, 12.0))))
+        for road, lane_id, s, speed in placed:
+            direction = 1.0 if lane_id < 0 else -1.0
+            positions.append((s, road * ROAD_SPACING - lane_id * 0.5 * LANE_WIDTH, 0.0))
+            yaws.append(0.0 if lane_id < 0 else 180.0)
+            velocities.append((direction * speed, 0.0, 0.0))
+        # Walkers on the sidewalks, one in five crossing a road
+        for _ in range(walkers):
+            road = int(rng.integers(self.town.roads))
+            if rng.random() < 0.2:
+                offset = float(rng.uniform(-LANE_WIDTH, LANE_WIDTH))
+            else:
+                offset = float(rng.choice((-1.0, 1.0)) * rng.uniform(LANE_WIDTH, LANE_WIDTH + SIDEWALK_WIDTH))
+            speed = float(rng.uniform(-1.5, 1.5))
+            positions.append((float(rng.uniform(0.0, length)), road * ROAD_SPACING + offset, 0.0))
+            yaws.append(0.0 if speed >= 0 else 180.0)
+            velocities.append((speed, 0.0, 0.0))
+        # Lights at the roadside; the first one is ahead of the ego, see set_red_light
+        light_places = [(0, 0.2 * length + 30.0)] + [
+            (int(rng.integers(self.town.roads)), float(rng.uniform(0.0, length))) for _ in range(lights - 1)]
+        light_states = [carla.TrafficLightState.Green] + [
+            (carla.TrafficLightState.Red, carla.TrafficLightState.Yellow, carla.TrafficLightState.Green)[
+                int(rng.integers(3))] for _ in range(lights - 1)]
+        for road, s in light_places[:lights]:
+            positions.append((s, road * ROAD_SPACING + LANE_WIDTH + SIDEWALK_WIDTH + 1.0, 0.0))
+            yaws.append(0.0)
+            velocities.append((0.0, 0.0, 0.0))
+
+        self._initial = (np.array(positions, dtype=np.float64).reshape(-1, 3),
+                         np.array(yaws, dtype=np.float64),
+                         np.array(velocities, dtype=np.float64).reshape(-1, 3))
+        self.positions, self.yaws, self.velocities = [array.copy() for array in self._initial]
+
+        self.actors = SyntheticActorList()
+        for row in range(vehicles):
+            self.actors.append(SyntheticVehicle(self, row, 1000 + row))
+        for index in range(walkers):
+            row = vehicles + index
+            self.actors.append(SyntheticWalker(self, row, 1000 + row))
+        for index, ((road, s), state) in enumerate(zip(light_places[:lights], light_states)):
+            row = vehicles + walkers + index
+            self.actors.append(SyntheticTrafficLight(self, row, 1000 + row, road, s, state))
+        self.rows = {actor.id: row for row, actor in enumerate(self.actors)}
+        self.ego = self.actors[0]
+        self.light_ahead = self.actors[vehicles + walkers]
+        self.set_red_light(red_light)
+
+    def set_red_light(self, red=True):
+        """Turn the light ahead of the ego, and the light state of the ego, red or green"""
+        state = carla.TrafficLightState.Red if red else carla.TrafficLightState.Green
+        self.light_ahead._state = state
+        self.ego.light_state = state
+
+    def transform(self, row):
+        x, y, z = self.positions[row].tolist()
+        return carla.Transform(carla.Location(x=x, y=y, z=z), carla.Rotation(yaw=float(self.yaws[row])))
+
+    def reset(self):
+        """Back to the initial positions and frame, for the next implementation"""
+        self.positions, self.yaws, self.velocities = [array.copy() for array in self._initial]
+        self.frame = 0
+        self.ego.command = None
+
+    def reset_calls(self):
+        self.calls.clear()
+
+    def step(self):
+        """Move every actor along x by one tick, wrapping around at the road ends"""
+        self.frame += 1
+        self.positions[:, 0] = (self.positions[:, 0] + self.velocities[:, 0] * self.dt) % self.town.length
+
+    # -- carla.World -----------------------------------------------------------
+
+    def get_actors(self, actor_ids=None):
+        self.calls['get_actors'] += 1
+        if actor_ids is None:
+            return SyntheticActorList(self.actors)
+        return SyntheticActorList(self.actors[self.rows[actor_id]] for actor_id in actor_ids
+                                  if actor_id in self.rows)
+
+    def get_map(self):
+        self.calls['get_map'] += 1
+        return self.map
+
+    def get_snapshot(self):
+        self.calls['get_snapshot'] += 1
+        return SyntheticWorldSnapshot(self)
+
+    def wait_for_tick(self, seconds=10.0):
+        """Advance one tick; the snapshot is pushed by the server, not counted"""
+        self.step()
+        return SyntheticWorldSnapshot(self)
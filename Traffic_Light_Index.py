@@ -0,0 +1,112 @@
+"""Static index of the traffic lights of a map.
+
+Light positions and stop lines never move, so they are collected once per map:
+the stop waypoints of every light are grouped by (road_id, lane_id) and sorted by
+s, and the light positions go into a Proximity.ProximityGrid. "Which light governs
+my lane within X m" is then a search in the ego lane plus, near the end of the
+lane, its successors, and one state read of the light found.
+
+Example:
+    index = TrafficLightIndex(world, world.get_map())
+    light, distance = index.next_light(world_map.get_waypoint(ego_location), 45.0)
+"""
+
+import bisect
+from collections import defaultdict
+
+import numpy as np
+
+from Lane_Graph import LaneGraph
+from Proximity import ProximityGrid
+
+
+class _LaneStops(object):
+    """Stop lines of one lane, sorted by s"""
+
+    def __init__(self):
+        self.s = []
+        self.lights = []
+
+    def add(self, s, light_row):
+        index = bisect.bisect(self.s, s)
+        self.s.insert(index, s)
+        self.lights.insert(index, light_row)
+
+
+class TrafficLightIndex(object):
+    """
+    Class indexing the traffic lights of a map by lane and by position.
+
+    lights: carla.TrafficLight handles, positions: (N, 3) light locations
+    stops: per light, the (road_id, lane_id, s, location) of its stop lines
+    """
+
+    def __init__(self, world, world_map, cell_size=20.0, step=2.0, behind_tolerance=2.0):
+        """
+        :param step: waypoint spacing used to walk to the end of a lane
+        :param behind_tolerance: a stop line up to this far behind still governs the
+                                 vehicle (it stopped slightly past it)
+        """
+        self.map = world_map
+        self.map_name = world_map.name
+        self.lanes = LaneGraph(step)
+        self.behind_tolerance = behind_tolerance
+        self.lights = list(world.get_actors().filter('traffic.traffic_light*'))
+        self.ids = np.array([light.id for light in self.lights], dtype=np.int64)
+        locations = [light.get_transform().location for light in self.lights]
+        self.positions = np.array([(l.x, l.y, l.z) for l in locations], dtype=np.float64).reshape(-1, 3)
+        self.grid = ProximityGrid(self.positions, cell_size)
+        self.stops = []
+        self._lanes = defaultdict(_LaneStops)
+        for row, light in enumerate(self.lights):
+            waypoints = self._stop_waypoints(light)
+            self.stops.append([(w.road_id, w.lane_id, w.s, w.transform.location) for w in waypoints])
+            for waypoint in waypoints:
+                self._lanes[(waypoint.road_id, waypoint.lane_id)].add(waypoint.s, row)
+
+    @staticmethod
+    def _stop_waypoints(light):
+        """Stop line waypoints, or the affected lane waypoints on older CARLA versions"""
+        if hasattr(light, 'get_stop_waypoints'):
+            return light.get_stop_waypoints()
+        if hasattr(light, 'get_affected_lane_waypoints'):
+            return light.get_affected_lane_waypoints()
+        return []
+
+    def __len__(self):
+        return len(self.lights)
+
+    def lights_near(self, location, radius):
+        """Lights within radius of a carla.Location, closest first"""
+        rows, _ = self.grid.query((location.x, location.y, location.z), radius, planar=True)
+        return [self.lights[row] for row in rows]
+
+    def _on_lane(self, key, s, budget):
+        """Closest stop line ahead on one lane within budget meters: (light row, distance)"""
+        stops = self._lanes.get(key)
+        if stops is None:
+            return None, None
+        # Negative lane ids drive towards increasing s
+        if key[1] < 0:
+            index = bisect.bisect_left(stops.s, s - self.behind_tolerance)
+            if index < len(stops.s) and stops.s[index] - s <= budget:
+                return stops.lights[index], max(stops.s[index] - s, 0.0)
+        else:
+            index = bisect.bisect_right(stops.s, s + self.behind_tolerance) - 1
+            if index >= 0 and s - stops.s[index] <= budget:
+                return stops.lights[index], max(s - stops.s[index], 0.0)
+        return None, None
+
+    def next_light(self, waypoint, max_distance=45.0):
+        """
+        Next traffic light governing the lane of a waypoint.
+
+        At a junction every successor lane is searched and the closest light wins.
+
+        :param waypoint: carla.Waypoint of the vehicle, e.g. map.get_waypoint(location)
+        :return: (carla.TrafficLight, distance along the lanes) or (None, None)
+        """
+        best_row, best_distance = self.lanes.search(waypoint, max_distance, self._on_lane)
+        if best_row is None:
+            return None, None
+        return self.lights[best_row], best_distance
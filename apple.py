@@ -30,7 +30,14 @@ import numpy as np
 import cv2
 import time
 from ultralytics import YOLO
-from Lane_Detection import process_image_lane
+from Actor_Snapshot import ActorSnapshotService
+from Ego_State import EgoStateProvider
+from Lane_Detection import as_bgr_frame, to_surface
+from Lane_Keeping import LaneKeeper
+from Lane_Profiling import StageCollector, start_timer
+from Lane_Pipeline import LanePipeline
+from Lane_Strategies import LANE_STRATEGIES, DEFAULT_STRATEGY, get_strategy
+from Occupancy_Grid import OccupancyGrid
 import math
 import weakref
 
@@ -72,6 +79,13 @@ class World(object):
         self._actor_filter = args.filter
         self._gamma = args.gamma
         self.hud = hud
+        self.actor_snapshots = ActorSnapshotService(self.world)
+        self.snapshot = None
+        self.lane_collector = StageCollector() if args.profile else None
+        self.lane_keeper = None
+        self.occupancy = OccupancyGrid(self.map) if args.occupancy else None
+        self.ego = None
+        self.ego_state = None
         self.restart(args)
         
 
@@ -114,11 +128,21 @@ class World(object):
             self.player = self.world.spawn_actor(blueprint, spawn_point)
 
                 # Set up the camera sensor
-            self.camera_manager = CameraManager(self.player, self._gamma, args.width, args.height)
+            if args.lane_keeping:
+                self.lane_keeper = LaneKeeper(self.player, world=self.world)
+            lane_params = {'world_map': self.map} if LANE_STRATEGIES[args.lane_strategy].needs_map else {}
+            self.camera_manager = CameraManager(self.player, self._gamma, args.width, args.height,
+                                                draw_overlay=not args.no_overlay,
+                                                lane_strategy=get_strategy(args.lane_strategy, **lane_params),
+                                                collector=self.lane_collector,
+                                                pipelined=args.pipeline,
+                                                lane_keeper=self.lane_keeper)
             self.camera_manager.transform_index = cam_pos_id
             self.camera_manager.set_sensor(1, notify=False)
             actor_type = get_actor_display_name(self.player)
             print('spawned %r at %s' % (actor_type, spawn_point.location))
+        if self.ego is None:
+            self.ego = EgoStateProvider(self.player, self.world)
 
     def next_weather(self, reverse=False):
         """Method to change the weather"""
@@ -127,6 +151,15 @@ class World(object):
         preset = self._weather_presets[self._weather_presets]
         self.player.get_world().set_weather(preset[0])
 
+    def tick(self, world_snapshot):
+        """Build the actor table and the ego state of the tick, read by the controller, the agent and the HUD"""
+        self.snapshot = self.actor_snapshots.update(world_snapshot)
+        self.ego_state = self.ego.update(world_snapshot, self.snapshot)
+        if self.occupancy is not None:
+            row = self.snapshot.row(self.player.id)
+            if row is not None:
+                self.occupancy.update(self.snapshot, row)
+
     def render(self, display):
         """ Method to render the world """
         self.camera_manager.render(display)
@@ -140,6 +173,11 @@ class World(object):
                     
     def destroy(self):
         """Destroy the player"""
+        if self.ego is not None:
+            self.ego.destroy()
+            self.ego = None
+        if self.camera_manager is not None and self.camera_manager.lane_pipeline is not None:
+            self.camera_manager.lane_pipeline.stop()
         actors = [
             self.camera_manager.sensor,
             self.player]
@@ -166,10 +204,23 @@ class HUD(object):
 
     def render(self, world, display):
         """Method to render the HUD"""
-        velocity = world.player.get_velocity()
-        if velocity is not None:
-            speed = 3.6 * math.sqrt(velocity.x**2 + velocity.y**2 + velocity.z**2)
-            display.blit(self._font.render('Speed: % 5d km/h' % speed, True, (255, 255, 255)), (10, 10))
+        if world.ego_state is not None:
+            speed = world.ego_state.speed
+        else:
+            speed = world.snapshot.speed(world.player.id) if world.snapshot is not None else None
+        if speed is None:
+            velocity = world.player.get_velocity()
+            speed = math.sqrt(velocity.x**2 + velocity.y**2 + velocity.z**2)
+        display.blit(self._font.render('Speed: % 5d km/h' % (3.6 * speed), True, (255, 255, 255)), (10, 10))
+        if world.lane_keeper is not None and world.lane_keeper.records:
+            latency = world.lane_keeper.records[-1][2]
+            display.blit(self._font.render('Lane keeping: %.1f ms' % latency, True, (255, 255, 255)), (10, 30))
+        if world.occupancy is not None and world.occupancy.frame is not None:
+            surface = to_surface(world.occupancy.to_image())
+            display.blit(surface, (self.dim[0] - surface.get_width() - 10, 10))
+            display.blit(self._font.render('Free ahead: %4.1f m' % world.occupancy.free_distance(), True,
+                                           (255, 255, 255)), (self.dim[0] - surface.get_width() - 10,
+                                                              surface.get_height() + 15))
 
 # ==============================================================================
 # -- KeyboardControl -----------------------------------------------------------
@@ -195,9 +246,24 @@ class KeyboardControl(object):
 class CameraManager(object):
     """ Class to manage the camera sensor """
 
-    def __init__(self, parent_actor, gamma_correction, width, height):
+    def __init__(self, parent_actor, gamma_correction, width, height, draw_overlay=True,
+                 lane_strategy=None, collector=None, pipelined=False, lane_keeper=None):
         self.sensor = None
         self.surface = None
+        self.lane_result = None
+        self.draw_overlay = draw_overlay
+        self.lane_strategy = lane_strategy or get_strategy(DEFAULT_STRATEGY)
+        self.collector = collector
+        self.lane_keeper = lane_keeper
+        self.lane_pipeline = None
+        if pipelined:
+            weak_self = weakref.ref(self)
+            on_detect = None
+            if lane_keeper is not None:
+                on_detect = lambda job: CameraManager._on_lane_detected(weak_self, job)
+            self.lane_pipeline = LanePipeline(
+                self.lane_strategy, lambda *output: CameraManager._on_lane_result(weak_self, *output),
+                draw_overlay, on_detect=on_detect, collector=collector)
         self._parent = parent_actor
         self._gamma = gamma_correction
         attachment = carla.AttachmentType
@@ -214,7 +280,10 @@ class CameraManager(object):
     def set_sensor(self, index, notify=True):
         """Set the sensor"""
         weak_self = weakref.ref(self)
-        self.sensor.listen(lambda image: CameraManager._parse_image(weak_self, image))
+        if self.lane_pipeline is not None:
+            self.sensor.listen(self.lane_pipeline.submit)
+        else:
+            self.sensor.listen(lambda image: CameraManager._parse_image(weak_self, image))
         print("Camera sensor created")
 
 
@@ -229,7 +298,40 @@ class CameraManager(object):
         if self is None:
             return
 
-        self.surface = process_image_lane(image)
+        received = time.perf_counter()
+        frame = as_bgr_frame(image)
+        # Map guided strategies read the camera transform and fov from the carla.Image
+        self.lane_result = self.lane_strategy.detect(
+            image if self.lane_strategy.needs_map else frame, self.collector)
+        if self.lane_keeper is not None:
+            # Steer before drawing anything, the overlay is not on the control path
+            self.lane_keeper.on_result(image.frame, self.lane_result, image.timestamp, received,
+                                       time.perf_counter())
+        if self.draw_overlay:
+            lane_img = self.lane_strategy.render(frame, self.lane_result, self.collector)
+            timer = start_timer(self.collector)
+            self.surface = to_surface(lane_img)
+            if timer is not None:
+                timer('surface')
+        if self.collector is not None:
+            self.collector.frame()
+
+    @staticmethod
+    def _on_lane_detected(weak_self, job):
+        self = weak_self()
+        if self is None:
+            return
+        self.lane_keeper.on_result(job.image.frame, job.result, job.image.timestamp, job.submitted,
+                                   job.detected)
+
+    @staticmethod
+    def _on_lane_result(weak_self, frame_id, result, surface):
+        self = weak_self()
+        if self is None:
+            return
+        self.lane_result = result
+        if surface is not None:
+            self.surface = surface
 
 def game_loop(args):
     """ Main loop for the game """
@@ -265,12 +367,13 @@ def game_loop(args):
             if not world.world.wait_for_tick(10.0):
                 continue
 
-            world.world.wait_for_tick(10.0)
+            world.tick(world.world.wait_for_tick(10.0))
 
             world.render(display)
             pygame.display.flip()
-            world.player.set_autopilot(True)
-            yaw =  world.player.get_transform().rotation.yaw
+            if world.lane_keeper is None:
+                world.player.set_autopilot(True)
+            yaw =  world.ego_state.rotation.yaw
             # Convert degrees to radians
             yaw_rad = math.radians(yaw)
 
@@ -284,6 +387,16 @@ def game_loop(args):
 
 
     finally:
+        if world is not None and world.lane_collector is not None:
+            world.lane_collector.save(args.profile)
+            world.lane_collector.print_summary()
+            print(f"[LANE PROFILE SAVED] {args.profile}")
+        if world is not None and world.lane_keeper is not None:
+            print(f"[LANE KEEPING] {world.lane_keeper.summary()}")
+            if args.lane_keeping_log:
+                world.lane_keeper.save(args.lane_keeping_log)
+        if world is not None and world.camera_manager is not None and world.camera_manager.lane_pipeline is not None:
+            print(f"[LANE PIPELINE] {world.camera_manager.lane_pipeline.stats()}")
         if world is not None:
             world.destroy()
 
@@ -346,6 +459,35 @@ def main():
         type=bool,
         default=False,
         help='Use custom code')
+    argparser.add_argument(
+        '--no-overlay',
+        action='store_true',
+        help='Only compute lane results, do not draw the lane overlay')
+    argparser.add_argument(
+        '--lane-strategy',
+        choices=sorted(LANE_STRATEGIES),
+        default=DEFAULT_STRATEGY,
+        help='Lane detection strategy (default: %(default)s)')
+    argparser.add_argument(
+        '--profile',
+        metavar='PATH',
+        help='Collect per-stage lane timings and write them to a json file on exit')
+    argparser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='Run the lane stages pipelined on worker threads')
+    argparser.add_argument(
+        '--lane-keeping',
+        action='store_true',
+        help='Steer from the lane results in the camera callback instead of using the autopilot')
+    argparser.add_argument(
+        '--lane-keeping-log',
+        metavar='PATH',
+        help='Write the per-frame lane keeping latency to a csv file on exit')
+    argparser.add_argument(
+        '--occupancy',
+        action='store_true',
+        help='Show the occupancy raster around the vehicle on the HUD')
 
     args = argparser.parse_args()
 